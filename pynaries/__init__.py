@@ -2,46 +2,181 @@
 # see LICENSE in the root folder for details on the license.
 # Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
 
-import os, sys, logging, logging.config
-import simplejson, simplejson.scanner
+import os, sys, threading, logging, logging.config
 
-import bundle, version
-from bundle import Bundle, Resolver, AddPullSite, localRepository
+import bundle, version, console, pool, solver, cleanup
+from bundle import Bundle, Resolver, AddPullSite, SetExtractMode, localRepository
 from version import Version
+from solver import UnsatisfiableDependencies
+from lockfile import Lockfile, LockMismatch, fetchLocked
+from indexcache import SetIndexCacheTTL, SetOffline
+from cleanup import SetCacheBudget
+from transfer import SetDownloadSegments
 from site import *
 
-logging.config.fileConfig(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'logging.conf'))
 logger = logging.getLogger('Logger')
+setupDone = False
+setupLock = threading.Lock()
 
-def fetch(dependencies, repository=localRepository):
-	bundles = []
-	for id, op, version in dependencies:
-		bundles.append(fetchDependency(id, op, version, repository))
+# configures logging and runs ~/.pynaries/config. this normally happens on
+# import, but if PYNARIES_DEFER_SETUP is set in the environment it's put off
+# until the first fetch/resolve/publish (or an explicit call), so that tools
+# which only need Version or Bundle can import pynaries cheaply
+def setup():
+	global setupDone
+	setupLock.acquire()
+	try:
+		if setupDone: return
+		setupDone = True
+		logging.config.fileConfig(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'logging.conf'))
+
+		pynariesConfig = os.path.join(os.path.expanduser('~'), '.pynaries', 'config')
+		if os.path.exists(pynariesConfig) and os.path.isfile(pynariesConfig):
+			f = open(pynariesConfig, 'r')
+			try:
+				exec f.read() in globals()
+			except Exception, e:
+				logging.error("Error reading pynaries config file:" + str(e))
+
+			f.close()
+	finally:
+		setupLock.release()
+
+# fetch a list of (id, op, version) dependencies, resolving and downloading
+# up to `jobs` of them concurrently. bundles are returned in input order.
+# with transitive, the dependencies of the bundles are fetched as well, with
+# versions chosen for the whole graph at once (see solver.py); their bundles
+# follow the ones that were asked for.
+# with a lockfile path, the resolved bundles are recorded in it, and as long
+# as the dependencies don't change later fetches skip resolution and use
+# exactly those bundles (see lockfile.py).
+# afterwards, the repository is cleaned up if it has a budget and is due
+# (see cleanup.py). the fetched bundles, and those of the lockfile, are kept
+def fetch(dependencies, repository=localRepository, jobs=None, transitive=False, lockfile=None):
+	setup()
+	dependencies = list(dependencies)
+	if lockfile is not None:
+		cleanup.registerLockfile(lockfile, repository)
+	bundles = _fetch(dependencies, repository, jobs, transitive, lockfile)
+	cleanup.collectIfDue(repository, bundles)
+	return bundles
+
+def _fetch(dependencies, repository, jobs, transitive, lockfile):
+	lock = None
+	if lockfile is not None:
+		lock = Lockfile(lockfile)
+		if lock.load() and lock.matches(dependencies, transitive):
+			logging.info("Using locked bundles from " + lockfile)
+			return _fetchLocked(lock.bundles(), repository, jobs)
+
+	if transitive:
+		resolutions = solver.solve(dependencies, repository)
+	elif lock is not None:
+		resolutions = pool.parallelMap(lambda d: resolve(d[0], d[1], d[2], repository=repository), dependencies, jobs)
+	else:
+		return _fetchAll(dependencies, lambda d: fetchDependency(d[0], d[1], d[2], repository), jobs)
+
+	bundles = _fetchAll(resolutions, lambda r: fetchResolution(r, repository), jobs)
+	if lock is not None:
+		if [r for r in resolutions if r is None]:
+			logging.warn("Not all dependencies resolved, %s wasn't written" % lockfile)
+		else:
+			lock.save(dependencies, transitive, resolutions)
+	return bundles
+
+# bundles that are already in the repository are looked up directly, only
+# the rest need to be downloaded
+def _fetchLocked(entries, repository, jobs):
+	bundles = [repository.lockedBundle(e['id'], e['version'], e['sha1']) for e in entries]
+	missing = [i for i in range(len(entries)) if bundles[i] is None]
+	fetched = _fetchAll([entries[i] for i in missing], lambda e: fetchLocked(e, repository), jobs)
+	for i, b in zip(missing, fetched):
+		bundles[i] = b
 	return bundles
-	
+
+def _fetchAll(items, fetchOne, jobs):
+	if jobs is None:
+		jobs = pool.DefaultJobs
+	if jobs <= 1 or len(items) <= 1:
+		return [fetchOne(item) for item in items]
+
+	progress = console.ParallelProgress()
+	progress.startAll("%d dependencies" % len(items), 'download', len(items))
+	# the workers report to progress, other threads are left alone
+	def fetchTask(item):
+		bundle.SetThreadProgress(progress)
+		try:
+			return fetchOne(item)
+		finally:
+			bundle.SetThreadProgress(None)
+			progress.finishTask()
+
+	try:
+		return pool.parallelMap(fetchTask, items, jobs)
+	finally:
+		progress.finishAll()
+
+# fetch a resolution that's already been chosen, i.e. by the solver
+def fetchResolution(resolution, repository=localRepository):
+	if resolution is None:
+		return None
+	if resolution.site:
+		lock = repository.versionLock(resolution.id, resolution.version)
+		lock.acquire(shared=True)
+		try:
+			resolution.site.fetch(resolution, repository)
+		finally:
+			lock.release()
+	else:
+		logging.info(":: => Using local resolution: " + resolution.bundle.path)
+		resolution.bundle.repository.recordUse(resolution.bundle)
+	return resolution.bundle
+
 def fetchDependency(id, op=bundle.GreaterThan, version="0.0.0", repository=localRepository):
+	setup()
 	logging.info("Finding %s %s %s" % (id,op,version))
 	resolver = Resolver(id, op, version)
-	resolver.resolve()
+	resolver.resolve(repository=repository)
 	return resolver.fetch(repository)
 
-def resolve(id, op=bundle.GreaterThan, version="0.0.0", remote=True, local=True):
+def resolve(id, op=bundle.GreaterThan, version="0.0.0", remote=True, local=True, repository=localRepository):
+	setup()
 	logging.info('Resolving %s %s %s' % (id,op,version))
 	resolver = Resolver(id,op,version)
-	resolver.resolve(remote,local)
+	resolver.resolve(remote,local,repository)
 	return resolver.resolution
 
-def publish(dir, id, version, site):
+# with incremental, files unchanged since the last bundle of id are copied
+# from it rather than compressed again (see Bundle.bundle). deltas is a list
+# of earlier versions in the local repository to also publish deltas from,
+# and dependencies the (id, op, version) dependencies of the bundle itself
+def publish(dir, id, version, site, incremental=False, deltas=[], dependencies=[]):
+	setup()
 	b = Bundle(id, version)
-	b.bundle(dir)
+	b.dependencies = [tuple(d) for d in dependencies]
+	b.bundle(dir, incremental)
+	for baseVersion in deltas:
+		b.createDelta(baseVersion)
 	b.publish(site)
 
-pynariesConfig = os.path.join(os.path.expanduser('~'), '.pynaries', 'config')
-if os.path.exists(pynariesConfig) and os.path.isfile(pynariesConfig):
-	f = open(pynariesConfig, 'r')
-	try:
-		exec(f.read())
-	except Exception, e:
-		logging.error("Error reading pynaries config file:" + str(e))
-	
-	f.close()
\ No newline at end of file
+# bundle and publish several (dir, id, version) entries. the archives are
+# uploaded concurrently, and the site's index is only updated once at the end
+def publishAll(entries, site, incremental=False, jobs=None):
+	setup()
+	bundles = []
+	for dir, id, version in entries:
+		b = Bundle(id, version)
+		b.bundle(dir, incremental)
+		bundles.append(b)
+	site.publishAll(bundles, jobs)
+	return bundles
+
+# serve a caching mirror of upstreams (by default, the configured pull
+# sites) over HTTP until interrupted, see mirror.py
+def serve(upstreams=None, port=8080, host='', repository=None, sharded=False, path='/'):
+	setup()
+	import mirror
+	mirror.serve(upstreams, port, host, repository, sharded, path)
+
+if not os.environ.has_key('PYNARIES_DEFER_SETUP'):
+	setup()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+# python -m pynaries serve [options] [upstream ...]
+#
+# upstreams are http:// URLs or local site directories; without any, the
+# pull sites from ~/.pynaries/config are mirrored
+
+import os, sys, optparse, urlparse
+import pynaries
+from pynaries import bundle
+from pynaries.site import HTTPSite, LocalSite
+
+def upstreamSite(arg):
+	url = urlparse.urlparse(arg)
+	if url.scheme == 'http':
+		return HTTPSite(url.hostname, url.port or 80, url.path or '/')
+	if url.scheme in ('', 'file') and os.path.isdir(url.path):
+		return LocalSite(url.path)
+	raise Exception("Not an http:// URL or a site directory: " + arg)
+
+def main(args):
+	parser = optparse.OptionParser(usage="python -m pynaries serve [options] [upstream ...]")
+	parser.add_option('--host', default='', help="address to listen on (default: all)")
+	parser.add_option('--port', type='int', default=8080, help="port to listen on (default: 8080)")
+	parser.add_option('--cache', default=None, help="where archives are cached (default: ~/.pynaries-mirror)")
+	parser.add_option('--path', default='/', help="path the site is served under (default: /)")
+	parser.add_option('--sharded', action='store_true', default=False, help="serve a sharded index")
+	options, args = parser.parse_args(args)
+	if len(args) == 0 or args[0] != 'serve':
+		parser.error("the only command is serve")
+
+	upstreams = None
+	if len(args) > 1:
+		upstreams = [upstreamSite(arg) for arg in args[1:]]
+	repository = None
+	if options.cache:
+		repository = bundle.LocalRepository(options.cache)
+	pynaries.serve(upstreams, options.port, options.host, repository, options.sharded, options.path)
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
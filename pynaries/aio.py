@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Non-blocking versions of resolve, fetchDependency, fetch and publish, i.e.
+
+	from pynaries import aio
+	futures = [aio.fetch(deps) for deps in workspaces]
+	for future in aio.asCompleted(futures):
+		...
+
+Each call returns a Future straight away. The work itself runs on a single
+shared pool of Workers threads, however many calls are outstanding, so a
+build orchestrator can prepare hundreds of workspaces from one thread without
+a thread per dependency: a fetch of many dependencies is queued as one task
+per dependency, and only Workers of them run at a time.
+
+Since tasks run side by side, each reports its progress to a sink of its own
+(a fetch's dependencies share one ParallelProgress bar) rather than to
+bundle.Progress.
+"""
+
+import sys, time, threading, Queue, logging
+import pynaries, bundle, cleanup, console
+
+Workers = 16
+
+def SetWorkers(workers):
+	global Workers
+	Workers = max(1, int(workers))
+
+class TimeoutError(Exception):
+	pass
+
+class Future:
+	def __init__(self):
+		self.event = threading.Event()
+		self.lock = threading.Lock()
+		self.callbacks = []
+		self.value = None
+		self.error = None
+
+	def done(self):
+		return self.event.isSet()
+
+	# the result of the call, waiting up to timeout seconds for it (None
+	# waits forever). an exception raised by the call is raised again here
+	def result(self, timeout=None):
+		if not self.event.wait(timeout) and not self.done():
+			raise TimeoutError("Timed out waiting for a result")
+		if self.error is not None:
+			raise self.error[0], self.error[1], self.error[2]
+		return self.value
+
+	def exception(self, timeout=None):
+		if not self.event.wait(timeout) and not self.done():
+			raise TimeoutError("Timed out waiting for a result")
+		if self.error is not None:
+			return self.error[1]
+		return None
+
+	# fn is called with the future once it's done, from the thread that
+	# finished it (or right away, if it already is)
+	def addDoneCallback(self, fn):
+		self.lock.acquire()
+		try:
+			if not self.done():
+				self.callbacks.append(fn)
+				return
+		finally:
+			self.lock.release()
+		fn(self)
+
+	def _finish(self, value=None, error=None):
+		self.lock.acquire()
+		try:
+			self.value = value
+			self.error = error
+			self.event.set()
+			callbacks = self.callbacks
+			self.callbacks = []
+		finally:
+			self.lock.release()
+		for fn in callbacks:
+			try:
+				fn(self)
+			except Exception, e:
+				logging.error("Error in future callback: " + str(e))
+
+_tasks = Queue.Queue()
+_threads = []
+_threadsLock = threading.Lock()
+
+def _work():
+	while True:
+		future, fn, args, kwargs = _tasks.get()
+		try:
+			future._finish(fn(*args, **kwargs))
+		except:
+			future._finish(error=sys.exc_info())
+
+def _startWorkers():
+	_threadsLock.acquire()
+	try:
+		while len(_threads) < Workers:
+			thread = threading.Thread(target=_work)
+			thread.setDaemon(True)
+			thread.start()
+			_threads.append(thread)
+	finally:
+		_threadsLock.release()
+
+# run fn(*args, **kwargs) on the shared workers
+def submit(fn, *args, **kwargs):
+	_startWorkers()
+	future = Future()
+	_tasks.put((future, fn, args, kwargs))
+	return future
+
+# a future for the list of results of futures, in order. it fails with the
+# first error (in order) once all of them are done
+def gather(futures):
+	futures = list(futures)
+	combined = Future()
+	remaining = [len(futures)]
+	lock = threading.Lock()
+	def finished(future):
+		lock.acquire()
+		try:
+			remaining[0] -= 1
+			if remaining[0] > 0: return
+		finally:
+			lock.release()
+		for f in futures:
+			if f.error is not None:
+				combined._finish(error=f.error)
+				return
+		combined._finish([f.value for f in futures])
+
+	if len(futures) == 0:
+		combined._finish([])
+	for future in futures:
+		future.addDoneCallback(finished)
+	return combined
+
+# yields futures as they finish, waiting up to timeout seconds in all
+def asCompleted(futures, timeout=None):
+	futures = list(futures)
+	done = Queue.Queue()
+	for future in futures:
+		future.addDoneCallback(done.put)
+	deadline = None
+	if timeout is not None:
+		deadline = time.time() + timeout
+	for i in range(len(futures)):
+		# Queue.get without a timeout can't be interrupted
+		wait = 60
+		if deadline is not None:
+			wait = max(0, deadline - time.time())
+		while True:
+			try:
+				yield done.get(True, wait)
+				break
+			except Queue.Empty:
+				if deadline is not None:
+					raise TimeoutError("Timed out waiting for %d futures" % (len(futures) - i))
+
+def resolve(id, op=bundle.GreaterThan, version="0.0.0", remote=True, local=True, repository=bundle.localRepository):
+	return submit(pynaries.resolve, id, op, version, remote, local, repository)
+
+# call fn(*args) with the worker's progress reported to sink
+def _reporting(sink, fn, *args):
+	bundle.SetThreadProgress(sink)
+	try:
+		return fn(*args)
+	finally:
+		bundle.SetThreadProgress(None)
+
+def fetchDependency(id, op=bundle.GreaterThan, version="0.0.0", repository=bundle.localRepository):
+	return submit(_reporting, console.ConsoleProgress(), pynaries.fetchDependency, id, op, version, repository)
+
+# dependencies are queued individually, so a big fetch shares the workers
+# with everything else. transitive and locked fetches run as a single task.
+# as with pynaries.fetch, the repository is cleaned up afterwards if it's due
+def fetch(dependencies, repository=bundle.localRepository, transitive=False, lockfile=None):
+	if transitive or lockfile is not None:
+		return submit(pynaries.fetch, dependencies, repository, 1, transitive, lockfile)
+	dependencies = list(dependencies)
+	progress = console.ParallelProgress()
+	if len(dependencies) > 0:
+		progress.startAll("%d dependencies" % len(dependencies), 'download', len(dependencies))
+	def fetchOne(id, op, version):
+		try:
+			return pynaries.fetchDependency(id, op, version, repository)
+		finally:
+			progress.finishTask()
+
+	fetched = Future()
+	def collect(future):
+		if len(dependencies) > 0:
+			progress.finishAll()
+		if future.error is not None:
+			fetched._finish(error=future.error)
+			return
+		try:
+			cleanup.collectIfDue(repository, future.value)
+		except:
+			fetched._finish(error=sys.exc_info())
+			return
+		fetched._finish(future.value)
+	gather([submit(_reporting, progress, fetchOne, id, op, version)
+		for id, op, version in dependencies]).addDoneCallback(collect)
+	return fetched
+
+def publish(dir, id, version, site, incremental=False, deltas=[], dependencies=[]):
+	return submit(pynaries.publish, dir, id, version, site, incremental, deltas, dependencies)
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Low level helpers for reading and writing bundle archives concurrently.
+
+Zip members are compressed independently of each other, so they can be
+compressed on worker threads and then written to the archive in order as
+raw, already compressed bytes.
+
+Tarballs are written as a series of independently compressed gzip members
+or bzip2 streams (the way pigz / pbzip2 do it), each compressed on a worker
+thread and concatenated in order. Both formats allow concatenation, so the
+result is still a valid .tar.gz / .tar.bz2, and MultiStreamReader reads any
+number of streams back (Python's own bz2 module stops after the first one).
+Since each stream can be decompressed on its own, members can also be read
+without decompressing everything before them, see TarIndex.
+"""
+
+import os, time, zlib, bz2, zipfile, tarfile, struct, hashlib, bisect, collections
+import pool
+
+ChunkSize = 1024 * 1024
+BlockSize = 4 * 1024 * 1024
+
+# files larger than this are compressed by the writing thread, as a stream,
+# rather than read into memory and compressed on a worker
+InMemoryLimit = 16 * 1024 * 1024
+
+def gzipBlock(data):
+	c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return c.compress(data) + c.flush()
+
+def bz2Block(data):
+	return bz2.compress(data, 9)
+
+def zlibBlock(data):
+	return zlib.compress(data, 6)
+
+BlockCompressors = {
+	'gz': gzipBlock,
+	'bz2': bz2Block,
+	'zlib': zlibBlock
+}
+
+def _gzipDecompressor():
+	return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+BlockDecompressors = {
+	'gz': _gzipDecompressor,
+	'bz2': bz2.BZ2Decompressor,
+	'zlib': zlib.decompressobj
+}
+
+# A write-only file object that compresses everything written to it in
+# BlockSize blocks on a pool of worker threads, writing the compressed
+# blocks to fileobj in order. At most jobs * 2 blocks are in flight at once.
+# the (compressed, uncompressed) size of each block written is kept in sizes
+class BlockCompressor:
+	def __init__(self, fileobj, compression, jobs=None, blockSize=None):
+		if jobs is None:
+			jobs = pool.DefaultJobs
+		if blockSize is None:
+			blockSize = BlockSize
+		from multiprocessing.pool import ThreadPool
+		self.fileobj = fileobj
+		self.compress = BlockCompressors[compression]
+		self.blockSize = blockSize
+		self.maxPending = jobs * 2
+		self.pool = ThreadPool(jobs)
+		self.pending = collections.deque()
+		self.buffer = []
+		self.buffered = 0
+		self.blocks = 0
+		self.sizes = []
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffered += len(data)
+		if self.buffered >= self.blockSize:
+			data = ''.join(self.buffer)
+			offset = 0
+			while len(data) - offset >= self.blockSize:
+				self._submit(data[offset:offset + self.blockSize])
+				offset += self.blockSize
+			self.buffer = [data[offset:]]
+			self.buffered = len(data) - offset
+
+	def _submit(self, block):
+		self.pending.append((self.pool.apply_async(self.compress, (block,)), len(block)))
+		self.blocks += 1
+		while len(self.pending) > self.maxPending:
+			self._writeNext()
+
+	def _writeNext(self):
+		result, size = self.pending.popleft()
+		data = result.get()
+		self.fileobj.write(data)
+		self.sizes.append((len(data), size))
+
+	def close(self):
+		try:
+			if self.buffered > 0 or self.blocks == 0:
+				self._submit(''.join(self.buffer))
+			self.buffer = []
+			while len(self.pending) > 0:
+				self._writeNext()
+		finally:
+			self.pool.close()
+			self.pool.join()
+
+# A read-only file object that decompresses any number of concatenated
+# gzip members / bzip2 streams from fileobj. the streams seen so far are
+# recorded as (compressed offset, uncompressed offset) pairs in streams,
+# relative to where reading started; decompression can be restarted at any
+# of them (see TarIndex)
+class MultiStreamReader:
+	def __init__(self, fileobj, compression):
+		self.fileobj = fileobj
+		self.newDecompressor = BlockDecompressors[compression]
+		self.decompressor = self.newDecompressor()
+		self.buffer = ''
+		self.offset = 0
+		self.eof = False
+		self.streams = [(0, 0)]
+		self.consumed = 0
+		self.produced = 0
+
+	def _feed(self, data):
+		chunks = []
+		size = len(data)
+		while data:
+			try:
+				chunks.append(self.decompressor.decompress(data))
+			except EOFError:
+				# bz2 refuses data past the end of a stream
+				self._newStream(size - len(data), chunks)
+				continue
+			data = self.decompressor.unused_data
+			if data:
+				self._newStream(size - len(data), chunks)
+		output = ''.join(chunks)
+		self.consumed += size
+		self.produced += len(output)
+		return output
+
+	def _newStream(self, consumed, chunks):
+		self.decompressor = self.newDecompressor()
+		self.streams.append((self.consumed + consumed, self.produced + sum([len(c) for c in chunks])))
+
+	def _fill(self):
+		while self.offset >= len(self.buffer) and not self.eof:
+			data = self.fileobj.read(ChunkSize)
+			if data == '':
+				self.eof = True
+			else:
+				self.buffer = self._feed(data)
+				self.offset = 0
+
+	def read(self, size=-1):
+		chunks = []
+		while size != 0:
+			self._fill()
+			if self.offset >= len(self.buffer):
+				break
+			if size < 0:
+				chunk = self.buffer[self.offset:]
+			else:
+				chunk = self.buffer[self.offset:self.offset + size]
+				size -= len(chunk)
+			self.offset += len(chunk)
+			chunks.append(chunk)
+		return ''.join(chunks)
+
+	def close(self):
+		pass
+
+# A read-only file object for the next size bytes of fileobj. closing it
+# closes the underlying file, raw
+class BoundedReader:
+	def __init__(self, fileobj, size, raw):
+		self.fileobj = fileobj
+		self.remaining = size
+		self.raw = raw
+
+	def read(self, size=-1):
+		if size < 0 or size > self.remaining:
+			size = self.remaining
+		data = self.fileobj.read(size)
+		self.remaining -= len(data)
+		return data
+
+	def close(self):
+		self.raw.close()
+
+# An index of the members of a tarball, for reading them without
+# decompressing everything before them: each member's data offset in the
+# tar stream, and the (compressed, uncompressed) offsets of the compressed
+# streams (see MultiStreamReader). a member is read by decompressing from
+# the last stream that starts before it, so tarballs written in blocks by
+# BlockCompressor need at most a block decompressed first, and older single
+# stream tarballs still work, only from the start.
+# members are [name, kind, size, mode, data offset, link name] lists, with
+# kind one of the Member* constants
+MemberFile = 'file'
+MemberDir = 'dir'
+MemberSymlink = 'symlink'
+MemberHardlink = 'hardlink'
+
+# where the archive member name is extracted to under dest. names that would
+# land outside of dest (absolute ones, or ones climbing out with "..") are
+# refused, since archives come from remote sites
+def memberPath(dest, name):
+	root = os.path.normpath(dest)
+	path = os.path.normpath(os.path.join(root, name))
+	if os.path.isabs(name) or not (path == root or path.startswith(os.path.join(root, ''))):
+		raise IOError("Refusing to extract %s outside of %s" % (name, dest))
+	return path
+
+class TarIndex:
+	def __init__(self, streams, members):
+		self.streams = streams
+		self.members = members
+
+	# build the index by reading through the whole tarball once
+	@staticmethod
+	def build(archive, compression):
+		raw = open(archive, 'rb')
+		try:
+			reader = MultiStreamReader(raw, compression)
+			tar = tarfile.open(fileobj=reader, mode="r|")
+			members = []
+			for info in tar:
+				if info.isdir(): kind = MemberDir
+				elif info.issym(): kind = MemberSymlink
+				elif info.islnk(): kind = MemberHardlink
+				elif info.isfile(): kind = MemberFile
+				else: continue
+				members.append([info.name.rstrip('/'), kind, info.size, info.mode, info.offset_data, info.linkname])
+			tar.close()
+			while reader.read(ChunkSize) != '':
+				pass
+			return TarIndex(reader.streams, members)
+		finally:
+			raw.close()
+
+	def toJSON(self):
+		return {'streams': self.streams, 'members': self.members}
+
+	@staticmethod
+	def fromJSON(json):
+		members = []
+		for name, kind, size, mode, offset, linkname in json['members']:
+			members.append([name.encode('utf-8'), str(kind), size, mode, offset, linkname.encode('utf-8')])
+		return TarIndex([tuple(s) for s in json['streams']], members)
+
+	# a file object for the data of a member
+	def open(self, archive, compression, member):
+		offset, size = member[4], member[2]
+		i = bisect.bisect_right([s[1] for s in self.streams], offset) - 1
+		compressedOffset, uncompressedOffset = self.streams[i]
+		raw = open(archive, 'rb')
+		try:
+			raw.seek(compressedOffset)
+			reader = MultiStreamReader(raw, compression)
+			skip = offset - uncompressedOffset
+			while skip > 0:
+				skipped = len(reader.read(min(ChunkSize, skip)))
+				if skipped == 0:
+					raise tarfile.ReadError("Truncated tarball " + archive)
+				skip -= skipped
+		except:
+			raw.close()
+			raise
+		return BoundedReader(reader, size, raw)
+
+# the zip member for a file, directory or symlink, without its contents
+def zipInfo(path, arcname):
+	if os.path.islink(path):
+		info = zipfile.ZipInfo(arcname)
+		info.create_system = 3
+		info.external_attr = 2716663808L
+		info.compress_type = zipfile.ZIP_DEFLATED
+	elif os.path.isdir(path):
+		info = zipfile.ZipInfo(arcname + '/')
+		info.external_attr = 0755 << 16L
+	else:
+		st = os.stat(path)
+		info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+		info.external_attr = (st.st_mode & 0xFFFF) << 16L
+		info.compress_type = zipfile.ZIP_DEFLATED
+		info.file_size = st.st_size
+	return info
+
+# Returns (info, compressed bytes, sha1) for a zip member, ready for
+# writeRawMember. Files over InMemoryLimit are left for the writer and
+# return None as bytes. The sha1 is only computed for regular files
+def compressZipMember(path, arcname):
+	info = zipInfo(path, arcname)
+	sha1 = None
+	if os.path.islink(path):
+		data = os.readlink(path)
+	elif os.path.isdir(path):
+		data = ''
+	elif info.file_size > InMemoryLimit:
+		return (info, None, None)
+	else:
+		f = open(path, 'rb')
+		try:
+			data = f.read()
+		finally:
+			f.close()
+		sha1 = hashlib.sha1(data).hexdigest()
+
+	info.file_size = len(data)
+	info.CRC = zlib.crc32(data) & 0xffffffff
+	if info.compress_type == zipfile.ZIP_DEFLATED:
+		c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+		data = c.compress(data) + c.flush()
+	info.compress_size = len(data)
+	return (info, data, sha1)
+
+def _writeRawHeader(zip, info):
+	info.header_offset = zip.fp.tell()
+	zip._writecheck(info)
+	zip._didModify = True
+	zip64 = info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT
+	zip.fp.write(info.FileHeader(zip64))
+
+def _addRawInfo(zip, info):
+	zip.filelist.append(info)
+	zip.NameToInfo[info.filename] = info
+
+# append a member whose data is already compressed (and whose CRC, sizes
+# and compression type are already set on info) to a zip opened for writing
+def writeRawMember(zip, info, data):
+	_writeRawHeader(zip, info)
+	zip.fp.write(data)
+	_addRawInfo(zip, info)
+
+# the offset of a member's compressed bytes in the zip file fp. they follow
+# the local header, whose name and extra field lengths may differ from the
+# central directory's
+def rawMemberOffset(fp, info):
+	fp.seek(info.header_offset)
+	header = fp.read(zipfile.sizeFileHeader)
+	if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+		raise zipfile.BadZipfile("Bad local header for " + info.filename)
+	fields = struct.unpack(zipfile.structFileHeader, header)
+	return info.header_offset + zipfile.sizeFileHeader + \
+		fields[zipfile._FH_FILENAME_LENGTH] + fields[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+# append a member to zip by copying the compressed bytes of sourceInfo from
+# source, another open zip, without decompressing them. info describes the
+# new member (name, date, permissions); its CRC, sizes and compression are
+# taken from sourceInfo
+def copyRawMember(zip, info, source, sourceInfo):
+	info.CRC = sourceInfo.CRC
+	info.file_size = sourceInfo.file_size
+	info.compress_size = sourceInfo.compress_size
+	info.compress_type = sourceInfo.compress_type
+
+	source.fp.seek(rawMemberOffset(source.fp, sourceInfo))
+	_writeRawHeader(zip, info)
+	remaining = sourceInfo.compress_size
+	while remaining > 0:
+		buf = source.fp.read(min(ChunkSize, remaining))
+		if buf == '':
+			raise zipfile.BadZipfile("Truncated member " + sourceInfo.filename)
+		zip.fp.write(buf)
+		remaining -= len(buf)
+	_addRawInfo(zip, info)
@@ -3,8 +3,9 @@
 # see LICENSE in the root folder for details on the license.
 # Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
 
-import os, sys, distutils.dir_util as dir_util
-import console, re, logging
+import os, sys, threading, Queue
+import console, archives, catalog, cleanup, delta, filelock, pack, pool, store, transfer, re, logging
+import simplejson
 from version import Version
 
 GreaterThanEqual = ">="
@@ -13,49 +14,181 @@ LessThan = "<"
 LessThanEqual = "<="
 Equal = "="
 InRange = ".."
-Progress = console.ConsoleProgress()
+sha1Cache = {}
+memberCache = {}
+MaxMemberLinks = 32
+ExtractMode = None
 
-import shutil, platform, tarfile, time, hashlib
-import httplib, site, zipfile
+# the mode Bundle.extract uses when none is given, see Bundle.extract
+def SetExtractMode(mode):
+	global ExtractMode
+	ExtractMode = mode
+
+# Progress reports to the sink set for the current thread with
+# SetThreadProgress (i.e. by the workers of a parallel fetch), and otherwise
+# to its default, the console
+class ThreadProgress:
+	def __init__(self, default):
+		self.default = default
+		self.local = threading.local()
+
+	def __getattr__(self, name):
+		sink = getattr(self.local, 'sink', None)
+		if sink is None:
+			sink = self.default
+		return getattr(sink, name)
+
+Progress = ThreadProgress(console.ConsoleProgress())
+
+# report the current thread's progress to sink, or to the default with None
+def SetThreadProgress(sink):
+	Progress.local.sink = sink
+
+import shutil, tarfile, tempfile, time, hashlib, bisect, zipfile, posixpath
 
 class LocalRepository:
-	def __init__(self):
-		self.path = os.path.join(os.path.expanduser("~"), '.pynaries')
+	# directories in the repository that hold something other than bundles
+	ReservedDirs = ['blobs', 'indexes', 'quarantine', 'tmp']
+
+	def __init__(self, path=None):
+		if path is None:
+			path = os.path.join(os.path.expanduser("~"), '.pynaries')
+		self.path = path
 		if not os.path.exists(self.path):
 			try:
 				os.mkdir(self.path)
 			except: pass
 	
-		self._loadBundles()
+		self.catalog = None
+		self.catalogLock = threading.RLock()
+		self.store = store.BlobStore(os.path.join(self.path, 'blobs'))
+		self.accessLog = cleanup.AccessLog(os.path.join(self.path, 'access.log'))
 
-	def _loadBundles(self):
-		self.bundles = {}
+	# the catalog is loaded on first use, and rebuilt if it's missing
+	def getCatalog(self):
+		self.catalogLock.acquire()
+		try:
+			if self.catalog is None:
+				self.catalog = catalog.Catalog(os.path.join(self.path, 'catalog.json'))
+				if not self.catalog.load():
+					self.rebuildCatalog()
+		finally:
+			self.catalogLock.release()
+		return self.catalog
+
+	# scan the repository directories and rewrite the catalog from scratch
+	def rebuildCatalog(self):
+		entries = {}
 		if os.path.exists(self.path):
-			for dir in os.listdir(self.path):
-				if os.path.isdir(dir):
-					self._loadVersions(dir, os.path.join(self.path, dir))
+			for id in os.listdir(self.path):
+				dir = os.path.join(self.path, id)
+				if os.path.isdir(dir) and not id in LocalRepository.ReservedDirs:
+					versions = self._scanVersions(id, dir)
+					if len(versions) > 0: entries[id] = versions
+		try:
+			self.getCatalog().replace(entries)
+		except (IOError, OSError), e:
+			logging.warn("Couldn't write catalog for %s: %s" % (self.path, str(e)))
 	
-	def _loadVersions(self, id, dir):
-		self.bundles[id] = {}
+	def _scanVersions(self, id, dir):
+		versions = {}
 		for vdir in os.listdir(dir):
-			if os.path.isdir(vdir):
-					bundle = Bundle.localBundle(id, vdir, dir)
-					if bundle: self.bundles[id][vdir] = bundle
+			vpath = os.path.join(dir, vdir)
+			if not os.path.isdir(vpath): continue
+			try:
+				bundle = Bundle.localBundle(id, vdir, vpath, self)
+			except ValueError:
+				continue # not a version directory
+			if bundle: versions[vdir] = self._catalogEntry(bundle.path, bundle.type, None)
+		return versions
 
+	def _catalogEntry(self, archivePath, type, sha1):
+		stat = os.stat(archivePath)
+		return {
+			'archive': os.path.basename(archivePath),
+			'type': type,
+			'sha1': sha1,
+			'size': stat.st_size,
+			'mtime': stat.st_mtime
+		}
+
+	# record a bundle whose archive has just been placed in the repository.
+	# when its sha1 is known the archive is also shared through the blob store
+	def add(self, bundle):
+		if bundle.sha1:
+			self.store.adopt(bundle.localArchive(), bundle.sha1)
+		entry = self._catalogEntry(bundle.localArchive(), bundle.type, bundle.sha1)
+		if bundle.dependencies:
+			entry['dependencies'] = bundle.dependencies
+		self.getCatalog().add(bundle.id, str(bundle.version), entry)
+		self.recordUse(bundle)
+
+	# note a use of the bundle in the access log, for eviction (see cleanup.py)
+	def recordUse(self, bundle):
+		self.accessLog.record(bundle.id, bundle.version)
+
+	# the lock on a version, <id>/<version>.lock: it's held shared while the
+	# version is fetched or extracted, and cleanup.collect only evicts a
+	# version once it can take its lock exclusively
+	def versionLock(self, id, version):
+		dir = os.path.join(self.path, id)
+		if not os.path.exists(dir):
+			try: os.makedirs(dir)
+			except OSError: pass
+		return filelock.FileLock(os.path.join(dir, str(version) + '.lock'))
+
+	# a new temporary directory inside the repository, so that it's on the
+	# same filesystem and is cleaned up by cleanup.collect if it's left behind
+	def tempDir(self):
+		dir = os.path.join(self.path, 'tmp')
+		if not os.path.exists(dir):
+			try: os.makedirs(dir)
+			except OSError: pass
+		return tempfile.mkdtemp(dir=dir)
+
+	def remove(self, id, version):
+		self.getCatalog().remove(id, version)
+
+	def bundle(self, id, version):
+		return self._bundle(id, version, self.getCatalog().get(id, version))
+
+	# the bundle for a catalog entry, or None when its archive has gone missing
+	def _bundle(self, id, version, entry):
+		if entry is None:
+			return None
+		archivePath = os.path.join(self.path, id, str(version), entry['archive'])
+		if not os.path.exists(archivePath):
+			self.remove(id, version)
+			return None
+		b = Bundle(id, version, entry['type'], self)
+		b.path = archivePath
+		b.sha1 = entry.get('sha1')
+		b.dependencies = entry.get('dependencies') or []
+		return b
+
+	# the bundle for id/version, only if its archive has the given sha1
+	def lockedBundle(self, id, version, sha1):
+		b = self.bundle(id, version)
+		if b is not None and b.archiveSHA1() == sha1:
+			self.recordUse(b)
+			return b
+		return None
+
+	# bundles are built from one snapshot of each id's versions, rather than
+	# looking every version up in the catalog again
 	def bundles(self):
-		for id in self.bundles.keys():
-			for version in self.bundles[id].keys():
-				yield self.bundles[id][version]
+		catalog = self.getCatalog()
+		for id in catalog.ids():
+			for version, entry in catalog.versions(id).items():
+				b = self._bundle(id, version, entry)
+				if b: yield b
 
 	def resolve(self, resolver):
-		basepath = os.path.join(self.path, resolver.id)
 		resolutions = []
-		if os.path.exists(basepath):
-			for dir in os.listdir(basepath):
-				dirPath = os.path.join(basepath, dir)
-				if os.path.isdir(dirPath) and resolver.matchesVersion(dir):
-					bundle = Bundle.localBundle(resolver.id, dir, dirPath)
-					if bundle: resolutions.append(Resolution(bundle, None))
+		for version, entry in self.getCatalog().versions(resolver.id).items():
+			if resolver.matchesVersion(version):
+				bundle = self._bundle(resolver.id, version, entry)
+				if bundle: resolutions.append(Resolution(bundle, None))
 		
 		return resolutions
 
@@ -65,50 +198,73 @@ class Bundle:
 	TarBZ2 = ".tar.bz2"
 	Zip = ".zip"
 	TarGZ = ".tar.gz"
+	# see pack.py
+	Pack = ".pack"
+	Types = [TarBZ2, TarGZ, Zip, Pack]
+
+	# extract modes
+	Hardlink = "hardlink"
+	Symlink = "symlink"
+	Copy = "copy"
 	
 	# Zip is the default bundle type, because zip extract much
 	# more quickly than tar bz2 and have much richer cross-platform support
 	def __init__(self, id, version, type=Zip, repository=localRepository):
 		self.id = id
-		self.type = str(type) # lose the unicode
+		# lose the unicode, and intern so the type can be compared with `is`
+		# even when it was read from an index or the catalog
+		self.type = intern(str(type))
 		self.version = Version.fromObject(version)
 		self.repository = repository
+		self.sha1 = None
+		# deltas to publish along with the archive, by base version
+		self.deltas = {}
+		# the (id, op, version) dependencies of this bundle, see solver.py
+		self.dependencies = []
 
 	@staticmethod
-	def localBundle(id, version, dir):
+	def localBundle(id, version, dir, repository=None):
+		if repository is None: repository = localRepository
 		for file in os.listdir(dir):
 			fullPath = os.path.join(dir, file)
 			b = None
 			if fullPath.endswith(Bundle.TarGZ):
-				b = Bundle(id, version, Bundle.TarGZ)
+				b = Bundle(id, version, Bundle.TarGZ, repository)
 				b.path = fullPath
 			elif fullPath.endswith(Bundle.TarBZ2):
-				b = Bundle(id, version, Bundle.TarBZ2)
+				b = Bundle(id, version, Bundle.TarBZ2, repository)
 				b.path = fullPath
 			elif fullPath.endswith(Bundle.Zip):
-				b = Bundle(id, version, Bundle.Zip)
+				b = Bundle(id, version, Bundle.Zip, repository)
 				b.path = fullPath
-		return b
+			elif fullPath.endswith(Bundle.Pack):
+				b = Bundle(id, version, Bundle.Pack, repository)
+				b.path = fullPath
+			if b: return b
+		return None
 
 	@staticmethod
-	def createFromArchive(path, id, version):
+	def createFromArchive(path, id, version, repository=None):
+		if repository is None: repository = localRepository
 		filename = os.path.split(path)[-1]
-		pynariesDir = os.path.join(os.path.expanduser('~'), '.pynaries', id, version)
-		match = re.search('(\.(tar\.bz2|tar\.gz|zip))', filename)
+		pynariesDir = os.path.join(repository.path, id, str(version))
+		match = re.search('(\.(tar\.bz2|tar\.gz|zip|pack))', filename)
 		if match is None:
 			raise Exception("Error: Couldn't determine archive type of " + filename)
 
 		type = match.group(1)
-		if not (type == Bundle.TarBZ2 or type == Bundle.TarGZ or type == Bundle.Zip):
+		if not type in Bundle.Types:
 			raise Exception("Error: Unsupported archive type: " + type)
 	
 		if not os.path.exists(pynariesDir):
 			os.makedirs(pynariesDir)
-		shutil.copy(path,
+		sha1 = transfer.fileSHA1(path)
+		repository.store.insert(path, sha1,
 			os.path.join(pynariesDir,Bundle.getArchiveName(id,version,type)))
 
-		bundle = Bundle(id, version, type=type)
-		bundle.sha1 = bundle.archiveSHA1()
+		bundle = Bundle(id, version, type=type, repository=repository)
+		bundle.sha1 = sha1
+		repository.add(bundle)
 		return bundle
 	
 	@staticmethod
@@ -124,35 +280,104 @@ class Bundle:
 	def localArchive(self):
 		return os.path.join(self.localPath(), self.archiveName())
 
+	# zip bundles keep a manifest of {name: [size, mtime, sha1]} for the
+	# files they were bundled from, so the next bundle can be incremental
+	def localManifest(self):
+		return self.localArchive() + '.manifest'
+
+	def loadManifest(self):
+		path = self.localManifest()
+		if not os.path.exists(path):
+			return None
+		f = open(path, 'r')
+		try:
+			try:
+				return simplejson.load(f)
+			except ValueError:
+				return None
+		finally:
+			f.close()
+
+	def _saveManifest(self, manifest):
+		f = open(self.localManifest(), 'w')
+		try:
+			simplejson.dump(manifest, f)
+		finally:
+			f.close()
+
+	# the newest zip bundle of this id, up to and including this version,
+	# that has a manifest to compare against
+	def _incrementalBase(self):
+		versions = [Version.fromObject(v) for v in self.repository.getCatalog().versions(self.id).keys()]
+		versions.sort(reverse=True)
+		for version in versions:
+			if version > self.version: continue
+			base = self.repository.bundle(self.id, version)
+			if base and base.type is Bundle.Zip and os.path.exists(base.localManifest()):
+				return base
+		return None
+
+	# hashing is skipped when the archive is unchanged since it was last
+	# hashed, either in this process or when it was added to the catalog
 	def archiveSHA1(self):
-		if not os.path.exists(self.localArchive()):
-			raise Exception(self.localArchive() + " doesn't exist")
+		path = self.localArchive()
+		if not os.path.exists(path):
+			raise Exception(path + " doesn't exist")
 		
-		bufsize = 1024
-		f = open(self.localArchive(), "rb")
-		m = hashlib.sha1()
-		buf = f.read(1024)
-		t = f.tell()
-		stat = os.stat(self.localArchive())
-		size = stat[6]
-		while t < size:
-			m.update(buf)
-			buf = f.read(1024)
-			t = f.tell()
-
-		f.close()
-		return m.hexdigest()
+		stat = os.stat(path)
+		key = (path, stat.st_size, stat.st_mtime)
+		sha1 = sha1Cache.get(key)
+		if sha1 is None:
+			entry = self.repository.getCatalog().get(self.id, self.version)
+			if entry is not None and entry.get('sha1') and \
+					(entry['size'], entry['mtime']) == (stat.st_size, stat.st_mtime):
+				sha1 = entry['sha1']
+			else:
+				sha1 = transfer.fileSHA1(path)
+			sha1Cache[key] = sha1
+		return sha1
 	
-	def bundle(self, dir):
+	# with incremental, a zip bundle copies the compressed bytes of files
+	# that are unchanged since the previous bundle of this id (as recorded
+	# in its manifest) instead of compressing them again. a file counts as
+	# unchanged when its size and mtime match, or failing that its sha1
+	def bundle(self, dir, incremental=False):
 		try: os.makedirs(self.localPath())
 		except: pass
-		if self.type is Bundle.TarBZ2:
-			self._bundleTarball(dir, "bz2")
-		elif self.type is Bundle.TarGZ:
-			self._bundleTarball(dir, "gz")
-		else:
-			self._bundleZip(dir)
+		base = None
+		if incremental and self.type is Bundle.Zip:
+			base = self._incrementalBase()
+
+		baseArchive = None
+		baseManifest = None
+		if base:
+			baseManifest = base.loadManifest()
+			baseArchive = base.localArchive()
+			if baseArchive == self.localArchive():
+				# re-bundling the same version, keep the old archive aside
+				baseArchive = self.localArchive() + '.previous'
+				os.rename(self.localArchive(), baseArchive)
+
+		# the old archive may be linked into the blob store, so it has
+		# to be unlinked rather than overwritten
+		if os.path.lexists(self.localArchive()):
+			os.remove(self.localArchive())
+		if os.path.exists(self.localManifest()):
+			os.remove(self.localManifest())
+		try:
+			if self.type is Bundle.TarBZ2:
+				self._bundleTarball(dir, "bz2")
+			elif self.type is Bundle.TarGZ:
+				self._bundleTarball(dir, "gz")
+			elif self.type is Bundle.Pack:
+				self._bundlePack(dir)
+			else:
+				self._bundleZip(dir, baseArchive, baseManifest)
+		finally:
+			if baseArchive and baseArchive.endswith('.previous'):
+				os.remove(baseArchive)
 		self.sha1 = self.archiveSHA1()
+		self.repository.add(self)
 		return self.localArchive()
 	
 	def _startBundleProgress(self, dir):
@@ -165,101 +390,436 @@ class Bundle:
 		print "Bundling %s (%d files)" % (self.archiveName(), size)
 		Progress.start(self.archiveName(), "compress", size)
 	
-	def _walkBundleFiles(self, dir, fn):
-		cwd = os.getcwd()
-		os.chdir(dir)
-		for root, dirs, files in os.walk("."):
-			for file in files:
-				filepath = os.path.join(root, file)
-				fn(filepath, file)
-				Progress.update(1)
-
-			# Add directories as well, as they may be symlinks
-			for dir in dirs:
-				filepath = os.path.join(root, dir)
-				fn(filepath, dir)
-				Progress.update(1)
-		os.chdir(cwd)
+	# (path, archive name) for everything under dir, without changing the
+	# working directory. directories are included as well, as they may be symlinks
+	def _bundleEntries(self, dir):
+		for root, dirs, files in os.walk(dir):
+			for name in files + dirs:
+				path = os.path.join(root, name)
+				yield (path, os.path.relpath(path, dir))
 	
+	# the tar stream is compressed in blocks on the worker pool, and written
+	# out as concatenated gzip members / bzip2 streams
 	def _bundleTarball(self, dir, mode):
-		bundleArchive = self.localArchive()
-		bundleFile = tarfile.open(bundleArchive, "w:"+mode)
-		self._startBundleProgress(dir)
-
-		def tarFile(filePath, file):
-			bundleFile.add(filePath)
-		
-		self._walkBundleFiles(dir, tarFile)
-		
+		bundleArchive = open(self.localArchive(), 'wb')
+		try:
+			compressor = archives.BlockCompressor(bundleArchive, mode)
+			try:
+				bundleFile = tarfile.open(fileobj=compressor, mode="w|")
+				self._startBundleProgress(dir)
+				for path, arcname in self._bundleEntries(dir):
+					bundleFile.add(path, arcname, recursive=False)
+					Progress.update(1)
+				bundleFile.close()
+			finally:
+				compressor.close()
+		finally:
+			bundleArchive.close()
 		Progress.finish()
-		bundleFile.close()
 	
-	def _bundleZip(self, dir):
+	# blocks are compressed on the worker pool, see pack.PackWriter
+	def _bundlePack(self, dir):
+		bundleArchive = open(self.localArchive(), 'wb')
+		try:
+			writer = pack.PackWriter(bundleArchive)
+			self._startBundleProgress(dir)
+			for path, arcname in self._bundleEntries(dir):
+				writer.add(path, arcname)
+				Progress.update(1)
+			writer.close()
+		finally:
+			bundleArchive.close()
+		Progress.finish()
+
+	# members are compressed on the worker pool and written in order.
+	# members that are unchanged from baseManifest are copied from baseArchive
+	def _bundleZip(self, dir, baseArchive=None, baseManifest=None):
 		bundleArchive = self.localArchive()
-		bundleFile = zipfile.ZipFile(bundleArchive, 'w')
+		bundleFile = zipfile.ZipFile(bundleArchive, 'w', allowZip64=True)
 		self._startBundleProgress(dir)
 
-		def zipFile(filePath, file):
-			arcname = filePath.replace(dir + os.sep, "")
-			if os.path.islink(filePath):
-				dest = os.readlink(filePath)
-				attr = zipfile.ZipInfo()
-				attr.filename = arcname
-				attr.create_system = 3
-				attr.external_attr = 2716663808L
-				attr.compress_type = zipfile.ZIP_DEFLATED
-				bundleFile.writestr(attr, dest)
-			elif os.path.isdir(filePath):
-				attr = zipfile.ZipInfo(arcname + '/')
-				attr.external_attr = 0755 << 16L
-				bundleFile.writestr(attr, '')
-			else:
-				bundleFile.write(filePath, arcname, zipfile.ZIP_DEFLATED)
-		
-		self._walkBundleFiles(dir, zipFile)
-		
+		baseZip = None
+		if baseArchive and baseManifest:
+			logging.info(":: => Bundling incrementally against " + os.path.basename(baseArchive))
+			baseZip = zipfile.ZipFile(baseArchive, 'r')
+
+		# returns the sha1 of an unchanged file, or None
+		def unchanged(path, arcname):
+			if baseZip is None or not baseManifest.has_key(arcname) or \
+					os.path.islink(path) or not os.path.isfile(path):
+				return None
+			try:
+				baseZip.getinfo(arcname)
+			except KeyError:
+				return None
+			size, mtime, sha1 = baseManifest[arcname]
+			stat = os.stat(path)
+			if stat.st_size != size:
+				return None
+			if stat.st_mtime == mtime or transfer.fileSHA1(path) == sha1:
+				return sha1
+			return None
+
+		def compress(entry):
+			path, arcname = entry
+			sha1 = unchanged(path, arcname)
+			if sha1:
+				return (path, arcname, archives.zipInfo(path, arcname), None, sha1, True)
+			info, data, sha1 = archives.compressZipMember(path, arcname)
+			if data is None:
+				sha1 = transfer.fileSHA1(path)
+			return (path, arcname, info, data, sha1, False)
+
+		manifest = {}
+		reused = 0
+		try:
+			for path, arcname, info, data, sha1, reuse in pool.parallelEach(compress, self._bundleEntries(dir), ordered=True):
+				if reuse:
+					archives.copyRawMember(bundleFile, info, baseZip, baseZip.getinfo(arcname))
+					reused += 1
+				elif data is None:
+					bundleFile.write(path, arcname, zipfile.ZIP_DEFLATED)
+				else:
+					archives.writeRawMember(bundleFile, info, data)
+				if sha1:
+					stat = os.stat(path)
+					manifest[arcname] = [stat.st_size, stat.st_mtime, sha1]
+				Progress.update(1)
+		finally:
+			bundleFile.close()
+			if baseZip: baseZip.close()
 		Progress.finish()
-		bundleFile.close()
+		if baseZip:
+			logging.info(":: => Reused %d of %d files" % (reused, len(manifest)))
+		self._saveManifest(manifest)
 	
-	def extract(self, dest):
+	# the archive is unpacked straight into dest, unless a mode is given (or
+	# set with SetExtractMode). then it's only unpacked once, into a cached
+	# tree (see tree()), and dest is populated from that:
+	#  Bundle.Hardlink - files in dest are hardlinks into the tree
+	#  Bundle.Symlink - dest is a symlink to the tree
+	#  Bundle.Copy - files in dest are copies (reflinks, where supported)
+	# hardlinked and symlinked files are shared with the cache, and mustn't be
+	# modified in place. with dedup, extracted files are hardlinked to identical
+	# files in the blob store (see store.BlobStore.dedupTree), with the same caveat
+	def extract(self, dest, dedup=False, mode=None):
+		if mode is None:
+			mode = ExtractMode
+		lock = self.repository.versionLock(self.id, self.version)
+		lock.acquire(shared=True)
+		try:
+			self.repository.recordUse(self)
+			self._extract(dest, dedup, mode)
+		finally:
+			lock.release()
+
+	def _extract(self, dest, dedup, mode):
+		if mode is None:
+			self._extractArchive(dest)
+			if dedup:
+				self.repository.store.dedupTree(dest)
+			return
+
+		tree = self._tree(dedup)
+		if mode is Bundle.Symlink:
+			if os.path.islink(dest):
+				os.remove(dest)
+			elif os.path.isdir(dest):
+				# only an empty directory can be replaced
+				os.rmdir(dest)
+			os.symlink(tree, dest)
+		elif mode is Bundle.Hardlink:
+			store.linkTree(tree, dest)
+		elif mode is Bundle.Copy:
+			store.cloneTree(tree, dest)
+		else:
+			raise Exception("Unknown extract mode: " + str(mode))
+
+	def _extractArchive(self, dest):
 		if self.type is Bundle.TarBZ2:
 			self._extractTarball(dest, "bz2")
 		elif self.type is Bundle.TarGZ:
 			self._extractTarball(dest, "gz")
+		elif self.type is Bundle.Pack:
+			self._extractPack(dest)
 		else:
 			self._extractZip(dest)
 
-	def _extractArchive(self, dest, archive, names, extract_cb):
-		Progress.start(self.archiveName(), 'extract', len(names))
-		for name in names:
-			extract_cb(name, dest)
-			Progress.update(1)
-		archive.close()
-		Progress.finish()
-	
+	# the archive unpacked under <id>/<version>/tree/<archive sha1>, which is
+	# extracted on first use into a temporary directory and then renamed into
+	# place, so it's either complete or missing, even with several processes
+	# extracting at once. trees of archives that have been replaced may still
+	# be in use, so they're left for cleanup.collect to remove
+	def tree(self, dedup=False):
+		lock = self.repository.versionLock(self.id, self.version)
+		lock.acquire(shared=True)
+		try:
+			self.repository.recordUse(self)
+			return self._tree(dedup)
+		finally:
+			lock.release()
+
+	def _tree(self, dedup):
+		sha1 = self.archiveSHA1()
+		treesDir = os.path.join(self.localPath(), 'tree')
+		tree = os.path.join(treesDir, sha1)
+		if os.path.isdir(tree):
+			return tree
+
+		if not os.path.exists(treesDir):
+			try: os.makedirs(treesDir)
+			except OSError: pass
+		tmpTree = tempfile.mkdtemp(prefix='.extract', dir=treesDir)
+		try:
+			self._extractArchive(tmpTree)
+			if dedup:
+				self.repository.store.dedupTree(tmpTree)
+			try:
+				os.rename(tmpTree, tree)
+			except OSError:
+				# someone else finished extracting first
+				if not os.path.isdir(tree):
+					raise
+		finally:
+			if os.path.exists(tmpTree):
+				shutil.rmtree(tmpTree, ignore_errors=True)
+		return tree
+
+	# tarballs keep an index of their members next to them, see archives.TarIndex
+	def localMemberIndex(self):
+		return self.localArchive() + '.members'
+
+	def _tarCompression(self):
+		if self.type is Bundle.TarBZ2:
+			return "bz2"
+		return "gz"
+
+	# the tarball's member index, built on first use (which reads through
+	# the whole tarball once) and kept for as long as the archive is unchanged
+	def _tarIndex(self, sha1):
+		path = self.localMemberIndex()
+		if os.path.exists(path):
+			f = open(path, 'r')
+			try:
+				try:
+					json = simplejson.load(f)
+					if json.get('sha1') == sha1:
+						return archives.TarIndex.fromJSON(json)
+				except ValueError:
+					pass
+			finally:
+				f.close()
+
+		index = archives.TarIndex.build(self.localArchive(), self._tarCompression())
+		json = index.toJSON()
+		json['sha1'] = sha1
+		fd, tmpPath = tempfile.mkstemp(prefix='.members', dir=self.localPath())
+		f = os.fdopen(fd, 'w')
+		try:
+			simplejson.dump(json, f)
+		finally:
+			f.close()
+		os.rename(tmpPath, path)
+		return index
+
+	# ([name, kind, size, mode, ...] lists in archive order, {name: member},
+	# index), with kinds from archives.Member*. zip members are read from
+	# the central directory and end with their ZipInfo, tar members are as in
+	# archives.TarIndex, and pack members as in pack.Pack
+	def _members(self):
+		sha1 = self.archiveSHA1()
+		key = (self.localArchive(), sha1)
+		if not memberCache.has_key(key):
+			if self.type is Bundle.Zip:
+				zip = zipfile.ZipFile(self.localArchive(), 'r')
+				try:
+					members = []
+					for info in zip.infolist():
+						if info.filename.endswith('/'): kind = archives.MemberDir
+						elif info.external_attr == 2716663808L: kind = archives.MemberSymlink
+						else: kind = archives.MemberFile
+						members.append([info.filename, kind, info.file_size, info.external_attr >> 16L, info])
+				finally:
+					zip.close()
+				index = None
+			elif self.type is Bundle.Pack:
+				index = pack.Pack(self.localArchive())
+				members = index.members
+			else:
+				index = self._tarIndex(sha1)
+				members = index.members
+			byName = {}
+			for member in members:
+				member[0] = posixpath.normpath(member[0].rstrip('/'))
+				byName[member[0]] = member
+			memberCache[key] = ([m for m in members if m[0] != '.'], byName, index)
+		return memberCache[key]
+
+	# the paths of the archive's members, in archive order, without
+	# extracting it. directories end with '/'
+	def listing(self):
+		members = self._members()[0]
+		return [m[0] + (m[1] == archives.MemberDir and '/' or '') for m in members]
+
+	# a read-only file object for the contents of the member at path, read
+	# straight from the archive. links within the archive are followed
+	def openMember(self, path):
+		members, byName, index = self._members()
+		name = posixpath.normpath(path.strip('/'))
+		for i in range(MaxMemberLinks):
+			member = byName.get(name)
+			if member is None:
+				raise KeyError("%s has no member %s" % (self.archiveName(), path))
+			kind = member[1]
+			if kind == archives.MemberDir:
+				raise IOError("%s is a directory in %s" % (path, self.archiveName()))
+			elif kind == archives.MemberSymlink:
+				if self.type is Bundle.Zip:
+					zip = zipfile.ZipFile(self.localArchive(), 'r')
+					try:
+						target = zip.read(member[4])
+					finally:
+						zip.close()
+				else:
+					target = member[5]
+				name = posixpath.normpath(posixpath.join(posixpath.dirname(name), target))
+			elif kind == archives.MemberHardlink:
+				name = posixpath.normpath(member[5])
+			elif self.type is Bundle.Zip:
+				# the member gets a file handle of its own
+				zip = zipfile.ZipFile(self.localArchive(), 'r')
+				try:
+					return zip.open(member[4])
+				finally:
+					zip.close()
+			elif self.type is Bundle.Pack:
+				return index.open(member)
+			else:
+				return index.open(self.localArchive(), self._tarCompression(), member)
+		raise IOError("Too many levels of links at %s in %s" % (path, self.archiveName()))
+
+	# tarballs are extracted in a single streaming pass, with progress
+	# measured in compressed bytes read. they may hold several streams,
+	# see archives.MultiStreamReader
 	def _extractTarball(self, dest, mode):
-		tar = tarfile.open(self.localArchive(), "r:"+mode)
-		def extract_cb(name, dest):
-			tar.extract(name, dest)
-		self._extractArchive(dest, tar, tar.getnames(), extract_cb)
-		
+		archive = self.localArchive()
+		size = os.path.getsize(archive)
+		raw = open(archive, 'rb')
+		try:
+			tar = tarfile.open(fileobj=archives.MultiStreamReader(raw, mode), mode="r|")
+			def members():
+				Progress.start(self.archiveName(), 'extract', max(size, 1))
+				for member in tar:
+					yield member
+					Progress.set(min(raw.tell(), size))
+				Progress.finish()
+			tar.extractall(dest, members())
+			tar.close()
+		finally:
+			raw.close()
+	
+	def _extractPack(self, dest):
+		packFile = pack.Pack(self.localArchive())
+		Progress.start(self.archiveName(), 'extract', max(len(packFile.members), 1))
+		packFile.extract(dest, onMember=lambda member: Progress.update(1))
+		Progress.finish()
+
+	# zip members are streamed through fixed size buffers, and regular files
+	# are decompressed in parallel, each worker with its own handle on the zip
 	def _extractZip(self, dest):
-		zip = zipfile.ZipFile(self.localArchive(), 'r')
-		def extract_cb(name, dest):
-			dest = os.path.join(dest, name)
-			info = zip.getinfo(name)
+		archive = self.localArchive()
+		zip = zipfile.ZipFile(archive, 'r')
+		infos = zip.infolist()
+		zip.close()
+		if not os.path.exists(dest):
+			os.makedirs(dest)
+		Progress.start(self.archiveName(), 'extract', max(len(infos), 1))
+
+		files = []
+		links = []
+		dirs = []
+		# every name is checked before anything is written
+		for info in infos:
+			path = archives.memberPath(dest, info.filename)
 			if info.external_attr == 2716663808L:
-				target = zip.read(name)
-				os.symlink(target, dest)
-			elif name.endswith("/"):
-				os.makedirs(dest)
-				os.chmod(dest, info.external_attr >> 16L)
+				links.append(info)
+			elif info.filename.endswith("/"):
+				if not os.path.isdir(path):
+					os.makedirs(path)
+				dirs.append(info)
+				Progress.update(1)
 			else:
-				bytes = zip.read(name)
-				f = open(dest, 'w')
-				f.write(bytes)
-				os.chmod(dest, info.external_attr >> 16L)
-		self._extractArchive(dest, zip, zip.namelist(), extract_cb)
+				files.append(info)
+
+		handles = threading.local()
+		opened = []
+		def extractFile(info):
+			if not hasattr(handles, 'zip'):
+				handles.zip = zipfile.ZipFile(archive, 'r')
+				opened.append(handles.zip)
+			path = os.path.join(dest, info.filename)
+			dir = os.path.dirname(path)
+			if not os.path.isdir(dir):
+				try: os.makedirs(dir)
+				except OSError: pass
+			input = handles.zip.open(info)
+			try:
+				f = open(path, 'wb')
+				try:
+					shutil.copyfileobj(input, f, transfer.ChunkSize)
+				finally:
+					f.close()
+			finally:
+				input.close()
+			mode = info.external_attr >> 16L
+			if mode: os.chmod(path, mode)
+
+		try:
+			for result in pool.parallelEach(extractFile, files):
+				Progress.update(1)
+		finally:
+			for handle in opened: handle.close()
+
+		zip = zipfile.ZipFile(archive, 'r')
+		try:
+			for info in links:
+				os.symlink(zip.read(info), os.path.join(dest, info.filename))
+				Progress.update(1)
+		finally:
+			zip.close()
+
+		# directory modes go last, deepest first, so that a read-only
+		# directory doesn't keep anything from being written into it
+		dirs.sort(key=lambda info: info.filename.rstrip('/').count('/'), reverse=True)
+		for info in dirs:
+			mode = info.external_attr >> 16L
+			if mode: os.chmod(os.path.join(dest, info.filename), mode)
+
+		Progress.finish()
+
+	def deltaPath(self, baseVersion):
+		return os.path.join(self.localPath(), delta.deltaName(self.id, self.version, baseVersion))
+
+	# write a delta from the zip bundle of this id at baseVersion in the
+	# repository, to be published along with this bundle (see delta.py)
+	def createDelta(self, baseVersion):
+		if self.type is not Bundle.Zip:
+			raise Exception("Deltas are only supported for zip bundles")
+		base = self.repository.bundle(self.id, baseVersion)
+		if base is None or base.type is not Bundle.Zip:
+			raise Exception("No zip bundle of %s %s to create a delta from" % (self.id, str(baseVersion)))
+
+		baseVersion = str(Version.fromObject(baseVersion))
+		path = self.deltaPath(baseVersion)
+		copied = delta.create(base.localArchive(), self.localArchive(), path)
+		self.deltas[baseVersion] = {
+			'base': base.archiveSHA1(),
+			'sha1': transfer.fileSHA1(path),
+			'size': os.path.getsize(path)
+		}
+		logging.info(":: => Delta from %s is %d bytes, %d bytes are reused" %
+			(baseVersion, self.deltas[baseVersion]['size'], copied))
+		return path
 
 	def publish(self, site):
 		if not os.path.exists(self.localArchive()):
@@ -272,8 +832,115 @@ class Bundle:
 
 PullSites = [ ]
 
-def AddPullSite(site):
+# when several sites have the same version, the one with the highest priority
+# is used. resolution waits up to timeout seconds for the site to answer, and
+# then goes on without it (None waits for as long as it takes)
+def AddPullSite(site, priority=0, timeout=None):
+	site.priority = priority
+	site.timeout = timeout
 	PullSites.append(site)
+	PullSites.sort(key=sitePriority, reverse=True)
+
+def sitePriority(site):
+	return getattr(site, 'priority', 0)
+
+def siteTimeout(site):
+	return getattr(site, 'timeout', None)
+
+def _resolveSite(site, resolver):
+	try:
+		return site.resolve(resolver) or []
+	except Exception, e:
+		logging.error(": Error resolving %s on %s: %s" % (resolver.id, getattr(site, 'baseURL', site), str(e)))
+		return []
+
+# sites are queried on a shared pool of at most QueryWorkers threads, so
+# that sites which hang don't leave a thread behind on every resolve
+QueryWorkers = 16
+
+def SetQueryWorkers(workers):
+	global QueryWorkers
+	QueryWorkers = max(1, int(workers))
+
+_queries = Queue.Queue()
+_queryThreads = []
+_queryThreadsLock = threading.Lock()
+
+def _queryWorker():
+	while True:
+		fn, args = _queries.get()
+		try:
+			fn(*args)
+		except Exception, e:
+			logging.error(": Error querying a site: " + str(e))
+
+def _submitQuery(fn, *args):
+	_queryThreadsLock.acquire()
+	try:
+		if len(_queryThreads) < QueryWorkers:
+			thread = threading.Thread(target=_queryWorker)
+			thread.setDaemon(True)
+			thread.start()
+			_queryThreads.append(thread)
+	finally:
+		_queryThreadsLock.release()
+	_queries.put((fn, args))
+
+# with firstHit, whether the answers so far settle the resolve: the site with
+# the highest priority that has a resolution can only be beaten by a site of
+# higher priority, so none of those may still be pending
+def _settled(sites, pending, answers):
+	for site in sites:
+		if len(answers.get(id(site), [])) > 0:
+			return not [s for s in pending if sitePriority(s) > sitePriority(site)]
+	return False
+
+# resolve against every pull site concurrently, returning (site, resolutions)
+# for the sites that answered in time, highest priority first. with
+# firstHit, stop waiting as soon as a site has a resolution and no site of
+# higher priority is still pending
+def querySites(resolver, firstHit=False):
+	sites = PullSites[:]
+	if len(sites) == 1 and siteTimeout(sites[0]) is None:
+		return [(sites[0], _resolveSite(sites[0], resolver))]
+
+	results = Queue.Queue()
+	# set once we're done waiting: queries that haven't started by then skip
+	# their site, and the answers of those still running are dropped
+	finished = threading.Event()
+	def query(site):
+		if finished.isSet():
+			return
+		resolutions = _resolveSite(site, resolver)
+		if not finished.isSet():
+			results.put((site, resolutions))
+	start = time.time()
+	for site in sites:
+		_submitQuery(query, site)
+
+	answers = {}
+	pending = sites[:]
+	try:
+		while len(pending) > 0 and not (firstHit and _settled(sites, pending, answers)):
+			deadlines = [start + siteTimeout(s) for s in pending if siteTimeout(s) is not None]
+			wait = 60
+			if len(deadlines) > 0:
+				wait = max(0, min(deadlines) - time.time())
+			try:
+				site, resolutions = results.get(True, wait)
+				# a site that already timed out is ignored
+				if site in pending:
+					pending.remove(site)
+					answers[id(site)] = resolutions
+			except Queue.Empty:
+				pass
+			for site in pending[:]:
+				if siteTimeout(site) is not None and time.time() >= start + siteTimeout(site):
+					logging.warn(": %s didn't answer within %ss, skipping it" % (getattr(site, 'baseURL', site), siteTimeout(site)))
+					pending.remove(site)
+	finally:
+		finished.set()
+	return [(site, answers[id(site)]) for site in sites if answers.has_key(id(site))]
 	
 class Resolution:
 	def __init__(self, bundle, site, **kwargs):
@@ -288,7 +955,7 @@ class Resolution:
 	def remoteDict(self):
 		if not self.site:
 			return None
-		return self.site.getIndex().json['bundles'][self.id][str(self.version)]
+		return self.site.getIndex().entry(self.id, self.version)
 	
 	def sha1(self):
 		if not self.site:
@@ -296,6 +963,12 @@ class Resolution:
 		else:
 			return self.remoteDict()['sha1']
 	
+	def dependencies(self):
+		if not self.site:
+			return self.bundle.dependencies
+		else:
+			return self.remoteDict().get('dependencies') or []
+
 	def type(self):
 		if not self.site:
 			return self.bundle.type
@@ -311,44 +984,73 @@ class Resolution:
 class Resolver:
 	def __init__(self, id, op=GreaterThan, version="0.0.0"):
 		self.id = id
-		self.op = op
+		# interned so that operators read from an index compare with `is`
+		self.op = op = intern(str(op))
+		self.range = None
+		if op is InRange:
+			self.range = Resolver.parseRange(version)
+			version = self.range[0]
 		self.version = Version.fromObject(version)
 		self.resolution = None
 		self.resolvedSite = None
 		self.error = False
 	
+	# ranges are exclusive on both ends and are given either as a list
+	# or as a string delimited by one of ",-:", i.e. "1.0.0-2.0.0"
+	@staticmethod
+	def parseRange(versionRange):
+		if not isinstance(versionRange, list):
+			versionRange = re.split("[,\\-\\:]", versionRange)
+		return (Version.fromObject(versionRange[0]), Version.fromObject(versionRange[1]))
+	
 	def matchesVersion(self, version):
-		if not self.op is InRange:
-			v = Version.fromObject(version)
-			if self.op is GreaterThanEqual:
-				return v >= self.version
-			elif self.op is GreaterThan:
-				return v > self.version
-			elif self.op is LessThanEqual:
-				return v <= self.version
-			elif self.op is LessThan:
-				return v < self.version
-			elif self.op is Equal:
-				return v == self.version
-		else:
-			versionRange = []
-			if isinstance(version, list):
-				versionRange = version
-			else:
-				r = re.compile("[,\\-\\:]")
-				versionRange = re.split(r, version)
-			
-			if self.version > Version.fromObject(versionRange[0]) and self.version < Version.fromObject(versionRange[1]):
-				return True
-			return False
+		v = Version.fromObject(version)
+		if self.op is GreaterThanEqual:
+			return v >= self.version
+		elif self.op is GreaterThan:
+			return v > self.version
+		elif self.op is LessThanEqual:
+			return v <= self.version
+		elif self.op is LessThan:
+			return v < self.version
+		elif self.op is Equal:
+			return v == self.version
+		elif self.op is InRange:
+			return v > self.range[0] and v < self.range[1]
+		return False
+	
+	# the (start, end) slice of an ascending list of versions that matches
+	def matchingRange(self, versions):
+		if self.op is GreaterThanEqual:
+			return (bisect.bisect_left(versions, self.version), len(versions))
+		elif self.op is GreaterThan:
+			return (bisect.bisect_right(versions, self.version), len(versions))
+		elif self.op is LessThanEqual:
+			return (0, bisect.bisect_right(versions, self.version))
+		elif self.op is LessThan:
+			return (0, bisect.bisect_left(versions, self.version))
+		elif self.op is Equal:
+			return (bisect.bisect_left(versions, self.version), bisect.bisect_right(versions, self.version))
+		elif self.op is InRange:
+			start = bisect.bisect_right(versions, self.range[0])
+			return (start, max(start, bisect.bisect_left(versions, self.range[1])))
+		return (0, 0)
 	
-	# find the "newest" resolution for the id/version/operator spec
-	def resolve(self, remote=True, local=True):
+	# find the "newest" resolution for the id/version/operator spec. an exact
+	# version is looked up locally first, and then on whichever site has it first.
+	# local resolutions come from repository, by default the local repository
+	def resolve(self, remote=True, local=True, repository=None):
+		if repository is None: repository = localRepository
 		self.resolution = None
+
+		if local and self.op is Equal:
+			for localResolution in repository.resolve(self):
+				logging.info(": Found %s [%s] in local repository" % (self.id, str(self.version)))
+				self.resolution = localResolution
+				return
 		
 		if remote:
-			for site in PullSites:
-				resolutions = site.resolve(self)
+			for site, resolutions in querySites(self, firstHit=self.op is Equal):
 				for resolution in resolutions:
 					if self.resolution is None:
 						self.resolution = resolution
@@ -363,7 +1065,7 @@ class Resolver:
 			logging.info(": Checking against local repository..")
 			# compare the "greatest" resolution with the one in our local repository
 			# if it's greater, prefer the updated version
-			for localResolution in localRepository.resolve(self):
+			for localResolution in repository.resolve(self):
 				if self.resolution is None or localResolution >= self.resolution:
 					self.resolution = localResolution
 		
@@ -374,14 +1076,20 @@ class Resolver:
 		
 	def fetch(self, repository=localRepository):
 		if self.resolution is None:
-			self.resolve()
+			self.resolve(repository=repository)
 			if self.resolution is None:
 				return
 		
 		if self.resolution.site:
-			self.resolution.site.fetch(self.resolution, repository)
+			lock = repository.versionLock(self.id, self.resolution.version)
+			lock.acquire(shared=True)
+			try:
+				self.resolution.site.fetch(self.resolution, repository)
+			finally:
+				lock.release()
 		else:
 			logging.info(":: => Using local resolution: " + self.resolution.bundle.path)
+			self.resolution.bundle.repository.recordUse(self.resolution.bundle)
 
 		return self.resolution.bundle
 	
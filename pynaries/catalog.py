@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+A persistent catalog of the bundles cached in a local repository, so that
+resolving against the repository is a dictionary lookup instead of a scan
+of the filesystem. The catalog is a JSON file of the form:
+
+{
+	"<id>": {
+		"<version>": {
+			"archive": "<archive name>",
+			"type": ".zip",
+			"sha1": "...",
+			"size": 1234,
+			"mtime": 1234567890.0
+		}
+	}
+}
+
+Writes go to a temporary file which is then renamed over the catalog, and the
+catalog is re-read whenever another process has replaced it since we loaded it.
+Updates hold an exclusive lock on "<catalog>.lock" from re-reading the catalog
+until the new one is renamed into place, so concurrent processes don't drop
+each other's entries.
+"""
+
+import os, tempfile, threading, logging
+import simplejson
+import filelock
+
+class Catalog:
+	def __init__(self, path):
+		self.path = path
+		self.lock = threading.RLock()
+		self.entries = {}
+		self.stamp = None
+
+	# every save renames a new file into place, so its inode changes even
+	# when the mtime doesn't
+	def _fileStamp(self):
+		try:
+			st = os.stat(self.path)
+		except OSError:
+			return None
+		return (st.st_mtime, st.st_ino)
+
+	# the lock on the catalog file, held until it's released
+	def _lockFile(self):
+		lock = filelock.FileLock(self.path + '.lock')
+		lock.acquire()
+		return lock
+
+	# returns False if there is no catalog on disk to load
+	def load(self):
+		self.lock.acquire()
+		try:
+			stamp = self._fileStamp()
+			if stamp is None:
+				return False
+			try:
+				f = open(self.path, 'r')
+				try:
+					self.entries = simplejson.load(f)
+				finally:
+					f.close()
+			except (IOError, ValueError), e:
+				logging.warn("Ignoring unreadable catalog %s: %s" % (self.path, str(e)))
+				return False
+			self.stamp = stamp
+			return True
+		finally:
+			self.lock.release()
+
+	def _refresh(self):
+		stamp = self._fileStamp()
+		if stamp is not None and stamp != self.stamp:
+			self.load()
+
+	# callers that changed entries they refreshed hold _lockFile()
+	def save(self):
+		self.lock.acquire()
+		try:
+			fd, tmpPath = tempfile.mkstemp(prefix='.catalog', dir=os.path.dirname(self.path))
+			f = os.fdopen(fd, 'w')
+			try:
+				simplejson.dump(self.entries, f)
+			finally:
+				f.close()
+			os.rename(tmpPath, self.path)
+			self.stamp = self._fileStamp()
+		finally:
+			self.lock.release()
+
+	def versions(self, id):
+		self.lock.acquire()
+		try:
+			self._refresh()
+			return dict(self.entries.get(id, {}))
+		finally:
+			self.lock.release()
+
+	def get(self, id, version):
+		self.lock.acquire()
+		try:
+			self._refresh()
+			return self.entries.get(id, {}).get(str(version))
+		finally:
+			self.lock.release()
+
+	def ids(self):
+		self.lock.acquire()
+		try:
+			self._refresh()
+			return self.entries.keys()
+		finally:
+			self.lock.release()
+
+	def add(self, id, version, entry):
+		self.lock.acquire()
+		fileLock = self._lockFile()
+		try:
+			self._refresh()
+			self.entries.setdefault(id, {})[str(version)] = entry
+			self.save()
+		finally:
+			fileLock.release()
+			self.lock.release()
+
+	def remove(self, id, version):
+		self.lock.acquire()
+		fileLock = self._lockFile()
+		try:
+			self._refresh()
+			versions = self.entries.get(id, {})
+			if versions.pop(str(version), None) is not None:
+				if len(versions) == 0:
+					del self.entries[id]
+				self.save()
+		finally:
+			fileLock.release()
+			self.lock.release()
+
+	def replace(self, entries):
+		self.lock.acquire()
+		fileLock = self._lockFile()
+		try:
+			self.entries = entries
+			self.save()
+		finally:
+			fileLock.release()
+			self.lock.release()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Keeps a local repository within a byte budget. Every time a bundle is used
+(fetched, found in the repository, or bundled locally) a line is appended to
+<repository>/access.log, and collect() removes the least recently used
+versions until the repository fits the budget, i.e.
+
+	pynaries.cleanup.collect(budget=10 * 1024 * 1024 * 1024)
+
+or, to collect automatically after fetches (at most every CollectInterval
+seconds), in ~/.pynaries/config:
+
+	SetCacheBudget(10 * 1024 * 1024 * 1024)
+
+Versions referenced by a lockfile that still exists are never evicted: the
+path of every lockfile passed to fetch is remembered in <repository>/lockfiles.
+
+Since archives and deduplicated files are hardlinks into the blob store, the
+size of the repository is counted per inode, and a version only frees the
+bytes that no other version shares. Blobs that nothing links to anymore are
+removed once they've been unlinked for TempMaxAge (a blob exists for a moment
+before its first link), or straight away when an eviction released them, as
+are temporary files left behind by interrupted downloads, extractions and
+writes once they're older than TempMaxAge. Blobs of archives in the catalog
+are always kept, since one copied in across filesystems has no other link.
+Extracted trees of an archive that has since been replaced (see Bundle.tree)
+are removed once the new archive has been in place for TempMaxAge, giving
+anything still using the old tree time to finish.
+
+Collection holds an exclusive lock on <repository>/collect.lock, so only one
+process collects at a time (collectIfDue skips collecting when another one
+is). A version is only evicted once its lock (see
+LocalRepository.versionLock) can be taken exclusively, so versions that are
+being fetched or extracted stay, even in other processes.
+"""
+
+import os, time, shutil, tempfile, logging
+import bundle, filelock, lockfile
+from version import Version
+
+CacheBudget = None
+CollectInterval = 60 * 60
+TempMaxAge = 24 * 60 * 60
+
+# temporary files (by prefix and suffix) that are only left behind when a
+# process is interrupted
+TempPrefixes = ('.extract', '.catalog', '.index', '.blob', '.access', '.lockfiles', '.members')
+TempSuffixes = ('.partial', '.segments', '.link', '.previous')
+# lock files of interrupted downloads (see transfer.exclusively), which are
+# only removed once nobody holds them
+TempLockSuffixes = ('.partial.lock',)
+
+# automatically collect after fetches, keeping the repository under budget
+# bytes (None turns it off)
+def SetCacheBudget(budget):
+	global CacheBudget
+	CacheBudget = budget
+
+# an append-only log of "<time> <id> <version>" lines. appends are a single
+# write to a file opened with O_APPEND, so processes can share the log
+class AccessLog:
+	def __init__(self, path):
+		self.path = path
+
+	def record(self, id, version, when=None):
+		if when is None:
+			when = time.time()
+		try:
+			fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+			try:
+				os.write(fd, "%d %s %s\n" % (int(when), id, str(version)))
+			finally:
+				os.close(fd)
+		except OSError, e:
+			logging.debug("Couldn't record use of %s %s: %s" % (id, str(version), str(e)))
+
+	# the time of the last use of each (id, version)
+	def load(self):
+		lastUse = {}
+		if not os.path.exists(self.path):
+			return lastUse
+		f = open(self.path, 'r')
+		try:
+			for line in f:
+				fields = line.split()
+				if len(fields) != 3: continue
+				try:
+					when = int(fields[0])
+				except ValueError:
+					continue
+				key = (fields[1], fields[2])
+				if when > lastUse.get(key, 0):
+					lastUse[key] = when
+		finally:
+			f.close()
+		return lastUse
+
+	# rewrite the log with one line per (id, version) in lastUse. uses
+	# recorded while the log is being rewritten may be lost
+	def compact(self, lastUse):
+		fd, tmpPath = tempfile.mkstemp(prefix='.access', dir=os.path.dirname(self.path))
+		f = os.fdopen(fd, 'w')
+		try:
+			for (id, version), when in lastUse.items():
+				f.write("%d %s %s\n" % (when, id, version))
+		finally:
+			f.close()
+		os.rename(tmpPath, self.path)
+
+def _lockfilesPath(repository):
+	return os.path.join(repository.path, 'lockfiles')
+
+def _readLockfiles(repository):
+	path = _lockfilesPath(repository)
+	if not os.path.exists(path):
+		return []
+	f = open(path, 'r')
+	try:
+		return [line.strip() for line in f if line.strip()]
+	finally:
+		f.close()
+
+# remember a lockfile, so that the bundles it pins are kept by collect
+def registerLockfile(path, repository=None):
+	if repository is None: repository = bundle.localRepository
+	path = os.path.abspath(path)
+	try:
+		if path in _readLockfiles(repository):
+			return
+		fd = os.open(_lockfilesPath(repository), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+		try:
+			os.write(fd, path + "\n")
+		finally:
+			os.close(fd)
+	except (IOError, OSError), e:
+		logging.debug("Couldn't register lockfile %s: %s" % (path, str(e)))
+
+# the (id, version)s pinned by registered lockfiles that still exist and by
+# the given lockfile paths. lockfiles that are gone are forgotten
+def pinnedVersions(repository, lockfiles=[]):
+	registered = _readLockfiles(repository)
+	active = [path for path in registered if os.path.exists(path)]
+	if len(active) != len(registered):
+		fd, tmpPath = tempfile.mkstemp(prefix='.lockfiles', dir=repository.path)
+		f = os.fdopen(fd, 'w')
+		try:
+			f.write(''.join([path + "\n" for path in active]))
+		finally:
+			f.close()
+		os.rename(tmpPath, _lockfilesPath(repository))
+
+	pinned = set()
+	for path in active + list(lockfiles):
+		lock = lockfile.Lockfile(path)
+		if lock.load():
+			for entry in lock.bundles():
+				pinned.add((entry['id'], entry['version']))
+	return pinned
+
+def _isTemp(name):
+	return name.startswith(TempPrefixes) or name.endswith(TempSuffixes)
+
+def _remove(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path, ignore_errors=True)
+	elif os.path.lexists(path):
+		os.remove(path)
+
+# remove the lock file at path, unless someone holds the lock
+def _removeLock(path):
+	lock = filelock.FileLock(path)
+	if not lock.acquire(blocking=False):
+		return False
+	logging.debug(":: => Removing stale lock " + path)
+	lock.release(remove=True)
+	return True
+
+# remove temporary files and directories, and anything in <repository>/tmp,
+# that are older than maxAge seconds. extracted trees aren't descended into
+def cleanTemp(repository, maxAge=None):
+	if maxAge is None:
+		maxAge = TempMaxAge
+	cutoff = time.time() - maxAge
+	removed = 0
+	for root, dirs, files in os.walk(repository.path):
+		tmp = root == os.path.join(repository.path, 'tmp')
+		for name in dirs + files:
+			path = os.path.join(root, name)
+			if name.endswith(TempLockSuffixes) and not tmp:
+				if os.lstat(path).st_mtime < cutoff and _removeLock(path):
+					removed += 1
+				continue
+			if (tmp or _isTemp(name)) and os.lstat(path).st_mtime < cutoff:
+				logging.debug(":: => Removing temporary " + path)
+				_remove(path)
+				removed += 1
+		dirs[:] = [d for d in dirs if os.path.isdir(os.path.join(root, d)) and
+			os.path.basename(root) != 'tree']
+	return removed
+
+# remove blobs that aren't linked from anywhere else, and haven't been
+# linked, renamed or written for maxAge seconds (going by their ctime), or
+# whose inode is in released. blobs of archives in the catalog stay
+def removeOrphanBlobs(repository, maxAge=None, released=()):
+	if maxAge is None:
+		maxAge = TempMaxAge
+	cutoff = time.time() - maxAge
+	catalog = repository.getCatalog()
+	archives = set()
+	for id in catalog.ids():
+		for entry in catalog.versions(id).values():
+			archives.add(entry.get('sha1'))
+	removed = 0
+	for root, dirs, files in os.walk(repository.store.path):
+		for name in files:
+			path = os.path.join(root, name)
+			st = os.lstat(path)
+			if _isTemp(name) or name in archives or st.st_nlink > 1:
+				continue
+			if st.st_ctime < cutoff or (st.st_dev, st.st_ino) in released:
+				os.remove(path)
+				removed += 1
+	return removed
+
+# remove the extracted trees of archives that were replaced more than maxAge
+# seconds ago (going by the ctime of their replacement)
+def removeStaleTrees(repository, maxAge=None):
+	if maxAge is None:
+		maxAge = TempMaxAge
+	cutoff = time.time() - maxAge
+	catalog = repository.getCatalog()
+	removed = 0
+	for id in catalog.ids():
+		for version, entry in catalog.versions(id).items():
+			treesDir = os.path.join(repository.path, id, version, 'tree')
+			if not entry.get('sha1') or not os.path.isdir(treesDir):
+				continue
+			try:
+				if os.stat(os.path.join(repository.path, id, version, entry['archive'])).st_ctime >= cutoff:
+					continue
+			except OSError:
+				continue
+			for name in os.listdir(treesDir):
+				if name != entry['sha1'] and not name.startswith('.'):
+					logging.debug(":: => Removing stale tree %s of %s %s" % (name, id, version))
+					shutil.rmtree(os.path.join(treesDir, name), ignore_errors=True)
+					removed += 1
+	return removed
+
+def _files(dir):
+	for root, dirs, files in os.walk(dir):
+		for name in dirs + files:
+			st = os.lstat(os.path.join(root, name))
+			yield ((st.st_dev, st.st_ino), st.st_size)
+
+# the sizes of every inode in the repository, the inodes under each
+# <id>/<version> directory, and the paths of those directories
+def _usage(repository):
+	sizes = {}
+	versions = {}
+	paths = {}
+	for name in os.listdir(repository.path):
+		path = os.path.join(repository.path, name)
+		if not os.path.isdir(path) or name in bundle.LocalRepository.ReservedDirs:
+			for inode, size in _files(path):
+				sizes[inode] = size
+			if not os.path.isdir(path):
+				st = os.lstat(path)
+				sizes[(st.st_dev, st.st_ino)] = st.st_size
+			continue
+		for vdir in os.listdir(path):
+			vpath = os.path.join(path, vdir)
+			try:
+				Version.fromObject(vdir)
+			except ValueError:
+				continue
+			if not os.path.isdir(vpath): continue
+			inodes = set()
+			for inode, size in _files(vpath):
+				sizes[inode] = size
+				inodes.add(inode)
+			versions[(name, vdir)] = inodes
+			paths[(name, vdir)] = vpath
+	return sizes, versions, paths
+
+def _lastUse(repository, key, path, lastUse):
+	if lastUse.has_key(key):
+		return lastUse[key]
+	entry = repository.getCatalog().get(key[0], key[1])
+	if entry is not None:
+		return entry['mtime']
+	return os.stat(path).st_mtime
+
+def _collectLock(repository):
+	return filelock.FileLock(os.path.join(repository.path, 'collect.lock'))
+
+# evict the least recently used versions until the repository takes up at
+# most budget bytes (by default CacheBudget; None only cleans up). versions
+# pinned by lockfiles (see pinnedVersions), given in keep, a list of
+# bundles, or in use stay. returns the list of evicted (id, version)s
+def collect(repository=None, budget=None, lockfiles=[], keep=[], maxAge=None):
+	if repository is None: repository = bundle.localRepository
+	lock = _collectLock(repository)
+	lock.acquire()
+	try:
+		return _collect(repository, budget, lockfiles, keep, maxAge)
+	finally:
+		lock.release(remove=True)
+
+def _collect(repository, budget, lockfiles, keep, maxAge):
+	if budget is None: budget = CacheBudget
+	cleanTemp(repository, maxAge)
+	removeStaleTrees(repository, maxAge)
+	removeOrphanBlobs(repository, maxAge)
+
+	accessLog = repository.accessLog
+	lastUse = accessLog.load()
+	evicted = []
+	if budget is not None:
+		pinned = pinnedVersions(repository, lockfiles)
+		for b in keep:
+			if b is not None:
+				pinned.add((b.id, str(b.version)))
+
+		sizes, versions, paths = _usage(repository)
+		holders = {}
+		for key, inodes in versions.items():
+			for inode in inodes:
+				holders.setdefault(inode, set()).add(key)
+		total = sum(sizes.values())
+		logging.info("Repository %s uses %d bytes, the budget is %d" % (repository.path, total, budget))
+
+		candidates = [key for key in versions.keys() if not key in pinned]
+		candidates.sort(key=lambda key: _lastUse(repository, key, paths[key], lastUse))
+		for key in candidates:
+			if total <= budget:
+				break
+			versionLock = repository.versionLock(key[0], key[1])
+			if not versionLock.acquire(blocking=False):
+				logging.info(":: => Keeping %s %s, it's in use" % key)
+				continue
+			try:
+				logging.info(":: => Evicting %s %s" % key)
+				shutil.rmtree(paths[key], ignore_errors=True)
+				repository.remove(key[0], key[1])
+			finally:
+				versionLock.release(remove=True)
+			try: os.rmdir(os.path.dirname(paths[key]))
+			except OSError: pass
+			# the version's bytes are freed once no other version shares them
+			for inode in versions[key]:
+				holders[inode].discard(key)
+				if len(holders[inode]) == 0:
+					total -= sizes[inode]
+			lastUse.pop(key, None)
+			evicted.append(key)
+
+		if len(evicted) > 0:
+			released = set()
+			for key in evicted:
+				released.update(versions[key])
+			removeOrphanBlobs(repository, maxAge, released)
+		if total > budget:
+			logging.warn("Repository %s is still %d bytes over budget, the rest is pinned or in use" %
+				(repository.path, total - budget))
+
+	if os.path.exists(accessLog.path):
+		accessLog.compact(lastUse)
+	return evicted
+
+# collect if there's a CacheBudget and the last collection was more than
+# CollectInterval seconds ago. keep is passed on to collect
+def collectIfDue(repository=None, keep=[]):
+	if CacheBudget is None:
+		return []
+	if repository is None: repository = bundle.localRepository
+	stamp = os.path.join(repository.path, '.collected')
+	try:
+		if time.time() - os.stat(stamp).st_mtime < CollectInterval:
+			return []
+	except OSError:
+		pass
+	open(stamp, 'w').close()
+	lock = _collectLock(repository)
+	if not lock.acquire(blocking=False):
+		return []
+	try:
+		return _collect(repository, None, [], keep, None)
+	finally:
+		lock.release(remove=True)
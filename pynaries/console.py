@@ -3,6 +3,7 @@
 # see LICENSE in the root folder for details on the license.
 # Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
 
+import thread, threading
 from progressbar import Bar, Percentage, ETA, ProgressBar
 
 class ConsoleProgress:
@@ -45,4 +46,75 @@ class ConsoleProgress:
 		self.progress.update(self.amount)
 	
 	def finish(self):
-		self.progress.finish()
\ No newline at end of file
+		self.progress.finish()
+
+# Aggregates the progress of several concurrent tasks into one bar.
+# Worker threads report through the usual start/set/update calls, and
+# each task counts as an equal share of the bar until finishTask is called
+class ParallelProgress(ConsoleProgress):
+	Share = 1000
+
+	def __init__(self):
+		ConsoleProgress.__init__(self)
+		self.lock = threading.Lock()
+		self.tasks = {}
+		self.finished = 0
+
+	def startAll(self, object, action, count):
+		ConsoleProgress.start(self, object, action, count * ParallelProgress.Share)
+
+	def _render(self):
+		amount = self.finished * ParallelProgress.Share
+		for task in self.tasks.values():
+			if task[1] > 0:
+				amount += min(task[0] / float(task[1]), 1.0) * ParallelProgress.Share
+		self.amount = min(int(amount), self.maxVal)
+		self.progress.update(self.amount)
+
+	def start(self, object, action, maxVal):
+		self.lock.acquire()
+		try:
+			self.tasks[thread.get_ident()] = [0, maxVal]
+			self._render()
+		finally:
+			self.lock.release()
+
+	def setMaxVal(self, maxVal):
+		self.lock.acquire()
+		try:
+			self.tasks.setdefault(thread.get_ident(), [0, 0])[1] = maxVal
+			self._render()
+		finally:
+			self.lock.release()
+
+	def set(self, amount):
+		self.lock.acquire()
+		try:
+			self.tasks.setdefault(thread.get_ident(), [0, 0])[0] = amount
+			self._render()
+		finally:
+			self.lock.release()
+
+	def update(self, amount):
+		self.lock.acquire()
+		try:
+			self.tasks.setdefault(thread.get_ident(), [0, 0])[0] += amount
+			self._render()
+		finally:
+			self.lock.release()
+
+	# a single transfer finishing doesn't finish the whole task
+	def finish(self):
+		pass
+
+	def finishTask(self):
+		self.lock.acquire()
+		try:
+			self.tasks.pop(thread.get_ident(), None)
+			self.finished += 1
+			self._render()
+		finally:
+			self.lock.release()
+
+	def finishAll(self):
+		self.progress.finish()
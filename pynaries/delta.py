@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Deltas between two versions of a zip bundle, so that a consumer that already
+has the base version only downloads what changed.
+
+A delta is a recipe for rebuilding the new archive byte for byte: a list of
+ranges that are either copied from the base archive or read from the delta's
+own (gzip compressed) literal data. Members whose compressed bytes are
+identical in both archives, wherever they are and whatever they're called,
+are copied from the base; new and changed members, local headers and the
+central directory are literals. Removed members simply aren't referenced.
+
+The file format is a "pynaries-delta 1" line, a line of JSON describing the
+base and target archives and holding the recipe, then the literal data.
+"""
+
+import os, hashlib, zipfile
+import simplejson
+import archives, transfer
+
+Magic = "pynaries-delta 1\n"
+
+# members smaller than this aren't worth a recipe entry of their own
+MinimumCopy = 256
+
+class DeltaError(Exception):
+	pass
+
+def deltaName(id, version, baseVersion):
+	return "%s_%s.from_%s.delta" % (id, str(version), str(baseVersion))
+
+def _rawSHA1(fp, offset, length):
+	m = hashlib.sha1()
+	fp.seek(offset)
+	while length > 0:
+		buf = fp.read(min(transfer.ChunkSize, length))
+		if buf == '':
+			break
+		m.update(buf)
+		length -= len(buf)
+	return m.hexdigest()
+
+def _copy(input, out, length, m):
+	while length > 0:
+		buf = input.read(min(transfer.ChunkSize, length))
+		if buf == '':
+			raise DeltaError("Delta or base archive is truncated")
+		out.write(buf)
+		m.update(buf)
+		length -= len(buf)
+
+# the (offset, length) ranges of targetArchive that can be copied from
+# baseArchive, in order
+def _matches(baseArchive, targetArchive):
+	baseZip = zipfile.ZipFile(baseArchive, 'r')
+	targetZip = zipfile.ZipFile(targetArchive, 'r')
+	try:
+		candidates = {}
+		for info in baseZip.infolist():
+			if info.compress_size < MinimumCopy: continue
+			key = (info.CRC, info.file_size, info.compress_size, info.compress_type)
+			candidates.setdefault(key, []).append(info)
+
+		baseDigests = {}
+		def baseRange(info):
+			if not baseDigests.has_key(info.header_offset):
+				offset = archives.rawMemberOffset(baseZip.fp, info)
+				baseDigests[info.header_offset] = (offset, _rawSHA1(baseZip.fp, offset, info.compress_size))
+			return baseDigests[info.header_offset]
+
+		matches = []
+		infos = sorted(targetZip.infolist(), key=lambda info: info.header_offset)
+		for info in infos:
+			key = (info.CRC, info.file_size, info.compress_size, info.compress_type)
+			if not candidates.has_key(key): continue
+			offset = archives.rawMemberOffset(targetZip.fp, info)
+			digest = _rawSHA1(targetZip.fp, offset, info.compress_size)
+			# try the member with the same name first
+			for candidate in sorted(candidates[key], key=lambda c: c.filename != info.filename):
+				baseOffset, baseDigest = baseRange(candidate)
+				if baseDigest == digest:
+					matches.append((offset, info.compress_size, baseOffset))
+					break
+		return matches
+	finally:
+		baseZip.close()
+		targetZip.close()
+
+# write a delta to deltaPath that rebuilds targetArchive from baseArchive.
+# returns the number of bytes that are copied from the base
+def create(baseArchive, targetArchive, deltaPath):
+	matches = _matches(baseArchive, targetArchive)
+	size = os.path.getsize(targetArchive)
+	recipe = []
+	def literal(length):
+		if length <= 0: return
+		if len(recipe) > 0 and recipe[-1][0] == 'delta':
+			recipe[-1][1] += length
+		else:
+			recipe.append(['delta', length])
+
+	position = 0
+	copied = 0
+	for offset, length, baseOffset in matches:
+		literal(offset - position)
+		recipe.append(['base', baseOffset, length])
+		position = offset + length
+		copied += length
+	literal(size - position)
+
+	header = {
+		'base': transfer.fileSHA1(baseArchive),
+		'sha1': transfer.fileSHA1(targetArchive),
+		'size': size,
+		'recipe': recipe
+	}
+	out = open(deltaPath, 'wb')
+	try:
+		out.write(Magic)
+		out.write(simplejson.dumps(header) + "\n")
+		compressor = archives.BlockCompressor(out, 'gz')
+		target = open(targetArchive, 'rb')
+		try:
+			position = 0
+			for op in recipe:
+				if op[0] == 'base':
+					position += op[2]
+					continue
+				target.seek(position)
+				remaining = op[1]
+				while remaining > 0:
+					buf = target.read(min(transfer.ChunkSize, remaining))
+					compressor.write(buf)
+					remaining -= len(buf)
+				position += op[1]
+		finally:
+			target.close()
+			compressor.close()
+	finally:
+		out.close()
+	return copied
+
+def readHeader(deltaFile):
+	if deltaFile.readline() != Magic:
+		raise DeltaError("Not a pynaries delta: " + deltaFile.name)
+	try:
+		return simplejson.loads(deltaFile.readline())
+	except ValueError:
+		raise DeltaError("Corrupt delta header in " + deltaFile.name)
+
+# rebuild archivePath from baseArchive and the delta at deltaPath. the result
+# is verified against sha1 (by default, the sha1 recorded in the delta) and
+# only renamed into place when it matches, see transfer.download
+def apply(deltaPath, baseArchive, archivePath, sha1=None, label=None):
+	if label is None:
+		label = os.path.basename(archivePath)
+	transfer.exclusively(archivePath, lambda: _apply(deltaPath, baseArchive, archivePath, sha1, label))
+	return archivePath
+
+def _apply(deltaPath, baseArchive, archivePath, sha1, label):
+	deltaFile = open(deltaPath, 'rb')
+	try:
+		header = readHeader(deltaFile)
+		if sha1 is None:
+			sha1 = header['sha1']
+		literals = archives.MultiStreamReader(deltaFile, 'gz')
+		partial = transfer.partialPath(archivePath)
+		m = hashlib.sha1()
+		base = open(baseArchive, 'rb')
+		try:
+			out = open(partial, 'wb')
+			try:
+				for op in header['recipe']:
+					if op[0] == 'base':
+						base.seek(op[1])
+						_copy(base, out, op[2], m)
+					else:
+						_copy(literals, out, op[1], m)
+			finally:
+				out.close()
+		finally:
+			base.close()
+	finally:
+		deltaFile.close()
+	transfer._complete(partial, archivePath, label, sha1, m.hexdigest())
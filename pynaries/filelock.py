@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Advisory locks on files, shared between processes: flock where the platform
+has it, msvcrt's byte-range locks on Windows (which has no shared locks, so
+those are only taken for exclusive locks), and no locking at all elsewhere.
+
+Whoever holds a lock exclusively may remove its file when it's done with
+what the lock guards: anyone who was waiting for it notices that the file
+was replaced, and locks the new one instead.
+"""
+
+import os, time, errno
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+try:
+	import msvcrt
+except ImportError:
+	msvcrt = None
+
+def _lock(f, shared, blocking):
+	if fcntl is not None:
+		if shared:
+			flags = fcntl.LOCK_SH
+		else:
+			flags = fcntl.LOCK_EX
+		if not blocking:
+			flags |= fcntl.LOCK_NB
+		try:
+			fcntl.flock(f.fileno(), flags)
+		except IOError, e:
+			if not blocking and e.errno in (errno.EAGAIN, errno.EACCES):
+				return False
+			raise
+		return True
+	if msvcrt is not None and not shared:
+		f.seek(0)
+		while True:
+			try:
+				msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+				return True
+			except IOError:
+				if not blocking:
+					return False
+				time.sleep(0.1)
+	return True
+
+def _unlock(f):
+	if fcntl is None and msvcrt is not None:
+		f.seek(0)
+		try: msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+		except IOError: pass
+
+class FileLock:
+	def __init__(self, path):
+		self.path = path
+		self.file = None
+
+	# take the lock, waiting for it unless blocking is False, in which case
+	# False is returned when someone else holds it. the file's mtime is when
+	# the lock was last taken
+	def acquire(self, shared=False, blocking=True):
+		while True:
+			f = open(self.path, 'a')
+			try:
+				if not _lock(f, shared, blocking):
+					f.close()
+					return False
+				try:
+					current = os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino
+				except OSError:
+					current = False
+			except:
+				f.close()
+				raise
+			if current:
+				self.file = f
+				try: os.utime(self.path, None)
+				except OSError: pass
+				return True
+			# removed by its last holder while we waited
+			_unlock(f)
+			f.close()
+
+	# with remove, the lock file is removed first (only while holding it
+	# exclusively, see above)
+	def release(self, remove=False):
+		if remove:
+			try: os.remove(self.path)
+			except OSError: pass
+		_unlock(self.file)
+		self.file.close()
+		self.file = None
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+An on-disk cache of remote indexes, kept under ~/.pynaries/indexes and keyed
+by the URL of the index. A cached index is used as-is for TTL seconds after
+it was last validated; after that it is revalidated with the site (i.e. with
+If-None-Match / If-Modified-Since for HTTP sites), and only re-downloaded
+when it actually changed. In offline mode the cached copy is always used.
+"""
+
+import os, time, tempfile, hashlib, logging
+import simplejson
+
+TTL = 300
+Offline = os.environ.has_key('PYNARIES_OFFLINE')
+
+def SetIndexCacheTTL(seconds):
+	global TTL
+	TTL = seconds
+
+def SetOffline(offline=True):
+	global Offline
+	Offline = offline
+
+def cacheDir():
+	import bundle
+	return os.path.join(bundle.localRepository.path, 'indexes')
+
+def _writeAtomic(path, data):
+	fd, tmpPath = tempfile.mkstemp(prefix='.index', dir=os.path.dirname(path))
+	f = os.fdopen(fd, 'wb')
+	try:
+		f.write(data)
+	finally:
+		f.close()
+	os.rename(tmpPath, path)
+
+class CachedIndex:
+	def __init__(self, url, dir=None):
+		if dir is None:
+			dir = cacheDir()
+		self.url = url
+		name = hashlib.sha1(url).hexdigest()
+		self.dataPath = os.path.join(dir, name + '.json')
+		self.metaPath = os.path.join(dir, name + '.meta')
+		self.meta = None
+
+	def getMeta(self):
+		if self.meta is None:
+			self.meta = {}
+			if os.path.exists(self.metaPath) and os.path.exists(self.dataPath):
+				try:
+					f = open(self.metaPath, 'r')
+					try:
+						self.meta = simplejson.load(f)
+					finally:
+						f.close()
+				except (IOError, ValueError):
+					self.meta = {}
+		return self.meta
+
+	def isCached(self):
+		return self.getMeta().has_key('fetched')
+
+	def isFresh(self, ttl):
+		return self.isCached() and time.time() - self.getMeta()['fetched'] < ttl
+
+	def read(self):
+		if not self.isCached():
+			return None
+		f = open(self.dataPath, 'rb')
+		try:
+			return f.read()
+		finally:
+			f.close()
+
+	def _saveMeta(self):
+		_writeAtomic(self.metaPath, simplejson.dumps(self.meta))
+
+	def store(self, data, etag=None, lastModified=None):
+		if not os.path.exists(os.path.dirname(self.dataPath)):
+			try: os.makedirs(os.path.dirname(self.dataPath))
+			except OSError: pass
+		_writeAtomic(self.dataPath, data)
+		self.meta = {
+			'url': self.url,
+			'etag': etag,
+			'lastModified': lastModified,
+			'fetched': time.time()
+		}
+		self._saveMeta()
+
+	# the cached copy was revalidated with the site and is still current
+	def touch(self):
+		self.getMeta()['fetched'] = time.time()
+		self._saveMeta()
+
+# Load the index at url, going through the cache. revalidate is called with
+# the cached etag and last-modified values (None when nothing is cached), and
+# returns None if the cached copy is still current, or a (data, etag,
+# lastModified) tuple with the new index. data may itself be None when the
+# site has no index. Returns the index contents, or None if there is none
+def load(url, revalidate, ttl=None, dir=None):
+	if ttl is None:
+		ttl = TTL
+	cache = CachedIndex(url, dir)
+	if Offline or cache.isFresh(ttl):
+		data = cache.read()
+		if data is not None or Offline:
+			return data
+
+	meta = cache.getMeta()
+	try:
+		result = revalidate(meta.get('etag'), meta.get('lastModified'))
+	except Exception, e:
+		if cache.isCached():
+			logging.warn("Couldn't revalidate %s, using cached index: %s" % (url, str(e)))
+			return cache.read()
+		logging.warn("Couldn't load %s: %s" % (url, str(e)))
+		return None
+
+	if result is None:
+		cache.touch()
+		return cache.read()
+
+	data, etag, lastModified = result
+	if data is not None:
+		cache.store(data, etag, lastModified)
+	return data
+
+# Load the index at url when it's known to have the given sha1 (i.e. a shard
+# listed in a sharded root): a cached copy with that sha1 is used without
+# asking the site, otherwise it's revalidated whatever its age
+def loadVersion(url, sha1, revalidate, dir=None):
+	cache = CachedIndex(url, dir)
+	data = cache.read()
+	if data is not None and hashlib.sha1(data).hexdigest() == sha1:
+		return data
+	return load(url, revalidate, 0, dir)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Lockfiles pin a dependency list to the exact bundles it resolved to, so that
+later fetches of the same list can skip resolution entirely: each locked
+bundle is either already in the local repository with the locked sha1, or is
+downloaded straight from the locked URL. A lockfile looks like:
+
+{
+	"dependencies": [["com.mycompany.dep1", "=", "1.0.1"], ...],
+	"transitive": false,
+	"bundles": [
+		{
+			"id": "com.mycompany.dep1",
+			"version": "1.0.1",
+			"type": ".zip",
+			"sha1": "...",
+			"url": "http://myrepository.com/pynaries/com.mycompany.dep1/1.0.1/com.mycompany.dep1_1.0.1.zip"
+		}
+	]
+}
+
+A lockfile only applies to the dependency list it was written for; when the
+list changes, it is resolved again and the lockfile rewritten.
+"""
+
+import os, tempfile, urlparse, logging
+import simplejson
+import bundle, transfer
+
+class LockMismatch(Exception):
+	pass
+
+def _normalize(dependencies):
+	normalized = []
+	for id, op, version in dependencies:
+		if isinstance(version, (list, tuple)):
+			version = [str(v) for v in version]
+		else:
+			version = str(version)
+		normalized.append([str(id), str(op), version])
+	return normalized
+
+# the URL a resolution's archive can be downloaded from directly, if any
+def resolutionURL(resolution):
+	if resolution.site is None:
+		return None
+	if hasattr(resolution.site, 'archiveURL'):
+		return resolution.site.archiveURL(resolution)
+	return resolution.args.get('url')
+
+class Lockfile:
+	def __init__(self, path):
+		self.path = path
+		self.json = None
+
+	def load(self):
+		if not os.path.exists(self.path):
+			return False
+		try:
+			f = open(self.path, 'r')
+			try:
+				self.json = simplejson.load(f)
+			finally:
+				f.close()
+		except (IOError, ValueError), e:
+			logging.warn("Ignoring unreadable lockfile %s: %s" % (self.path, str(e)))
+			return False
+		return True
+
+	def matches(self, dependencies, transitive=False):
+		return self.json is not None and \
+			self.json.get('dependencies') == _normalize(dependencies) and \
+			self.json.get('transitive', False) == transitive
+
+	def bundles(self):
+		return self.json['bundles']
+
+	def save(self, dependencies, transitive, resolutions):
+		self.json = {
+			'dependencies': _normalize(dependencies),
+			'transitive': transitive,
+			'bundles': [{
+				'id': r.id,
+				'version': str(r.version),
+				'type': r.type(),
+				'sha1': r.sha1(),
+				'url': resolutionURL(r)
+			} for r in resolutions]
+		}
+		dir = os.path.dirname(os.path.abspath(self.path))
+		fd, tmpPath = tempfile.mkstemp(prefix='.lock', dir=dir)
+		f = os.fdopen(fd, 'w')
+		try:
+			f.write(simplejson.dumps(self.json, sort_keys=True, indent=4))
+		finally:
+			f.close()
+		os.rename(tmpPath, self.path)
+
+# fetch a locked bundle: a repository hit with the locked sha1 is used as is,
+# otherwise the archive is downloaded from the locked URL (or, for sites that
+# can't be downloaded from directly, resolved for the exact version) and
+# verified against the locked sha1
+def fetchLocked(entry, repository=None):
+	if repository is None: repository = bundle.localRepository
+	id, version, sha1 = entry['id'], entry['version'], entry['sha1']
+	lock = repository.versionLock(id, version)
+	lock.acquire(shared=True)
+	try:
+		return _fetchEntry(id, version, sha1, entry, repository)
+	finally:
+		lock.release()
+
+def _fetchEntry(id, version, sha1, entry, repository):
+	b = repository.lockedBundle(id, version, sha1)
+	if b is not None:
+		return b
+
+	url = entry.get('url')
+	if url and urlparse.urlparse(url)[0] in ('http', 'https', 'file'):
+		b = bundle.Bundle(id, version, entry['type'], repository)
+		transfer.download(url, b.localArchive(), b.archiveName(), sha1)
+		b.sha1 = sha1
+		repository.add(b)
+		return b
+
+	resolver = bundle.Resolver(id, bundle.Equal, version)
+	resolver.resolve(local=False)
+	if resolver.resolution is None or resolver.resolution.sha1() != sha1:
+		raise LockMismatch("%s %s isn't available with the locked sha1 %s" % (id, version, sha1))
+	resolver.resolution.site.fetch(resolver.resolution, repository)
+	return repository.bundle(id, version)
@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+A caching mirror of one or more sites, served over HTTP with the same layout
+as an HTTPSite, so clients only need to point their pull site at it:
+
+	python -m pynaries serve --port 8080 http://myrepository.com/pynaries
+
+	AddPullSite(HTTPSite('mirror.local', 8080))
+
+The mirror serves the index of its upstream sites (merged, with earlier
+sites winning, and sharded when asked to), refreshed every TTL seconds, and
+answers conditional requests for it with ETags. Archives and deltas are
+pulled through from the site that has them the first time they're asked for,
+and cached in a LocalRepository of the mirror's own, where they're only
+renamed into place once their sha1 matches the index.
+
+Concurrent requests for a file that's still being pulled are collapsed into
+a single upstream download: every request streams from the partial file as
+it's written, so even the first byte reaches clients as soon as it arrives
+from upstream. Range requests (for resuming and segmented downloads) are
+served the same way, once the bytes they ask for have arrived.
+"""
+
+import os, re, sys, time, hashlib, threading, urllib, urllib2, logging
+import BaseHTTPServer, SocketServer
+import bundle, cleanup, delta, indexcache, transfer
+from site import JSONIndex, ShardedIndex
+
+DefaultPath = os.path.join(os.path.expanduser("~"), '.pynaries-mirror')
+
+# the base URL archives are downloaded from for a site
+def siteURL(site):
+	if hasattr(site, 'baseURL'):
+		return site.baseURL
+	return 'file:' + urllib.pathname2url(os.path.abspath(site.path))
+
+# An upstream download in progress, shared by every request for the file.
+# bytes are written to the partial file and readers follow it as it grows
+class _Pull:
+	def __init__(self, url, path, sha1, label, onComplete=None):
+		self.url = url
+		self.path = path
+		self.sha1 = sha1
+		self.label = label
+		self.onComplete = onComplete
+		self.partial = transfer.partialPath(path)
+		self.cond = threading.Condition()
+		self.size = None
+		self.written = 0
+		self.started = False
+		self.renamed = False
+		self.done = False
+		self.error = None
+
+	def run(self):
+		try:
+			f = urllib2.urlopen(self.url, timeout=transfer.Timeout)
+			try:
+				length = f.info().get('Content-Length')
+				out = open(self.partial, 'wb')
+				self._update(started=True, size=length and int(length) or None)
+				m = hashlib.sha1()
+				try:
+					while True:
+						buf = f.read(transfer.ChunkSize)
+						if buf == '':
+							break
+						out.write(buf)
+						out.flush()
+						m.update(buf)
+						self._update(written=self.written + len(buf))
+				finally:
+					out.close()
+			finally:
+				f.close()
+			if self.size is not None and self.written != self.size:
+				raise transfer.IncompleteDownload("Got %d of %d bytes of %s" % (self.written, self.size, self.url))
+			self.cond.acquire()
+			try:
+				transfer._complete(self.partial, self.path, self.label, self.sha1, m.hexdigest())
+				self.renamed = True
+				self.size = self.written
+			finally:
+				self.cond.release()
+			if self.onComplete:
+				self.onComplete()
+			self._update(done=True)
+		except Exception, e:
+			logging.error("Couldn't pull %s: %s" % (self.url, str(e)))
+			if os.path.exists(self.partial):
+				try: os.remove(self.partial)
+				except OSError: pass
+			self._update(done=True, error=e)
+
+	def _update(self, **fields):
+		self.cond.acquire()
+		try:
+			self.__dict__.update(fields)
+			self.cond.notifyAll()
+		finally:
+			self.cond.release()
+
+	# wait until the size is known (i.e. the upstream response started)
+	def waitForSize(self):
+		self.cond.acquire()
+		try:
+			while not self.done and (not self.started or self.size is None):
+				self.cond.wait(1)
+			if self.error is not None:
+				raise self.error
+			return self.size
+		finally:
+			self.cond.release()
+
+	# a file handle on whatever's been written so far, which stays valid
+	# when the partial file is renamed into place
+	def open(self):
+		self.cond.acquire()
+		try:
+			if self.renamed or self.done:
+				return open(self.path, 'rb')
+			return open(self.partial, 'rb')
+		finally:
+			self.cond.release()
+
+	# wait until at least position bytes are written, returning how many are
+	def waitFor(self, position):
+		self.cond.acquire()
+		try:
+			while self.written < position and not self.done:
+				self.cond.wait(1)
+			if self.error is not None:
+				raise self.error
+			return self.written
+		finally:
+			self.cond.release()
+
+class Mirror:
+	# upstreams is a list of sites (i.e. HTTPSite, S3Site or LocalSite),
+	# ttl how often their indexes are reloaded (by default indexcache.TTL)
+	def __init__(self, upstreams, repository=None, sharded=False, ttl=None):
+		if repository is None:
+			repository = bundle.LocalRepository(DefaultPath)
+		if ttl is None:
+			ttl = indexcache.TTL
+		self.upstreams = list(upstreams)
+		self.repository = repository
+		self.sharded = sharded
+		self.ttl = ttl
+		self.indexLock = threading.Lock()
+		self.indexLoaded = None
+		# (merged index, {(id, version): site}, {path: index file contents})
+		self.state = None
+		self.pulls = {}
+		self.pullsLock = threading.Lock()
+		self.verified = {}
+
+	def _loadIndex(self):
+		merged = JSONIndex()
+		origins = {}
+		# earlier sites win, so they're merged last
+		for site in reversed(self.upstreams):
+			site.loadIndex()
+			index = site.jsonIndex
+			if isinstance(index, ShardedIndex):
+				ids = index.shards.keys()
+			else:
+				ids = index.json['bundles'].keys()
+			for id in ids:
+				for version, entry in index.bundles(id).items():
+					merged.json['bundles'].setdefault(id, {})[version] = entry
+					origins[(id, entry.get('version', version))] = site
+
+		if self.sharded:
+			sharded = ShardedIndex.fromIndex(merged)
+			files = dict(sharded.changedShards())
+			files['pynaries.json'] = str(sharded)
+		else:
+			files = {'pynaries.json': str(merged)}
+		return merged, origins, files
+
+	# (index, origins, files) as returned by _loadIndex, reloaded when it's
+	# older than ttl. requests that arrive while it's loading wait for that
+	# load rather than starting another
+	def getState(self):
+		self.indexLock.acquire()
+		try:
+			if self.state is None or time.time() - self.indexLoaded >= self.ttl:
+				try:
+					self.state = self._loadIndex()
+				except Exception, e:
+					if self.state is None:
+						raise
+					logging.warn("Couldn't reload upstream indexes, serving the previous one: " + str(e))
+				self.indexLoaded = time.time()
+			return self.state
+		finally:
+			self.indexLock.release()
+
+	# the contents of an index file (pynaries.json or a shard), or None
+	def indexFile(self, path):
+		return self.getState()[2].get(path)
+
+	# (local path, upstream URL, sha1, bundle) for an archive or delta path
+	# of the form <id>/<version>/<file>, or None if it isn't in the index.
+	# bundle is only set for archives
+	def lookup(self, path):
+		parts = path.split('/')
+		if len(parts) != 3:
+			return None
+		id, version, name = parts
+		index, origins, files = self.getState()
+		try:
+			entry = index.entry(id, version)
+		except ValueError:
+			return None # not a version
+		if entry is None:
+			return None
+		version = entry.get('version', version)
+		b = bundle.Bundle(id, version, entry['type'], self.repository)
+		url = siteURL(origins[(id, version)]) + '/' + '/'.join([id, version, name])
+		if name == b.archiveName():
+			b.sha1 = entry['sha1']
+			return (b.localArchive(), url, entry['sha1'], b)
+		for baseVersion, info in (entry.get('deltas') or {}).items():
+			if name == delta.deltaName(id, version, baseVersion):
+				return (b.deltaPath(baseVersion), url, info['sha1'], None)
+		return None
+
+	# whether the cached copy of a file has the given sha1. files are only
+	# hashed again when they change; without hashing, a copy that hasn't been
+	# verified in its current state doesn't count
+	def isCached(self, path, sha1, hashing=True):
+		try:
+			st = os.stat(path)
+		except OSError:
+			return False
+		key = (path, st.st_size, st.st_mtime)
+		if not self.verified.has_key(key):
+			if not hashing:
+				return False
+			self.verified[key] = transfer.fileSHA1(path)
+		return self.verified[key] == sha1
+
+	# the download of a file that isn't cached, started by the first request
+	# for it and joined by the rest. None if it was cached in the meantime
+	# the cached copy is hashed before taking pullsLock, which only guards
+	# looking up and registering pulls, so that hashing one big archive doesn't
+	# hold up the requests for every other file
+	def pull(self, path, url, sha1, b):
+		if self.isCached(path, sha1):
+			return None
+		self.pullsLock.acquire()
+		try:
+			pull = self.pulls.get(path)
+			if pull is not None:
+				return pull
+			# a pull that completed since then verified its file
+			if self.isCached(path, sha1, hashing=False):
+				return None
+			dir = os.path.dirname(path)
+			if not os.path.exists(dir):
+				try: os.makedirs(dir)
+				except OSError: pass
+			def complete():
+				st = os.stat(path)
+				self.verified[(path, st.st_size, st.st_mtime)] = sha1
+				if b is not None:
+					self.repository.add(b)
+			pull = _Pull(url, path, sha1, os.path.basename(path), complete)
+			self.pulls[path] = pull
+		finally:
+			self.pullsLock.release()
+
+		logging.info("Pulling " + url)
+		# the version isn't evicted by a collection while it's being pulled
+		versionDir = os.path.dirname(path)
+		lock = self.repository.versionLock(os.path.basename(os.path.dirname(versionDir)), os.path.basename(versionDir))
+		def run():
+			try:
+				lock.acquire(shared=True)
+				try:
+					pull.run()
+				finally:
+					lock.release()
+			finally:
+				self.pullsLock.acquire()
+				try:
+					del self.pulls[path]
+				finally:
+					self.pullsLock.release()
+				cleanup.collectIfDue(self.repository)
+		thread = threading.Thread(target=run)
+		thread.setDaemon(True)
+		thread.start()
+		return pull
+
+# a single "bytes=start-end" range, as (start, end) inclusive, or None
+def parseRange(header, size):
+	match = re.match('bytes\\s*=\\s*(\\d*)\\s*-\\s*(\\d*)\\s*$', header or '')
+	if match is None or (match.group(1) == '' and match.group(2) == ''):
+		return None
+	if match.group(1) == '':
+		# the last n bytes
+		return (max(0, size - int(match.group(2))), size - 1)
+	start = int(match.group(1))
+	end = size - 1
+	if match.group(2) != '':
+		end = min(end, int(match.group(2)))
+	return (start, end)
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.0'
+
+	def do_GET(self):
+		self.serve(True)
+
+	def do_HEAD(self):
+		self.serve(False)
+
+	def log_message(self, format, *args):
+		logging.debug(": %s %s" % (self.address_string(), format % args))
+
+	def serve(self, body):
+		mirror = self.server.mirror
+		path = urllib.unquote(self.path.split('?')[0]).strip('/')
+		base = self.server.basePath.strip('/')
+		if base:
+			if not path.startswith(base + '/'):
+				return self.send_error(404)
+			path = path[len(base) + 1:]
+		try:
+			data = mirror.indexFile(path)
+			if data is not None:
+				return self.serveIndex(data, body)
+			found = mirror.lookup(path)
+		except Exception, e:
+			logging.error("Couldn't load upstream indexes: " + str(e))
+			return self.send_error(502)
+		if found is None:
+			return self.send_error(404)
+
+		localPath, url, sha1, b = found
+		pull = None
+		if not mirror.isCached(localPath, sha1):
+			pull = mirror.pull(localPath, url, sha1, b)
+		if pull is None:
+			if b is not None:
+				mirror.repository.recordUse(b)
+			f = open(localPath, 'rb')
+			try:
+				self.serveFile(f, os.fstat(f.fileno()).st_size, sha1, body, None)
+			finally:
+				f.close()
+			return
+
+		try:
+			size = pull.waitForSize()
+			f = pull.open()
+		except Exception, e:
+			return self.send_error(502, "Couldn't pull %s: %s" % (path, str(e)))
+		try:
+			self.serveFile(f, size, sha1, body, pull)
+		finally:
+			f.close()
+
+	def serveIndex(self, data, body):
+		etag = '"%s"' % hashlib.sha1(data).hexdigest()
+		if self.headers.get('If-None-Match') == etag:
+			self.send_response(304)
+			self.send_header('ETag', etag)
+			self.end_headers()
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.send_header('ETag', etag)
+		self.end_headers()
+		if body:
+			self.wfile.write(data)
+
+	# send bytes of f, a file of size bytes (or a pull's partial file)
+	def serveFile(self, f, size, sha1, body, pull):
+		start, end = 0, size - 1
+		range = None
+		if self.headers.get('Range'):
+			range = parseRange(self.headers.get('Range'), size)
+		if range is not None:
+			start, end = range
+			if start >= size or start > end:
+				self.send_response(416)
+				self.send_header('Content-Range', 'bytes */%d' % size)
+				self.end_headers()
+				return
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+		else:
+			self.send_response(200)
+		self.send_header('Content-Type', 'application/octet-stream')
+		self.send_header('Content-Length', str(end - start + 1))
+		self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('ETag', '"%s"' % sha1)
+		self.end_headers()
+		if not body:
+			return
+
+		position = start
+		f.seek(position)
+		while position <= end:
+			if pull is not None:
+				# an error from upstream ends the response short, so the
+				# client sees an incomplete download and retries
+				try:
+					available = pull.waitFor(position + 1)
+				except Exception:
+					break
+				if available <= position:
+					break
+				length = min(available, end + 1) - position
+			else:
+				length = end + 1 - position
+			buf = f.read(min(transfer.ChunkSize, length))
+			if buf == '':
+				break
+			self.wfile.write(buf)
+			position += len(buf)
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	# basePath is the path the site is served under, as in HTTPSite
+	def __init__(self, address, mirror, basePath='/'):
+		BaseHTTPServer.HTTPServer.__init__(self, address, MirrorHandler)
+		self.mirror = mirror
+		self.basePath = basePath
+
+# serve a mirror of upstreams (by default, the configured pull sites) until
+# interrupted
+def serve(upstreams=None, port=8080, host='', repository=None, sharded=False, path='/'):
+	if upstreams is None:
+		upstreams = bundle.PullSites
+	if len(upstreams) == 0:
+		raise Exception("No upstream sites to mirror")
+	server = MirrorServer((host, port), Mirror(upstreams, repository, sharded), path)
+	logging.info("Mirroring %s on port %d" % (', '.join([siteURL(s) for s in upstreams]), port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	server.server_close()
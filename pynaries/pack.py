@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+The .pack bundle format. The contents of a bundle's files are concatenated
+in archive order and cut into BlockSize blocks, each compressed on its own
+with zlib, and an index of the blocks and members follows them:
+
+	"PYNPACK1"
+	block 0, block 1, ...
+	index (zlib compressed JSON)
+	footer: index offset, index size (little endian, 8 bytes each), "PYNPACK1"
+
+Blocks are cut regardless of file boundaries, so small files compress well
+together and large files span several blocks. Since the blocks are
+independent they're compressed and decompressed on the worker pool, and a
+single member is read by decompressing only the blocks that hold it. The
+index is of the form:
+
+{
+	"blocks": [[offset, compressed size, size], ...],
+	"members": [[name, kind, size, mode, data offset, link name, mtime], ...]
+}
+
+with kinds from archives.Member*, and data offsets into the concatenated
+contents.
+"""
+
+import os, stat, zlib, struct, bisect, collections
+import simplejson
+import archives, pool
+
+Magic = "PYNPACK1"
+Footer = '<QQ8s'
+BlockSize = 1024 * 1024
+
+class PackError(Exception):
+	pass
+
+# writes a pack to fileobj, which must be empty: add() everything, then close()
+class PackWriter:
+	def __init__(self, fileobj, jobs=None, blockSize=None):
+		if blockSize is None:
+			blockSize = BlockSize
+		self.fileobj = fileobj
+		self.fileobj.write(Magic)
+		self.compressor = archives.BlockCompressor(fileobj, 'zlib', jobs, blockSize)
+		self.members = []
+		self.offset = 0
+
+	# add the file, directory or symlink at path as arcname
+	def add(self, path, arcname):
+		st = os.lstat(path)
+		mode = stat.S_IMODE(st.st_mode)
+		if stat.S_ISLNK(st.st_mode):
+			self.members.append([arcname, archives.MemberSymlink, 0, mode, 0, os.readlink(path), st.st_mtime])
+		elif stat.S_ISDIR(st.st_mode):
+			self.members.append([arcname, archives.MemberDir, 0, mode, 0, '', st.st_mtime])
+		elif stat.S_ISREG(st.st_mode):
+			size = 0
+			f = open(path, 'rb')
+			try:
+				while True:
+					buf = f.read(archives.ChunkSize)
+					if buf == '':
+						break
+					self.compressor.write(buf)
+					size += len(buf)
+			finally:
+				f.close()
+			self.members.append([arcname, archives.MemberFile, size, mode, self.offset, '', st.st_mtime])
+			self.offset += size
+
+	def close(self):
+		self.compressor.close()
+		blocks = []
+		offset = len(Magic)
+		for compressedSize, size in self.compressor.sizes:
+			blocks.append([offset, compressedSize, size])
+			offset += compressedSize
+		index = zlib.compress(simplejson.dumps({'blocks': blocks, 'members': self.members}), 9)
+		self.fileobj.write(index)
+		self.fileobj.write(struct.pack(Footer, offset, len(index), Magic))
+
+# A read-only file object for the concatenated contents of a pack, starting
+# at position, that decompresses blocks as they're needed
+class _BlockReader:
+	def __init__(self, fileobj, pack, position):
+		self.fileobj = fileobj
+		self.pack = pack
+		self.next = pack.blockAt(position)
+		self.buffer = ''
+		self.offset = 0
+		if self.next < len(pack.blocks):
+			start = pack.blockStart(self.next)
+			self._load()
+			self.offset = position - start
+
+	def _load(self):
+		offset, compressedSize, size = self.pack.blocks[self.next]
+		self.fileobj.seek(offset)
+		self.buffer = self.pack.decompress(self.fileobj.read(compressedSize))
+		self.offset = 0
+		self.next += 1
+
+	def read(self, size=-1):
+		chunks = []
+		while size != 0:
+			if self.offset >= len(self.buffer):
+				if self.next >= len(self.pack.blocks):
+					break
+				self._load()
+				continue
+			if size < 0:
+				chunk = self.buffer[self.offset:]
+			else:
+				chunk = self.buffer[self.offset:self.offset + size]
+				size -= len(chunk)
+			self.offset += len(chunk)
+			chunks.append(chunk)
+		return ''.join(chunks)
+
+class Pack:
+	def __init__(self, path):
+		self.path = path
+		f = open(path, 'rb')
+		try:
+			if f.read(len(Magic)) != Magic:
+				raise PackError("Not a pack: " + path)
+			footerSize = struct.calcsize(Footer)
+			f.seek(0, 2)
+			if f.tell() < len(Magic) + footerSize:
+				raise PackError("Truncated pack: " + path)
+			f.seek(-footerSize, 2)
+			indexOffset, indexSize, magic = struct.unpack(Footer, f.read(footerSize))
+			if magic != Magic:
+				raise PackError("Truncated pack: " + path)
+			f.seek(indexOffset)
+			try:
+				index = simplejson.loads(zlib.decompress(f.read(indexSize)))
+			except (zlib.error, ValueError):
+				raise PackError("Corrupt index in pack " + path)
+		finally:
+			f.close()
+
+		self.blocks = index['blocks']
+		# where each block ends in the concatenated contents
+		self.ends = []
+		end = 0
+		for offset, compressedSize, size in self.blocks:
+			end += size
+			self.ends.append(end)
+		self.members = []
+		for name, kind, size, mode, offset, linkname, mtime in index['members']:
+			self.members.append([name.encode('utf-8'), str(kind), size, mode, offset, linkname.encode('utf-8'), mtime])
+
+	def decompress(self, data):
+		try:
+			return zlib.decompress(data)
+		except zlib.error, e:
+			raise PackError("Corrupt block in pack %s: %s" % (self.path, str(e)))
+
+	# the index of the block holding position
+	def blockAt(self, position):
+		return bisect.bisect_right(self.ends, position)
+
+	def blockStart(self, i):
+		if i == 0:
+			return 0
+		return self.ends[i - 1]
+
+	# a file object for the data of a member
+	def open(self, member):
+		raw = open(self.path, 'rb')
+		try:
+			reader = _BlockReader(raw, self, member[4])
+		except:
+			raw.close()
+			raise
+		return archives.BoundedReader(reader, member[2], raw)
+
+	# every block, decompressed, in order. at most jobs * 2 are in flight
+	def _decompressedBlocks(self, jobs):
+		from multiprocessing.pool import ThreadPool
+		workers = ThreadPool(jobs)
+		pending = collections.deque()
+		f = open(self.path, 'rb')
+		try:
+			for offset, compressedSize, size in self.blocks:
+				f.seek(offset)
+				pending.append(workers.apply_async(self.decompress, (f.read(compressedSize),)))
+				while len(pending) > jobs * 2:
+					yield pending.popleft().get()
+			while len(pending) > 0:
+				yield pending.popleft().get()
+		finally:
+			f.close()
+			workers.close()
+			workers.join()
+
+	# extract everything into dest, decompressing blocks on up to jobs
+	# threads while the files are written in order. onMember is called with
+	# each member once it's extracted
+	def extract(self, dest, jobs=None, onMember=None):
+		if jobs is None:
+			jobs = pool.DefaultJobs
+		# every name is checked before anything is written
+		paths = [archives.memberPath(dest, member[0]) for member in self.members]
+		if not os.path.exists(dest):
+			os.makedirs(dest)
+		dirs = [(m, path) for m, path in zip(self.members, paths) if m[1] == archives.MemberDir]
+		for member, path in dirs:
+			if not os.path.isdir(path):
+				os.makedirs(path)
+		root = os.path.realpath(dest)
+
+		blocks = self._decompressedBlocks(max(1, jobs))
+		try:
+			buffer = ''
+			offset = 0
+			for member, path in zip(self.members, paths):
+				if member[1] == archives.MemberFile:
+					dir = os.path.dirname(path)
+					if not os.path.isdir(dir):
+						os.makedirs(dir)
+					# nor through a symlink that an earlier member created
+					if not os.path.join(os.path.realpath(dir), '').startswith(os.path.join(root, '')):
+						raise IOError("Refusing to extract %s outside of %s" % (member[0], dest))
+					if os.path.lexists(path): os.remove(path)
+					f = open(path, 'wb')
+					try:
+						remaining = member[2]
+						while remaining > 0:
+							if offset >= len(buffer):
+								try:
+									buffer = blocks.next()
+								except StopIteration:
+									raise PackError("Truncated pack: " + self.path)
+								offset = 0
+								continue
+							chunk = buffer[offset:offset + remaining]
+							f.write(chunk)
+							offset += len(chunk)
+							remaining -= len(chunk)
+					finally:
+						f.close()
+					os.chmod(path, member[3])
+					os.utime(path, (member[6], member[6]))
+				elif member[1] == archives.MemberSymlink:
+					if os.path.lexists(path): os.remove(path)
+					os.symlink(member[5], path)
+				if onMember is not None:
+					onMember(member)
+		finally:
+			blocks.close()
+
+		# directories last, since their contents change their mtime
+		for member, path in reversed(dirs):
+			os.chmod(path, member[3])
+			os.utime(path, (member[6], member[6]))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+# the default number of worker threads used for concurrent work
+DefaultJobs = 8
+
+def SetDefaultJobs(jobs):
+	global DefaultJobs
+	DefaultJobs = max(1, int(jobs))
+
+# map fn over items using a bounded pool of worker threads,
+# returning results in the same order as items
+def parallelMap(fn, items, jobs=None):
+	items = list(items)
+	if jobs is None:
+		jobs = DefaultJobs
+	jobs = min(jobs, len(items))
+	if jobs <= 1:
+		return map(fn, items)
+
+	from multiprocessing.pool import ThreadPool
+	pool = ThreadPool(jobs)
+	try:
+		return pool.map(fn, items, 1)
+	finally:
+		pool.close()
+		pool.join()
+
+# like parallelMap, but yields results to the calling thread as soon as
+# they're ready, i.e. so it can report progress. results come in no
+# particular order unless ordered is set. at most jobs * 2 items are in
+# flight, so a slow item can't leave every later result waiting in memory
+def parallelEach(fn, items, jobs=None, ordered=False):
+	items = list(items)
+	if jobs is None:
+		jobs = DefaultJobs
+	jobs = min(jobs, len(items))
+	if jobs <= 1:
+		for item in items:
+			yield fn(item)
+		return
+
+	import collections
+	from multiprocessing.pool import ThreadPool
+	pool = ThreadPool(jobs)
+	pending = collections.deque()
+	try:
+		for item in items:
+			pending.append(pool.apply_async(fn, (item,)))
+			if len(pending) >= jobs * 2:
+				yield _next(pending, ordered)
+		while len(pending) > 0:
+			yield _next(pending, ordered)
+	finally:
+		pool.close()
+		pool.join()
+
+# the result of the oldest pending item, or unless ordered, of any that's done
+def _next(pending, ordered):
+	if not ordered:
+		for result in pending:
+			if result.ready():
+				pending.remove(result)
+				return result.get()
+	return pending.popleft().get()
@@ -3,18 +3,31 @@
 # see LICENSE in the root folder for details on the license.
 # Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
 
-import os, sys, shutil, tempfile
+import os, sys, shutil, tempfile, bisect, imp, threading
 
+# paramiko and boto are slow to import, so they're only imported once
+# an SFTP or S3 site actually needs them
 sftpEnabled = True
 try:
-	import paramiko
+	imp.find_module('paramiko')
 except ImportError, e:
 	sftpEnabled = False
 
-import bundle, console
+import bundle, console, delta, filelock, indexcache, pool, transfer
 
-import simplejson, httplib, hashlib, urllib2, StringIO
-import boto.s3, logging
+import simplejson, httplib, hashlib, urllib, urllib2, StringIO
+import logging
+
+# the bundle a resolution will occupy in repository once it's fetched
+def repositoryBundle(resolution, repository):
+	return bundle.Bundle(resolution.id, resolution.version, resolution.bundle.type, repository)
+
+# record a fetched resolution's archive in the repository catalog
+def addResolution(resolution, repository):
+	b = repositoryBundle(resolution, repository)
+	b.sha1 = resolution.sha1()
+	b.dependencies = resolution.dependencies()
+	repository.add(b)
 
 def copyResolution(path, resolution, repository):
 	bundleArchive = os.path.join(path, resolution.bundle.archiveName())
@@ -22,13 +35,93 @@ def copyResolution(path, resolution, repository):
 	try: os.makedirs(path)
 	except: pass
 	archivePath = os.path.join(path, resolution.bundle.archiveName())
-	shutil.copy(bundleArchive, archivePath)
+	transfer.copy(bundleArchive, archivePath, resolution.bundle.archiveName(), resolution.sha1())
+	addResolution(resolution, repository)
+
+# upload several bundles concurrently with upload(bundle), reporting their
+# progress as one bar, and then add them all to the site's index at once
+# with updateIndex(bundles)
+def publishAll(bundles, upload, updateIndex, jobs=None):
+	bundles = list(bundles)
+	if len(bundles) > 1 and (jobs is None or jobs > 1):
+		progress = console.ParallelProgress()
+		progress.startAll("%d bundles" % len(bundles), 'upload', len(bundles))
+		def uploadOne(b):
+			bundle.SetThreadProgress(progress)
+			try:
+				upload(b)
+			finally:
+				bundle.SetThreadProgress(None)
+				progress.finishTask()
+		try:
+			pool.parallelMap(uploadOne, bundles, jobs)
+		finally:
+			progress.finishAll()
+	else:
+		for b in bundles: upload(b)
+	logging.info("Publishing pynaries JSON index...")
+	updateIndex(bundles)
+	logging.info("Finished publishing %d bundles" % len(bundles))
+
+# when the site publishes a delta from a version that's already in the
+# repository, download it and rebuild the resolution's archive from it.
+# returns False if there's no usable delta, or rebuilding it failed
+def fetchDelta(site, resolution, repository):
+	deltas = resolution.remoteDict().get('deltas') or {}
+	baseVersions = [bundle.Version.fromObject(v) for v in deltas.keys()]
+	baseVersions.sort(reverse=True)
+	for baseVersion in baseVersions:
+		entry = deltas[str(baseVersion)]
+		base = repository.bundle(resolution.id, baseVersion)
+		if base is None or base.archiveSHA1() != entry['base']:
+			continue
+
+		target = repositoryBundle(resolution, repository)
+		deltaPath = target.deltaPath(baseVersion)
+		name = os.path.basename(deltaPath)
+		logging.info(":: => Fetching delta from %s (%d bytes)" % (str(baseVersion), entry['size']))
+		try:
+			try:
+				transfer.download(site.deltaURL(resolution, baseVersion), deltaPath, name, entry['sha1'])
+				delta.apply(deltaPath, base.localArchive(), target.localArchive(),
+					resolution.sha1(), resolution.bundle.archiveName())
+				return True
+			except Exception, e:
+				logging.warn(":: => Couldn't use delta %s, fetching the full archive: %s" % (name, str(e)))
+				return False
+		finally:
+			if os.path.exists(deltaPath): os.remove(deltaPath)
+	return False
+
+def formatJSON(json):
+	s = simplejson.dumps(json, sort_keys=True, indent=4)
+	return '\n'.join([l.rstrip() for l in s.splitlines()])
+
+# written to a temporary file and renamed into place, so readers never
+# see a partially written index
+def writeAtomic(path, data):
+	dir = os.path.dirname(os.path.abspath(path))
+	if not os.path.exists(dir):
+		try: os.makedirs(dir)
+		except OSError: pass
+	fd, tmpPath = tempfile.mkstemp(prefix='.pynaries', dir=dir)
+	f = os.fdopen(fd, 'w')
+	try:
+		f.write(data)
+	finally:
+		f.close()
+	if os.path.exists(path):
+		shutil.copymode(path, tmpPath)
+	else:
+		os.chmod(tmpPath, 0644)
+	os.rename(tmpPath, path)
 
 class JSONIndex:
 	def __init__(self):
 		self.json = {
 			'bundles': {}
 		}
+		self.versionIndex = {}
 	
 	def load(self, path):
 		f = open(path, 'r')
@@ -36,22 +129,25 @@ class JSONIndex:
 	
 	def loadstring(self, s):
 		self.json = simplejson.loads(s)
+		self.versionIndex = {}
 
 	def loadfile(self, file):
 		self.json = simplejson.load(file)
+		self.versionIndex = {}
 		file.close()
 	
 	def save(self, path):
-		f = open(path, 'w+')
-		f.write(str(self))
-		f.close()
+		writeAtomic(path, str(self))
 	
 	def __str__(self):
-		s = simplejson.dumps(self.json, sort_keys=True, indent=4)
-		return '\n'.join([l.rstrip() for l in s.splitlines()])
+		return formatJSON(self.json)
+
+	# the {version: entry} dict of an id
+	def bundles(self, id):
+		return self.json['bundles'].get(id, {})
 	
 	def add(self, bundle):
-		if not self.json['bundles'].has_key(bundle.id):
+		if not self.bundles(bundle.id):
 			self.json['bundles'][bundle.id] = {}
 		self.json['bundles'][bundle.id][str(bundle.version)] = {
 			'sha1': bundle.sha1,
@@ -59,44 +155,232 @@ class JSONIndex:
 			'id': bundle.id,
 			'version': str(bundle.version)
 		}
+		if bundle.dependencies:
+			self.json['bundles'][bundle.id][str(bundle.version)]['dependencies'] = \
+				[list(d) for d in bundle.dependencies]
+		if bundle.deltas:
+			self.json['bundles'][bundle.id][str(bundle.version)]['deltas'] = bundle.deltas
+		self.versionIndex.pop(bundle.id, None)
+
+	# the parsed versions of an id sorted ascending, along with the
+	# index keys they were parsed from. built once per id per load
+	def versions(self, id):
+		if not self.versionIndex.has_key(id):
+			pairs = [(bundle.Version.fromObject(key), key)
+				for key in self.bundles(id).keys()]
+			pairs.sort()
+			self.versionIndex[id] = ([p[0] for p in pairs], [p[1] for p in pairs])
+		return self.versionIndex[id]
+
+	# index keys of the versions matching a resolver, in ascending order
+	def matching(self, resolver):
+		versions, keys = self.versions(resolver.id)
+		start, end = resolver.matchingRange(versions)
+		return keys[start:end]
+
+	def entry(self, id, version):
+		entries = self.bundles(id)
+		if entries.has_key(str(version)):
+			return entries[str(version)]
+		versions, keys = self.versions(id)
+		version = bundle.Version.fromObject(version)
+		i = bisect.bisect_left(versions, version)
+		if i < len(versions) and versions[i] == version:
+			return entries[keys[i]]
+		return None
+
+# An index split into a small root, pynaries.json, and one shard per id
+# under index/. The root lists each id with the sha1 of its shard:
+#
+# {
+#	"format": "sharded",
+#	"bundles": {},
+#	"shards": {"com.mycompany.dep1": "<sha1 of index/com.mycompany.dep1.json>"}
+# }
+#
+# and a shard holds the {version: entry} dict a JSONIndex has for the id.
+# Shards are loaded with loadShard(id, sha1) the first time an id is looked
+# up, so a client only downloads the shards it needs (and a cached shard whose
+# sha1 still matches the root can be used as is). Publishing rewrites just the
+# shards of the ids that changed, then the root. The empty "bundles" keeps
+# older clients reading a sharded root from failing outright
+class ShardedIndex(JSONIndex):
+	Format = 'sharded'
+
+	def __init__(self, loadShard=None):
+		JSONIndex.__init__(self)
+		self.loadShard = loadShard
+		self.shards = {}
+		self.touched = set()
+		self.shardLock = threading.RLock()
+
+	@staticmethod
+	def isSharded(json):
+		return json.get('format') == ShardedIndex.Format
+
+	@staticmethod
+	def shardPath(id):
+		return 'index/%s.json' % id
+
+	# a sharded copy of a JSONIndex, with every shard still to be written
+	@staticmethod
+	def fromIndex(index, loadShard=None):
+		sharded = ShardedIndex(loadShard)
+		sharded.json = {'bundles': dict(index.json['bundles'])}
+		sharded.touched = set(sharded.json['bundles'].keys())
+		return sharded
+
+	def loadRoot(self, json):
+		self.shardLock.acquire()
+		try:
+			self.json = {'bundles': {}}
+			self.versionIndex = {}
+			self.shards = dict(json.get('shards', {}))
+			self.touched = set()
+		finally:
+			self.shardLock.release()
+
+	def loadstring(self, s):
+		self.loadRoot(simplejson.loads(s))
+
+	def loadfile(self, file):
+		self.loadRoot(simplejson.load(file))
+		file.close()
+
+	def bundles(self, id):
+		self.shardLock.acquire()
+		try:
+			if not self.json['bundles'].has_key(id) and self.shards.has_key(id) and self.loadShard:
+				data = self.loadShard(id, self.shards[id])
+				if data is None:
+					logging.warn("Index shard for %s is missing" % id)
+					self.json['bundles'][id] = {}
+				else:
+					self.json['bundles'][id] = simplejson.loads(data)
+			return self.json['bundles'].get(id, {})
+		finally:
+			self.shardLock.release()
+
+	def add(self, bundle):
+		self.shardLock.acquire()
+		try:
+			JSONIndex.add(self, bundle)
+			self.touched.add(bundle.id)
+		finally:
+			self.shardLock.release()
+
+	# (path, contents) of the shards changed since the root was loaded, with
+	# the root updated to match. these are written before the root itself
+	def changedShards(self):
+		self.shardLock.acquire()
+		try:
+			changed = []
+			for id in sorted(self.touched):
+				data = formatJSON(self.json['bundles'][id])
+				self.shards[id] = hashlib.sha1(data).hexdigest()
+				changed.append((ShardedIndex.shardPath(id), data))
+			self.touched = set()
+			return changed
+		finally:
+			self.shardLock.release()
+
+	def __str__(self):
+		return formatJSON({'format': ShardedIndex.Format, 'bundles': {}, 'shards': self.shards})
+
+# parse the data of a pynaries.json into a JSONIndex, or a ShardedIndex
+# whose shards are loaded with loadShard
+def parseIndex(data, loadShard):
+	json = simplejson.loads(data)
+	if ShardedIndex.isSharded(json):
+		index = ShardedIndex(loadShard)
+		index.loadRoot(json)
+	else:
+		index = JSONIndex()
+		index.json = json
+	return index
 		
 class LocalSite:
-	def __init__(self, path):
+	# with sharded, the site's index is written as a ShardedIndex (an
+	# existing single file index is converted the next time it's published to)
+	def __init__(self, path, sharded=False):
 		self.path = path
+		self.sharded = sharded
 		self.jsonIndex = JSONIndex()
 		self.jsonPath = os.path.join(self.path, "pynaries.json")
+		self.loadIndex()
+
+	def loadIndex(self):
 		if os.path.exists(self.jsonPath):
-			self.jsonIndex.load(self.jsonPath)
+			f = open(self.jsonPath, 'r')
+			try:
+				self.jsonIndex = parseIndex(f.read(), self.loadShard)
+			finally:
+				f.close()
 	
+	def loadShard(self, id, sha1):
+		path = os.path.join(self.path, ShardedIndex.shardPath(id))
+		if not os.path.exists(path):
+			return None
+		f = open(path, 'r')
+		try:
+			return f.read()
+		finally:
+			f.close()
+
 	def getIndex(self):
 		return self.jsonIndex
 	
 	def publish(self, bundle):
+		self.publishAll([bundle])
+
+	# copy the archives concurrently, then write the index once
+	def publishAll(self, bundles, jobs=None):
+		publishAll(bundles, self.upload, self.updateIndex, jobs)
+
+	def upload(self, bundle):
 		dir = os.path.join(self.path, bundle.id, str(bundle.version))
 		logging.info("Publishing %s into local repository.." % bundle.localArchive())
 		if not os.path.exists(dir):
-			os.makedirs(dir)
+			try: os.makedirs(dir)
+			except OSError: pass
 		
 		shutil.copy(bundle.localArchive(), dir)
-		self.jsonIndex.add(bundle)
-		self.jsonIndex.save(os.path.join(self.path, "pynaries.json"))
+		for baseVersion in bundle.deltas.keys():
+			shutil.copy(bundle.deltaPath(baseVersion), dir)
+
+	# the index is locked from reloading it to writing it back, so that
+	# concurrent publishers (in other processes too) don't drop each other's bundles
+	def updateIndex(self, bundles):
+		lock = filelock.FileLock(self.jsonPath + '.lock')
+		lock.acquire()
+		try:
+			# pick up anything published by someone else in the meantime
+			self.loadIndex()
+			if self.sharded and not isinstance(self.jsonIndex, ShardedIndex):
+				self.jsonIndex = ShardedIndex.fromIndex(self.jsonIndex, self.loadShard)
+			for bundle in bundles:
+				self.jsonIndex.add(bundle)
+			if isinstance(self.jsonIndex, ShardedIndex):
+				for path, data in self.jsonIndex.changedShards():
+					writeAtomic(os.path.join(self.path, path), data)
+			self.jsonIndex.save(self.jsonPath)
+		finally:
+			lock.release(remove=True)
 
 	def resolve(self, resolver):
-		basepath = os.path.join(self.path, resolver.id)
 		resolutions = []
-		if os.path.exists(basepath):
-			for dir in os.listdir(basepath):
-				if os.path.isdir(os.path.join(basepath,dir)) and resolver.matchesVersion(dir):
-					path = os.path.join(basepath, dir)
-					url = "file://" + path
-					url = url.replace('\\', '/')
-					url = urllib.quote_plus(url)
-					type = self.getIndex().json['bundles'][reolver.id][dir]['type']
-					bdl = bundle.Bundle(resolver.id, dir, type)
-					resolutions.append(bundle.Resolution(bdl, self, url=url))
+		index = self.getIndex()
+		for version in index.matching(resolver):
+			path = os.path.join(self.path, resolver.id, version)
+			url = 'file:' + urllib.pathname2url(path)
+			bdl = bundle.Bundle(resolver.id, version, index.entry(resolver.id, version)['type'])
+			resolutions.append(bundle.Resolution(bdl, self, url=url, path=path))
 		
 		return resolutions
 	
+	def archiveURL(self, resolution):
+		return 'file:' + urllib.pathname2url(os.path.join(resolution.arg('path'), resolution.bundle.archiveName()))
+
 	def fetch(self, resolution, repository):
 		copyResolution(resolution.arg('path'), resolution, repository)
 
@@ -118,18 +402,19 @@ if sftpEnabled:
 			self.passphrase = passphrase
 			self.sftp = None
 			self.client = None
-			self.initClient()
 		
+		# connects on first use rather than when the site is declared
 		def initClient(self):
 			if self.sftp is None or self.client is None or not self.client.get_transport().is_active():
+				import paramiko
 				self.client = paramiko.SSHClient()
 			
 				pkey = None
 				if self.identity is not None:
 					pkey = paramiko.RSAKey.from_private_key_file(self.identity, self.passphrase)
 			
-				client.connect(self.host, self.port, self.user, self.password, pkey)
-				self.sftp = client.open_sftp()
+				self.client.connect(self.host, self.port, self.user, self.password, pkey)
+				self.sftp = self.client.open_sftp()
 		
 		def publish(self, b):
 			self.initClient()
@@ -138,6 +423,13 @@ if sftpEnabled:
 			bundle.Progress.start(bundle.archiveName(), "upload", size)
 			self.sftp.put(b.localArchive(), publishPath, sftpCallback)
 			bundle.Progress.finish()
+			for baseVersion in b.deltas.keys():
+				deltaPath = b.deltaPath(baseVersion)
+				self.sftp.put(deltaPath, "/".join([self.path, b.id, str(b.version), os.path.basename(deltaPath)]))
+
+		# there's only the one SFTP channel, so these are uploaded in turn
+		def publishAll(self, bundles, jobs=None):
+			for b in bundles: self.publish(b)
 			
 		def resolve(self, resolver):
 			self.initClient()
@@ -160,11 +452,14 @@ if sftpEnabled:
 		
 		def fetch(self, resolution, repository):
 			self.initClient()
-			tmpDir = tempfile.mkdtemp()
-			tmpArchive = os.path.join(tmpDir, resolution.bundle.archiveName())
-			bundle.Progress.start(resolution.bundle.archiveName(), 'download', 0)
-			self.sftp.get(resolution.arg('path'), tmpArchive, sftpCallback)
-			copyResolution(tmpDir, resolution, repository)
+			tmpDir = repository.tempDir()
+			try:
+				tmpArchive = os.path.join(tmpDir, resolution.bundle.archiveName())
+				bundle.Progress.start(resolution.bundle.archiveName(), 'download', 0)
+				self.sftp.get(resolution.arg('path'), tmpArchive, sftpCallback)
+				copyResolution(tmpDir, resolution, repository)
+			finally:
+				shutil.rmtree(tmpDir, ignore_errors=True)
 
 class HTTPSite:
 	def __init__(self, host, port=80, path='/'):
@@ -176,85 +471,163 @@ class HTTPSite:
 		self.path = path
 		self.baseURL = 'http://%s:%s%s' % (self.host, self.port, self.path)
 		self.jsonIndex = JSONIndex()
-		try:
-			f = urllib2.urlopen(self.baseURL + '/pynaries.json')
-			self.jsonIndex.loadfile(f)
-			f.close()
-		except:
-			pass
+		self.indexLoaded = False
+		self.indexLock = threading.Lock()
+	
+	# revalidates a file of the index (pynaries.json or a shard) with a
+	# conditional GET, see indexcache.load
+	def revalidator(self, path):
+		url = self.baseURL + '/' + path
+		def revalidate(etag, lastModified):
+			request = urllib2.Request(url)
+			if etag: request.add_header('If-None-Match', etag)
+			if lastModified: request.add_header('If-Modified-Since', lastModified)
+			try:
+				f = urllib2.urlopen(request)
+			except urllib2.HTTPError, e:
+				if e.code == 304: return None
+				if e.code == 404: return (None, None, None)
+				raise
+			try:
+				return (f.read(), f.info().get('ETag'), f.info().get('Last-Modified'))
+			finally:
+				f.close()
+		return revalidate
+
+	def loadIndex(self, ttl=None):
+		data = indexcache.load(self.baseURL + '/pynaries.json', self.revalidator('pynaries.json'), ttl)
+		if data is not None:
+			self.jsonIndex = parseIndex(data, self.loadShard)
+
+	# a cached shard is only revalidated once the root says it's changed
+	def loadShard(self, id, sha1):
+		path = ShardedIndex.shardPath(id)
+		return indexcache.loadVersion(self.baseURL + '/' + path, sha1, self.revalidator(path))
 	
+	# the index is loaded the first time it's needed
 	def getIndex(self):
+		self.indexLock.acquire()
+		try:
+			if not self.indexLoaded:
+				self.loadIndex()
+				self.indexLoaded = True
+		finally:
+			self.indexLock.release()
 		return self.jsonIndex
 	
 	def publish(self, b):
 		#TODO: implement a generic way to use HTTP PUT here
 		pass
+
+	def publishAll(self, bundles, jobs=None):
+		for b in bundles: self.publish(b)
 	
 	def resolve(self, resolver):
 		resolutions = []
-		for b in self.jsonIndex.json['bundles'].keys():
-			versions = self.jsonIndex.json['bundles'][b]
-			for version in versions.keys():
-				type = self.jsonIndex.json['bundles'][b][version]['type']
-				if resolver.id == b and resolver.matchesVersion(version):
-					url = self.baseURL + '/' + resolver.id + '/' + \
-						version + '/' + bundle.Bundle.getArchiveName(resolver.id, version, type)
-					bdl = bundle.Bundle(resolver.id, version, type)
-					resolutions.append(bundle.Resolution(bdl, self, url=url))
+		index = self.getIndex()
+		for version in index.matching(resolver):
+			type = index.entry(resolver.id, version)['type']
+			url = self.baseURL + '/' + resolver.id + '/' + \
+				version + '/' + bundle.Bundle.getArchiveName(resolver.id, version, type)
+			bdl = bundle.Bundle(resolver.id, version, type)
+			resolutions.append(bundle.Resolution(bdl, self, url=url))
 		return resolutions
 
+	def archiveURL(self, resolution):
+		return self.baseURL + '/%s/%s/%s' % \
+			(resolution.id, str(resolution.version), resolution.bundle.archiveName())
+
+	def deltaURL(self, resolution, baseVersion):
+		return self.baseURL + '/%s/%s/%s' % (resolution.id, str(resolution.version),
+			delta.deltaName(resolution.id, resolution.version, baseVersion))
+
+	# streams the archive straight into the repository, see transfer.download.
+	# a delta is used instead when the repository has a version to apply it to
 	def fetch(self, resolution, repository):
-		f = urllib2.urlopen(self.baseURL + '/%s/%s/%s' %
-			(resolution.id, str(resolution.version), resolution.bundle.archiveName()))
-
-		size = f.info().get('Content-Length')
-		tmpDir = tempfile.mkdtemp()
-		tmpArchive = os.path.join(tmpDir, resolution.bundle.archiveName())
-		archiveFile = open(tmpArchive, 'wb+')
-		bundle.Progress.start(resolution.bundle.archiveName(), 'download', float(size))
-		progress = 0
-		buf = f.read(4096)
-		while buf != '':
-			archiveFile.write(buf)
-			buf = f.read(4096)
-			progress += len(buf)
-			bundle.Progress.set(progress)
-		bundle.Progress.finish()
-		f.close()
-		archiveFile.close()
-		copyResolution(tmpDir, resolution, repository)
+		if not fetchDelta(self, resolution, repository):
+			archivePath = repositoryBundle(resolution, repository).localArchive()
+			transfer.download(self.archiveURL(resolution), archivePath,
+				resolution.bundle.archiveName(), resolution.sha1())
+		addResolution(resolution, repository)
 	
 		
 class S3Site(HTTPSite):
-	def __init__(self, bucketName='pynaries', publicKey=None, privateKey=None):
+	# with sharded, the index is published as a ShardedIndex
+	def __init__(self, bucketName='pynaries', publicKey=None, privateKey=None, sharded=False):
+		self.sharded = sharded
 		self.publicKey = publicKey
 		self.privateKey = privateKey
 		self.jsonIndex = JSONIndex()
+		self.indexLoaded = False
+		self.indexLock = threading.Lock()
 		self.baseURL = 'http://s3.amazonaws.com/%s' % bucketName
-		self.connection = boto.s3.Connection(self.publicKey, self.privateKey)
-		#self.service = s3.Service(self.publicKey, self.privateKey, progress_listener=bundle.Progress)
 		self.bucketName = bucketName
-		self.bucket = self.connection.get_bucket(bucketName)
-		#self.bucket = self.service.get(bucketName)
-		pynariesJson = self.bucket.get_key("pynaries.json")
-		if pynariesJson is not None:
-			self.jsonIndex.loadstring(pynariesJson.get_contents_as_string())
+		self.threadState = threading.local()
+
+	# each thread gets its own connection, since concurrent uploads can't
+	# share one
+	def getBucket(self):
+		if getattr(self.threadState, 'bucket', None) is None:
+			import boto.s3
+			connection = boto.s3.Connection(self.publicKey, self.privateKey)
+			self.threadState.bucket = connection.get_bucket(self.bucketName)
+		return self.threadState.bucket
+
+	# compares the ETag from a HEAD of the key
+	def revalidator(self, path):
+		def revalidate(etag, lastModified):
+			key = self.getBucket().get_key(path)
+			if key is None:
+				return (None, None, None)
+			if etag is not None and key.etag == etag:
+				return None
+			return (key.get_contents_as_string(), key.etag, key.last_modified)
+		return revalidate
 		
 	def publish(self, b):
 		if isinstance(b, list):
-			for b1 in b: self.publish(b1)
-			return
-		
-		key = self.bucket.new_key('/'.join([b.id, str(b.version), b.archiveName()]))
+			self.publishAll(b)
+		else:
+			self.publishAll([b])
+
+	# upload the archives concurrently, then upload the index once
+	def publishAll(self, bundles, jobs=None):
+		publishAll(bundles, self.upload, self.updateIndex, jobs)
+
+	def upload(self, b):
+		key = self.getBucket().new_key('/'.join([b.id, str(b.version), b.archiveName()]))
 		size = os.stat(b.localArchive())[6]
 		bundle.Progress.start(b.archiveName(), "upload", size)
-		key.set_contents_from_file(open(b.localArchive(), 'rb'), cb=sftpCallback, num_cb=100, policy='public-read')
+		f = open(b.localArchive(), 'rb')
+		try:
+			key.set_contents_from_file(f, cb=sftpCallback, num_cb=100, policy='public-read')
+		finally:
+			f.close()
 		bundle.Progress.finish()
-		logging.info("Publishing pynaries JSON index...")
-		self.jsonIndex.add(b)
+		for baseVersion in b.deltas.keys():
+			deltaPath = b.deltaPath(baseVersion)
+			key = self.getBucket().new_key('/'.join([b.id, str(b.version), os.path.basename(deltaPath)]))
+			f = open(deltaPath, 'rb')
+			try:
+				key.set_contents_from_file(f, policy='public-read')
+			finally:
+				f.close()
+
+	def updateIndex(self, bundles):
+		# revalidate first, so bundles published by someone else aren't dropped
+		self.indexLock.acquire()
+		try:
+			self.loadIndex(ttl=0)
+			self.indexLoaded = True
+		finally:
+			self.indexLock.release()
+		if self.sharded and not isinstance(self.jsonIndex, ShardedIndex):
+			self.jsonIndex = ShardedIndex.fromIndex(self.jsonIndex, self.loadShard)
+		for b in bundles:
+			self.jsonIndex.add(b)
+		if isinstance(self.jsonIndex, ShardedIndex):
+			for path, data in self.jsonIndex.changedShards():
+				self.getBucket().new_key(path).set_contents_from_string(data, policy='public-read')
 		logging.debug('Creating pynaries.json')
-		key = self.bucket.new_key('pynaries.json')
-		json = str(self.jsonIndex)
-		logging.debug('set_contents_from_string')
-		key.set_contents_from_string(json, policy='public-read')
-		logging.info("Finished publishing")
+		key = self.getBucket().new_key('pynaries.json')
+		key.set_contents_from_string(str(self.jsonIndex), policy='public-read')
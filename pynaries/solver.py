@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Resolves a whole dependency graph at once. Bundles may declare their own
+(id, op, version) dependencies, which are published in the index entry of
+each version:
+
+	"dependencies": [["com.mycompany.dep1", ">=", "1.0.0"], ...]
+
+and the solver picks one version per id such that every constraint on that
+id, from the top level list or from any chosen bundle, is satisfied.
+
+It's a backtracking search that prefers the newest versions: the candidate
+versions of each id are listed once (from every pull site and the local
+repository) and tried newest first, the id with the fewest remaining
+candidates is decided next, and a choice is rejected as soon as one of its
+dependencies conflicts with a decision already made or leaves another id
+with no candidates at all.
+"""
+
+import logging
+import bundle
+
+class UnsatisfiableDependencies(Exception):
+	pass
+
+# constraints are kept as hashable (op, version string) pairs, ranges as "low,high"
+def _constraint(op, version):
+	if isinstance(version, (list, tuple)):
+		version = ','.join([str(v) for v in version])
+	return (str(op), str(version))
+
+# a resolver that matches every version
+def _anyVersion(id):
+	return bundle.Resolver(id, bundle.GreaterThanEqual, "0.0.0")
+
+class Solver:
+	def __init__(self, repository=None, remote=True, local=True):
+		if repository is None: repository = bundle.localRepository
+		self.repository = repository
+		self.remote = remote
+		self.local = local
+		self.candidateCache = {}
+		self.allowedCache = {}
+
+	# every resolution of id, newest first. a version that's both local and
+	# remote resolves to the local copy, as in Resolver.resolve
+	def candidates(self, id):
+		if not self.candidateCache.has_key(id):
+			resolver = _anyVersion(id)
+			byVersion = {}
+			if self.remote:
+				for site, resolutions in bundle.querySites(resolver):
+					for resolution in resolutions:
+						if not byVersion.has_key(resolution.version):
+							byVersion[resolution.version] = resolution
+			if self.local:
+				for resolution in self.repository.resolve(resolver):
+					byVersion[resolution.version] = resolution
+			versions = byVersion.keys()
+			versions.sort(reverse=True)
+			self.candidateCache[id] = [byVersion[v] for v in versions]
+		return self.candidateCache[id]
+
+	# the candidates of id that satisfy every constraint on it
+	def allowed(self, id, constraints):
+		key = (id, tuple(constraints))
+		if not self.allowedCache.has_key(key):
+			resolvers = [bundle.Resolver(id, op, version) for op, version in constraints]
+			self.allowedCache[key] = [c for c in self.candidates(id)
+				if not [r for r in resolvers if not r.matchesVersion(c.version)]]
+		return self.allowedCache[key]
+
+	# the (id, op, version) dependencies declared by a resolution
+	def dependencies(self, resolution):
+		return [tuple(d) for d in resolution.dependencies()]
+
+	# returns a list of resolutions, one per id in the graph, with the top
+	# level dependencies first in the order given
+	def solve(self, dependencies):
+		constraints = {}
+		order = []
+		for id, op, version in dependencies:
+			if not constraints.has_key(id):
+				constraints[id] = ()
+				order.append(id)
+			constraints[id] = constraints[id] + (_constraint(op, version),)
+
+		for id in order:
+			if len(self.allowed(id, constraints[id])) == 0:
+				raise UnsatisfiableDependencies("No version of %s matches %s" %
+					(id, ', '.join(['%s %s' % c for c in constraints[id]])))
+
+		self.failure = None
+		solution = self._search({}, constraints, order)
+		if solution is None:
+			raise UnsatisfiableDependencies("Couldn't find a consistent set of versions for %s%s" %
+				(', '.join(order), self.failure and ' (%s)' % self.failure or ''))
+		assignment, order = solution
+		return [assignment[id] for id in order]
+
+	def _search(self, assignment, constraints, order):
+		pending = [id for id in order if not assignment.has_key(id)]
+		if len(pending) == 0:
+			return (assignment, order)
+		id = min(pending, key=lambda id: len(self.allowed(id, constraints[id])))
+
+		for candidate in self.allowed(id, constraints[id]):
+			newConstraints = dict(constraints)
+			newOrder = list(order)
+			conflict = None
+			for depId, op, version in self.dependencies(candidate):
+				if not newConstraints.has_key(depId):
+					newConstraints[depId] = ()
+					newOrder.append(depId)
+				newConstraints[depId] = newConstraints[depId] + (_constraint(op, version),)
+				if assignment.has_key(depId):
+					if not bundle.Resolver(depId, op, version).matchesVersion(assignment[depId].version):
+						conflict = "%s %s needs %s %s %s, but %s was chosen" % (id, str(candidate.version),
+							depId, op, version, str(assignment[depId].version))
+						break
+				elif len(self.allowed(depId, newConstraints[depId])) == 0:
+					conflict = "%s %s needs %s %s %s, which can't be satisfied" % (id, str(candidate.version),
+						depId, op, version)
+					break
+
+			if conflict is not None:
+				logging.debug(": " + conflict)
+				self.failure = conflict
+				continue
+
+			newAssignment = dict(assignment)
+			newAssignment[id] = candidate
+			solution = self._search(newAssignment, newConstraints, newOrder)
+			if solution is not None:
+				return solution
+		return None
+
+def solve(dependencies, repository=None, remote=True, local=True):
+	return Solver(repository, remote, local).solve(dependencies)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+A content-addressed store of files under <repository>/blobs, keyed by sha1.
+Archives in the repository (<id>/<version>/<archive>) are hardlinks to their
+blob, so identical archives are only stored once. Where hardlinks aren't
+possible (i.e. across filesystems) a reflink is tried on filesystems that
+support them, then a plain copy.
+
+Extracted trees can optionally be deduplicated the same way: each regular
+file becomes a hardlink to a blob keyed by its sha1 and permissions, so
+identical files are shared across versions. Linked files must never be
+modified in place, since every link shares the same contents; replace them
+(write a new file and rename it over) instead.
+"""
+
+import os, sys, shutil, tempfile, hashlib, errno, stat
+import transfer
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def reflink(src, dest):
+	import fcntl
+	srcFile = open(src, 'rb')
+	try:
+		destFile = open(dest, 'wb')
+		try:
+			fcntl.ioctl(destFile.fileno(), FICLONE, srcFile.fileno())
+		finally:
+			destFile.close()
+	except (IOError, OSError):
+		if os.path.exists(dest): os.remove(dest)
+		raise
+	finally:
+		srcFile.close()
+
+# make dest a copy of src as cheaply as possible: a reflink if the
+# filesystem supports it, and a full copy otherwise. dest never shares
+# an inode with src, so either can be modified afterwards
+def cloneFile(src, dest):
+	if sys.platform.startswith('linux'):
+		try:
+			reflink(src, dest)
+			shutil.copystat(src, dest)
+			return
+		except (IOError, OSError):
+			pass
+	shutil.copy2(src, dest)
+
+# recreate the tree at src under dest (which may already exist), with
+# directories and symlinks copied, and regular files placed by
+# placeFile(srcPath, destPath)
+def _populateTree(src, dest, placeFile):
+	if not os.path.isdir(dest):
+		os.makedirs(dest)
+	for root, dirs, files in os.walk(src):
+		destRoot = os.path.join(dest, os.path.relpath(root, src))
+		for name in dirs + files:
+			srcPath = os.path.join(root, name)
+			destPath = os.path.join(destRoot, name)
+			if os.path.islink(srcPath):
+				if os.path.lexists(destPath): os.remove(destPath)
+				os.symlink(os.readlink(srcPath), destPath)
+			elif os.path.isdir(srcPath):
+				if not os.path.isdir(destPath):
+					os.mkdir(destPath)
+				shutil.copymode(srcPath, destPath)
+			else:
+				placeFile(srcPath, destPath)
+
+# populate dest with hardlinks to the files under src. the files are shared
+# with src, so they mustn't be modified in place
+def linkTree(src, dest):
+	_populateTree(src, dest, linkFile)
+
+# populate dest with copies (reflinks, where possible) of the files under src
+def cloneTree(src, dest):
+	def clone(srcPath, destPath):
+		if os.path.lexists(destPath): os.remove(destPath)
+		cloneFile(srcPath, destPath)
+	_populateTree(src, dest, clone)
+
+# replace dest with a hardlink to src, falling back to a clone
+def linkFile(src, dest):
+	tmpDest = dest + '.link'
+	if os.path.lexists(tmpDest): os.remove(tmpDest)
+	try:
+		os.link(src, tmpDest)
+	except OSError, e:
+		if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+			raise
+		cloneFile(src, tmpDest)
+	os.rename(tmpDest, dest)
+
+class BlobStore:
+	def __init__(self, path):
+		self.path = path
+
+	def blobPath(self, key):
+		return os.path.join(self.path, key[:2], key)
+
+	def has(self, key):
+		return os.path.exists(self.blobPath(key))
+
+	def _makeBlobDir(self, key):
+		dir = os.path.dirname(self.blobPath(key))
+		if not os.path.exists(dir):
+			try: os.makedirs(dir)
+			except OSError: pass
+
+	# take ownership of a file that's already in the repository: if an
+	# identical blob exists, path becomes a link to it, otherwise path
+	# itself becomes the blob
+	def adopt(self, path, key):
+		blob = self.blobPath(key)
+		if os.path.exists(blob):
+			if not os.path.samefile(blob, path):
+				linkFile(blob, path)
+			return blob
+		self._makeBlobDir(key)
+		try:
+			os.link(path, blob)
+		except OSError, e:
+			if e.errno == errno.EEXIST:
+				linkFile(blob, path)
+			elif e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+				self._insertCopy(path, key)
+			else:
+				raise
+		return blob
+
+	# add a copy of an outside file (which may change later) to the store
+	def _insertCopy(self, src, key):
+		blob = self.blobPath(key)
+		self._makeBlobDir(key)
+		fd, tmpPath = tempfile.mkstemp(prefix='.blob', dir=os.path.dirname(blob))
+		os.close(fd)
+		try:
+			cloneFile(src, tmpPath)
+			os.rename(tmpPath, blob)
+		except:
+			if os.path.exists(tmpPath): os.remove(tmpPath)
+			raise
+		return blob
+
+	# materialize the blob for key at dest (i.e. a repository archive path)
+	# from src, an outside file with those contents
+	def insert(self, src, key, dest):
+		if not self.has(key):
+			self._insertCopy(src, key)
+		linkFile(self.blobPath(key), dest)
+
+	# replace each regular file under dir with a link to a shared blob
+	def dedupTree(self, dir):
+		for root, dirs, files in os.walk(dir):
+			for file in files:
+				path = os.path.join(root, file)
+				st = os.lstat(path)
+				if not stat.S_ISREG(st.st_mode):
+					continue
+				key = '%s-%o' % (transfer.fileSHA1(path), stat.S_IMODE(st.st_mode))
+				self.adopt(path, key)
@@ -1,5 +1,11 @@
 import unittest
+import os, time, shutil, tempfile, zipfile, hashlib, StringIO, threading, urllib2, re
+import BaseHTTPServer, SocketServer
 from version import Version
+from bundle import Bundle, LocalRepository, Resolver, Equal, GreaterThan, GreaterThanEqual, LessThan, LessThanEqual, InRange
+from site import JSONIndex, LocalSite, HTTPSite
+import catalog, filelock
+import bundle, pool, indexcache, archives, delta, transfer, solver, lockfile, aio, cleanup, pack, mirror
 
 class VersionTestCase(unittest.TestCase):
 	def testFromString(self):
@@ -15,6 +21,1219 @@ class VersionTestCase(unittest.TestCase):
 		self.assertTrue(Version.fromObject('1.3.3') < Version.fromObject('1.3.3sp1'))
 		self.assertTrue(Version.fromObject('1.4.0') > Version.fromObject('1.3.3sp1'))
 		self.assertTrue(Version.fromObject('1.3.3p1') < Version.fromObject('1.4.0'))
+		self.assertTrue(Version.fromObject('1.3.0') < Version.fromObject('1.3.beta') < Version.fromObject('1.3.1'))
+		self.assertEquals(Version.fromObject('1.0'), Version.fromObject('1.0.0.0'))
+		self.assertNotEquals(Version.fromObject('1.0'), None)
+
+	def testHashingAndSorting(self):
+		versions = [Version.fromObject(v) for v in ['1.1.10', '1.1.1alpha1', '1.0.0', '1.1.1', '1.1.10p1']]
+		self.assertEquals([str(v) for v in sorted(versions)],
+			['1.0.0', '1.1.1', '1.1.1alpha1', '1.1.10', '1.1.10p1'])
+		self.assertEquals(len(set([Version.fromObject('1.2'), Version.fromObject('1.2.0')])), 1)
+		self.assertTrue(Version.fromString('1.2.3') is Version.fromString('1.2.3'))
+
+class PoolTestCase(unittest.TestCase):
+	def testParallelMapKeepsOrder(self):
+		def slow(n):
+			time.sleep(0.01 * (5 - n))
+			return n * 2
+		self.assertEquals(pool.parallelMap(slow, range(5), 5), [0, 2, 4, 6, 8])
+		self.assertEquals(pool.parallelMap(slow, range(5), 1), [0, 2, 4, 6, 8])
+
+	def testThreadProgress(self):
+		calls = []
+		class Sink:
+			def __init__(self, name):
+				self.name = name
+			def update(self, amount):
+				calls.append((self.name, amount))
+		default = bundle.Progress.default
+		bundle.Progress.default = Sink('default')
+		try:
+			def work(n):
+				bundle.SetThreadProgress(Sink('worker'))
+				try:
+					bundle.Progress.update(n)
+				finally:
+					bundle.SetThreadProgress(None)
+			pool.parallelMap(work, [1, 2], 2)
+			bundle.Progress.update(3)
+		finally:
+			bundle.Progress.default = default
+		self.assertEquals(sorted(calls), [('default', 3), ('worker', 1), ('worker', 2)])
+
+	def testParallelEachBoundsResultsInFlight(self):
+		started = []
+		startedDuringFirst = []
+		def slowFirst(n):
+			started.append(n)
+			if n == 0:
+				time.sleep(0.2)
+				startedDuringFirst.append(len(started))
+			return n
+		self.assertEquals(list(pool.parallelEach(slowFirst, range(100), 4, ordered=True)), range(100))
+		# nothing past the window was started while the first item ran
+		self.assertEquals(startedDuringFirst, [8])
+		self.assertEquals(sorted(pool.parallelEach(slowFirst, range(20), 4)), range(20))
+
+class AioTestCase(unittest.TestCase):
+	def testGather(self):
+		def slow(n):
+			time.sleep(0.01 * (5 - n))
+			return n * 2
+		self.assertEquals(aio.gather([aio.submit(slow, n) for n in range(5)]).result(5), [0, 2, 4, 6, 8])
+		self.assertEquals(aio.gather([]).result(), [])
+
+	def testErrors(self):
+		def fail():
+			raise ValueError("failed")
+		future = aio.submit(fail)
+		self.assertRaises(ValueError, future.result, 5)
+		self.assertTrue(isinstance(future.exception(), ValueError))
+		self.assertRaises(ValueError, aio.gather([aio.submit(time.sleep, 0), future]).result, 5)
+
+	def testAsCompleted(self):
+		futures = [aio.submit(time.sleep, t) for t in [0.2, 0]]
+		self.assertEquals(list(aio.asCompleted(futures, 5)), [futures[1], futures[0]])
+		self.assertRaises(aio.TimeoutError, aio.submit(time.sleep, 1).result, 0.01)
+
+	def testConcurrentFetchesReportSeparately(self):
+		tmpDir = tempfile.mkdtemp()
+		site = LocalSite(os.path.join(tmpDir, 'site'))
+		publisher = LocalRepository(os.path.join(tmpDir, 'publisher'))
+		published = []
+		for i in range(4):
+			source = os.path.join(tmpDir, 'source%d' % i)
+			os.makedirs(source)
+			open(os.path.join(source, 'file.bin'), 'wb').write(os.urandom(100000))
+			b = Bundle('com.test.aio%d' % i, '1.0.0', Bundle.Zip, publisher)
+			b.bundle(source)
+			site.publish(b)
+			published.append(b.sha1)
+
+		# workers mustn't share the console progress, which isn't thread safe
+		shared = []
+		class SharedProgress:
+			def __getattr__(self, name):
+				shared.append(name)
+				return lambda *args: None
+		server = RangeServer(tmpDir)
+		saved = (bundle.Progress.default, bundle.localRepository, bundle.PullSites[:])
+		bundle.Progress.default = SharedProgress()
+		bundle.localRepository = LocalRepository(os.path.join(tmpDir, 'local'))
+		bundle.PullSites[:] = [HTTPSite('127.0.0.1', server.server_address[1], '/site')]
+		try:
+			repository = LocalRepository(os.path.join(tmpDir, 'fetched'))
+			futures = [aio.fetchDependency('com.test.aio%d' % i, Equal, '1.0.0', repository) for i in range(2)]
+			futures.append(aio.fetch([('com.test.aio%d' % i, Equal, '1.0.0') for i in range(2, 4)], repository))
+			bundles = futures[0].result(30), futures[1].result(30)
+			bundles += tuple(futures[2].result(30))
+		finally:
+			bundle.Progress.default, bundle.localRepository, bundle.PullSites[:] = saved
+			server.stop()
+		try:
+			self.assertEquals([b.id for b in bundles], ['com.test.aio%d' % i for i in range(4)])
+			for b, sha1 in zip(bundles, published):
+				self.assertEquals(repository.bundle(b.id, '1.0.0').archiveSHA1(), sha1)
+			self.assertEquals(shared, [])
+		finally:
+			shutil.rmtree(tmpDir)
+
+class JSONIndexTestCase(unittest.TestCase):
+	def setUp(self):
+		self.index = JSONIndex()
+		for version in ['1.0', '1.2.0', '1.10.0', '1.2.0p1', '2.0.0', '0.9.1']:
+			self.index.add(Bundle('com.test.a', version))
+
+	def matching(self, op, version):
+		return self.index.matching(Resolver('com.test.a', op, version))
+
+	def testMatching(self):
+		self.assertEquals(self.matching(Equal, '1.0.0'), ['1.0.0'])
+		self.assertEquals(self.matching(GreaterThan, '1.2.0'), ['1.2.0p1', '1.10.0', '2.0.0'])
+		self.assertEquals(self.matching(GreaterThanEqual, '1.10.0'), ['1.10.0', '2.0.0'])
+		self.assertEquals(self.matching(LessThan, '1.2.0'), ['0.9.1', '1.0.0'])
+		self.assertEquals(self.matching(LessThanEqual, '1.2.0'), ['0.9.1', '1.0.0', '1.2.0'])
+		self.assertEquals(self.matching(InRange, '1.0.0-2.0.0'), ['1.2.0', '1.2.0p1', '1.10.0'])
+		self.assertEquals(self.index.matching(Resolver('com.test.missing', GreaterThan, '0.0.0')), [])
+
+	def testMatchingAgreesWithMatchesVersion(self):
+		for op in [Equal, GreaterThan, GreaterThanEqual, LessThan, LessThanEqual]:
+			resolver = Resolver('com.test.a', op, '1.2.0')
+			keys = self.index.json['bundles']['com.test.a'].keys()
+			expected = [k for k in keys if resolver.matchesVersion(k)]
+			self.assertEquals(sorted(self.index.matching(resolver)), sorted(expected))
+
+	def testEntry(self):
+		self.assertEquals(self.index.entry('com.test.a', Version.fromObject('1.2.0'))['version'], '1.2.0')
+		self.assertEquals(self.index.entry('com.test.a', '3.0.0'), None)
+
+class FakeSite:
+	def __init__(self, versions, delay=0):
+		self.versions = versions
+		self.delay = delay
+
+	def resolve(self, resolver):
+		time.sleep(self.delay)
+		return [bundle.Resolution(Bundle(resolver.id, v), self, url='fake:' + v)
+			for v in self.versions if resolver.matchesVersion(v)]
+
+class PullSitesTestCase(unittest.TestCase):
+	def setUp(self):
+		self.pullSites = bundle.PullSites[:]
+		bundle.PullSites[:] = []
+
+	def tearDown(self):
+		bundle.PullSites[:] = self.pullSites
+
+	def resolve(self, op, version):
+		resolver = Resolver('com.test.a', op, version)
+		start = time.time()
+		resolver.resolve(local=False)
+		return resolver.resolution, time.time() - start
+
+	def testTimeout(self):
+		fast = FakeSite(['1.0.0'])
+		bundle.AddPullSite(FakeSite(['2.0.0'], 2), timeout=0.2)
+		bundle.AddPullSite(fast)
+		resolution, elapsed = self.resolve(GreaterThan, '0.0.0')
+		self.assertEquals((str(resolution.version), resolution.site), ('1.0.0', fast))
+		self.assertTrue(elapsed < 1)
+
+	def testPriority(self):
+		low = FakeSite(['1.0.0', '1.1.0'])
+		high = FakeSite(['1.0.0'])
+		bundle.AddPullSite(low)
+		bundle.AddPullSite(high, priority=10)
+		self.assertEquals(bundle.PullSites, [high, low])
+		self.assertEquals(self.resolve(Equal, '1.0.0')[0].site, high)
+		self.assertEquals(self.resolve(GreaterThan, '0.0.0')[0].site, low)
+
+	def testExactVersionWaitsForHigherPriority(self):
+		high = FakeSite(['1.0.0'], 0.2)
+		bundle.AddPullSite(FakeSite(['1.0.0']))
+		bundle.AddPullSite(high, priority=10)
+		self.assertEquals(self.resolve(Equal, '1.0.0')[0].site, high)
+		# unless it doesn't answer in time
+		low = FakeSite(['1.0.0'])
+		bundle.PullSites[:] = []
+		bundle.AddPullSite(low)
+		bundle.AddPullSite(FakeSite(['1.0.0'], 2), priority=10, timeout=0.1)
+		resolution, elapsed = self.resolve(Equal, '1.0.0')
+		self.assertEquals(resolution.site, low)
+		self.assertTrue(elapsed < 1)
+
+	def testHungSitesShareBoundedWorkers(self):
+		hung = FakeSite(['2.0.0'], 1)
+		bundle.AddPullSite(hung, timeout=0.02)
+		bundle.AddPullSite(FakeSite(['1.0.0']))
+		workers = bundle.QueryWorkers
+		bundle.SetQueryWorkers(4)
+		threads = threading.activeCount()
+		try:
+			for i in range(10):
+				self.assertEquals(str(self.resolve(GreaterThan, '0.0.0')[0].version), '1.0.0')
+		finally:
+			bundle.SetQueryWorkers(workers)
+		# rather than a thread per site per resolve, left waiting on the hung one
+		self.assertTrue(threading.activeCount() - threads <= 4)
+
+	def testExactVersionStopsAtFirstHit(self):
+		fast = FakeSite(['1.0.0'], 0.05)
+		bundle.AddPullSite(FakeSite(['1.0.0'], 2))
+		bundle.AddPullSite(fast)
+		resolution, elapsed = self.resolve(Equal, '1.0.0')
+		self.assertEquals(resolution.site, fast)
+		self.assertTrue(elapsed < 1)
+
+class SolverTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.site = LocalSite(self.tmpDir)
+		self.add('com.test.app', '1.0.0', [('com.test.lib', GreaterThanEqual, '1.0.0')])
+		self.add('com.test.app', '2.0.0', [('com.test.lib', GreaterThanEqual, '2.0.0')])
+		self.add('com.test.lib', '1.0.0', [('com.test.core', GreaterThanEqual, '1.0.0')])
+		self.add('com.test.lib', '2.0.0', [('com.test.core', Equal, '1.0.0')])
+		self.add('com.test.core', '1.0.0', [])
+		self.add('com.test.core', '2.0.0', [])
+		self.pullSites = bundle.PullSites[:]
+		bundle.PullSites[:] = [self.site]
+
+	def tearDown(self):
+		bundle.PullSites[:] = self.pullSites
+		shutil.rmtree(self.tmpDir)
+
+	def add(self, id, version, dependencies):
+		b = Bundle(id, version)
+		b.dependencies = dependencies
+		self.site.getIndex().add(b)
+
+	def solve(self, dependencies):
+		return [(r.id, str(r.version)) for r in solver.solve(dependencies, local=False)]
+
+	def testNewestVersions(self):
+		self.assertEquals(self.solve([('com.test.app', GreaterThan, '0.0.0')]),
+			[('com.test.app', '2.0.0'), ('com.test.lib', '2.0.0'), ('com.test.core', '1.0.0')])
+
+	def testBacktracking(self):
+		# app 2.0.0 needs lib 2.0.0, which needs core 1.0.0
+		self.assertEquals(self.solve([('com.test.app', GreaterThan, '0.0.0'), ('com.test.core', GreaterThanEqual, '2.0.0')]),
+			[('com.test.app', '1.0.0'), ('com.test.core', '2.0.0'), ('com.test.lib', '1.0.0')])
+
+	def testUnsatisfiable(self):
+		self.assertRaises(solver.UnsatisfiableDependencies, self.solve,
+			[('com.test.app', GreaterThan, '0.0.0'), ('com.test.core', GreaterThan, '2.0.0')])
+		self.assertRaises(solver.UnsatisfiableDependencies, self.solve,
+			[('com.test.app', Equal, '2.0.0'), ('com.test.core', Equal, '2.0.0')])
+
+class LockfileTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		source = os.path.join(self.tmpDir, 'source')
+		os.makedirs(source)
+		f = open(os.path.join(source, 'file.txt'), 'w')
+		f.write('contents')
+		f.close()
+		self.site = LocalSite(os.path.join(self.tmpDir, 'site'))
+		b = Bundle('com.test.locked', '1.0.0', Bundle.Zip, LocalRepository(os.path.join(self.tmpDir, 'publisher')))
+		b.bundle(source)
+		self.site.publish(b)
+		self.sha1 = b.sha1
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def testLockedFetch(self):
+		dependencies = [('com.test.locked', GreaterThan, '0.0.0')]
+		resolutions = self.site.resolve(Resolver('com.test.locked', GreaterThan, '0.0.0'))
+		path = os.path.join(self.tmpDir, 'pynaries.lock')
+		lockfile.Lockfile(path).save(dependencies, False, resolutions)
+
+		lock = lockfile.Lockfile(path)
+		self.assertTrue(lock.load())
+		self.assertTrue(lock.matches(dependencies))
+		self.assertFalse(lock.matches(dependencies, transitive=True))
+		self.assertFalse(lock.matches([('com.test.locked', Equal, '1.0.0')]))
+		entry = lock.bundles()[0]
+		self.assertEquals((entry['version'], entry['sha1']), ('1.0.0', self.sha1))
+
+		repository = LocalRepository(os.path.join(self.tmpDir, 'repository'))
+		b = lockfile.fetchLocked(entry, repository)
+		self.assertEquals(transfer.fileSHA1(b.localArchive()), self.sha1)
+
+		# a repository hit doesn't go to the site at all
+		shutil.rmtree(self.site.path)
+		self.assertEquals(lockfile.fetchLocked(entry, repository).localArchive(), b.localArchive())
+
+class PublishTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.repository = LocalRepository(os.path.join(self.tmpDir, 'repository'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def testPublishAll(self):
+		source = os.path.join(self.tmpDir, 'source')
+		os.makedirs(source)
+		open(os.path.join(source, 'file.txt'), 'w').write('contents')
+		bundles = []
+		for i in range(5):
+			b = Bundle('com.test.b%d' % i, '1.0.0', Bundle.Zip, self.repository)
+			b.bundle(source)
+			bundles.append(b)
+
+		site = LocalSite(os.path.join(self.tmpDir, 'site'))
+		saves = []
+		save = site.jsonIndex.save
+		site.jsonIndex.save = lambda path: saves.append(path) or save(path)
+		site.publishAll(bundles)
+		self.assertEquals(len(saves), 1)
+
+		published = LocalSite(site.path)
+		for b in bundles:
+			self.assertEquals(published.getIndex().entry(b.id, '1.0.0')['sha1'], b.sha1)
+			self.assertTrue(os.path.exists(os.path.join(site.path, b.id, '1.0.0', b.archiveName())))
+
+	def testConcurrentIndexUpdates(self):
+		# separate sites on the same directory, as in separate processes
+		path = os.path.join(self.tmpDir, 'site')
+		os.makedirs(path)
+		def publishSome(i):
+			site = LocalSite(path)
+			for v in range(10):
+				b = Bundle('com.test.c%d' % i, '1.0.%d' % v, Bundle.Zip, self.repository)
+				b.sha1 = '%d.%d' % (i, v)
+				site.updateIndex([b])
+		pool.parallelMap(publishSome, range(4), 4)
+		index = LocalSite(path).getIndex()
+		for i in range(4):
+			self.assertEquals(len(index.bundles('com.test.c%d' % i)), 10)
+		self.assertEquals(os.listdir(path), ['pynaries.json'])
+
+class MirrorTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		source = os.path.join(self.tmpDir, 'source')
+		os.makedirs(source)
+		open(os.path.join(source, 'file.bin'), 'wb').write(os.urandom(200000))
+		self.bundle = Bundle('com.test.mirrored', '1.0.0', Bundle.Zip, LocalRepository(os.path.join(self.tmpDir, 'publisher')))
+		self.bundle.bundle(source)
+		upstream = LocalSite(os.path.join(self.tmpDir, 'upstream'))
+		upstream.publish(self.bundle)
+
+		self.mirror = mirror.Mirror([upstream], LocalRepository(os.path.join(self.tmpDir, 'mirror')))
+		self.server = mirror.MirrorServer(('127.0.0.1', 0), self.mirror, '/pynaries')
+		thread = threading.Thread(target=self.server.serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+		self.baseURL = 'http://127.0.0.1:%d/pynaries' % self.server.server_address[1]
+		self.archiveURL = '%s/com.test.mirrored/1.0.0/%s' % (self.baseURL, self.bundle.archiveName())
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		shutil.rmtree(self.tmpDir)
+
+	def testIndex(self):
+		f = urllib2.urlopen(self.baseURL + '/pynaries.json')
+		index = JSONIndex()
+		index.loadstring(f.read())
+		self.assertEquals(index.entry('com.test.mirrored', '1.0.0')['sha1'], self.bundle.sha1)
+		request = urllib2.Request(self.baseURL + '/pynaries.json')
+		request.add_header('If-None-Match', f.info().get('ETag'))
+		try:
+			urllib2.urlopen(request)
+			self.fail("expected 304")
+		except urllib2.HTTPError, e:
+			self.assertEquals(e.code, 304)
+
+	def testCachedFilesAreHashedOutsideThePullsLock(self):
+		path = os.path.join(self.tmpDir, 'first.zip')
+		transfer.download(self.archiveURL, path, self.bundle.archiveName(), self.bundle.sha1)
+		# as after a restart, when nothing cached has been verified yet
+		self.mirror.verified.clear()
+		locked = []
+		fileSHA1 = transfer.fileSHA1
+		def recordingSHA1(path):
+			locked.append(self.mirror.pullsLock.locked())
+			return fileSHA1(path)
+		transfer.fileSHA1 = recordingSHA1
+		try:
+			localPath, url, sha1, b = self.mirror.lookup('com.test.mirrored/1.0.0/' + self.bundle.archiveName())
+			self.assertEquals(self.mirror.pull(localPath, url, sha1, b), None)
+		finally:
+			transfer.fileSHA1 = fileSHA1
+		self.assertEquals(locked, [False])
+
+	def testPullsArentEvicted(self):
+		evicted = []
+		run = mirror._Pull.run
+		def collectingRun(pull):
+			evicted.extend(cleanup.collect(self.mirror.repository, budget=0))
+			run(pull)
+		mirror._Pull.run = collectingRun
+		try:
+			path = os.path.join(self.tmpDir, 'client.zip')
+			transfer.download(self.archiveURL, path, self.bundle.archiveName(), self.bundle.sha1)
+		finally:
+			mirror._Pull.run = run
+		self.assertEquals(evicted, [])
+		self.assertEquals(transfer.fileSHA1(path), self.bundle.sha1)
+
+	def testConcurrentPullsAreCollapsed(self):
+		pulls = []
+		run = mirror._Pull.run
+		def slowRun(pull):
+			pulls.append(pull.url)
+			time.sleep(0.2)
+			run(pull)
+		mirror._Pull.run = slowRun
+		try:
+			paths = [os.path.join(self.tmpDir, 'client%d.zip' % i) for i in range(5)]
+			downloads = [threading.Thread(target=transfer.download,
+				args=(self.archiveURL, path, self.bundle.archiveName(), self.bundle.sha1)) for path in paths]
+			for thread in downloads: thread.start()
+			for thread in downloads: thread.join()
+		finally:
+			mirror._Pull.run = run
+		self.assertEquals(len(pulls), 1)
+		for path in paths:
+			self.assertEquals(transfer.fileSHA1(path), self.bundle.sha1)
+		self.assertEquals(self.mirror.repository.bundle('com.test.mirrored', '1.0.0').sha1, self.bundle.sha1)
+
+		request = urllib2.Request(self.archiveURL)
+		request.add_header('Range', 'bytes=10-19')
+		f = urllib2.urlopen(request)
+		self.assertEquals(f.getcode(), 206)
+		self.assertEquals(f.read(), open(self.bundle.localArchive(), 'rb').read()[10:20])
+
+		try:
+			urllib2.urlopen(self.baseURL + '/com.test.mirrored/2.0.0/missing.zip')
+			self.fail("expected 404")
+		except urllib2.HTTPError, e:
+			self.assertEquals(e.code, 404)
+
+class ShardedIndexTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def publish(self, site, id, version):
+		b = Bundle(id, version)
+		b.sha1 = hashlib.sha1(id + version).hexdigest()
+		site.updateIndex([b])
+
+	def testShards(self):
+		site = LocalSite(self.tmpDir)
+		self.publish(site, 'com.test.a', '1.0.0')
+		# an existing single file index is converted on the next publish
+		site = LocalSite(self.tmpDir, sharded=True)
+		self.publish(site, 'com.test.b', '1.0.0')
+		self.assertTrue(os.path.exists(os.path.join(self.tmpDir, 'index', 'com.test.a.json')))
+		self.assertTrue(os.path.exists(os.path.join(self.tmpDir, 'index', 'com.test.b.json')))
+
+		# publishing only rewrites the shard that changed
+		os.utime(os.path.join(self.tmpDir, 'index', 'com.test.a.json'), (1000000000, 1000000000))
+		self.publish(site, 'com.test.b', '1.1.0')
+		self.assertEquals(os.stat(os.path.join(self.tmpDir, 'index', 'com.test.a.json')).st_mtime, 1000000000)
+
+		site = LocalSite(self.tmpDir)
+		loaded = []
+		loadShard = site.jsonIndex.loadShard
+		site.jsonIndex.loadShard = lambda id, sha1: loaded.append(id) or loadShard(id, sha1)
+		self.assertEquals(site.getIndex().matching(Resolver('com.test.b', GreaterThan, '0.0.0')), ['1.0.0', '1.1.0'])
+		self.assertEquals(site.getIndex().entry('com.test.b', '1.1.0')['sha1'], hashlib.sha1('com.test.b1.1.0').hexdigest())
+		self.assertEquals(site.getIndex().matching(Resolver('com.test.missing', GreaterThan, '0.0.0')), [])
+		self.assertEquals(loaded, ['com.test.b'])
+
+class IndexCacheTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.calls = []
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+		indexcache.SetOffline(False)
+
+	def load(self, result, ttl):
+		def revalidate(etag, lastModified):
+			self.calls.append(etag)
+			return result
+		return indexcache.load('http://example.com/pynaries.json', revalidate, ttl, self.tmpDir)
+
+	def testRevalidation(self):
+		self.assertEquals(self.load(('{"bundles": {}}', '"v1"', None), 300), '{"bundles": {}}')
+		# fresh within the TTL, so the site isn't contacted
+		self.assertEquals(self.load(('changed', '"v2"', None), 300), '{"bundles": {}}')
+		self.assertEquals(self.calls, [None])
+		# stale, but the site reports it unchanged
+		self.assertEquals(self.load(None, 0), '{"bundles": {}}')
+		self.assertEquals(self.calls, [None, '"v1"'])
+		self.assertEquals(self.load(('changed', '"v2"', None), 0), 'changed')
+
+	def testOffline(self):
+		indexcache.SetOffline(True)
+		self.assertEquals(self.load(('{}', None, None), 0), None)
+		self.assertEquals(self.calls, [])
+
+	def testLoadVersion(self):
+		def revalidate(etag, lastModified):
+			self.calls.append(etag)
+			return ('shard', '"v1"', None)
+		url = 'http://example.com/index/com.test.a.json'
+		sha1 = hashlib.sha1('shard').hexdigest()
+		self.assertEquals(indexcache.loadVersion(url, sha1, revalidate, self.tmpDir), 'shard')
+		# the cached copy has the expected sha1, so the site isn't contacted
+		self.assertEquals(indexcache.loadVersion(url, sha1, revalidate, self.tmpDir), 'shard')
+		self.assertEquals(self.calls, [None])
+		indexcache.loadVersion(url, hashlib.sha1('changed').hexdigest(), revalidate, self.tmpDir)
+		self.assertEquals(self.calls, [None, '"v1"'])
+
+class FileLockTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.path = os.path.join(self.tmpDir, 'test.lock')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def testExclusiveAndShared(self):
+		a, b = filelock.FileLock(self.path), filelock.FileLock(self.path)
+		self.assertTrue(a.acquire(shared=True))
+		self.assertTrue(b.acquire(shared=True, blocking=False))
+		b.release()
+		self.assertFalse(b.acquire(blocking=False))
+		a.release()
+		self.assertTrue(b.acquire(blocking=False))
+		b.release(remove=True)
+		self.assertFalse(os.path.exists(self.path))
+
+	def testWaiterLocksReplacedFile(self):
+		holder = filelock.FileLock(self.path)
+		holder.acquire()
+		waiter = filelock.FileLock(self.path)
+		thread = threading.Thread(target=waiter.acquire)
+		thread.start()
+		time.sleep(0.1)
+		holder.release(remove=True)
+		thread.join()
+		self.assertTrue(os.path.exists(self.path))
+		self.assertEquals(os.fstat(waiter.file.fileno()).st_ino, os.stat(self.path).st_ino)
+		waiter.release()
+
+	def testWithoutLocking(self):
+		saved = filelock.fcntl, filelock.msvcrt
+		filelock.fcntl = filelock.msvcrt = None
+		try:
+			a, b = filelock.FileLock(self.path), filelock.FileLock(self.path)
+			self.assertTrue(a.acquire())
+			self.assertTrue(b.acquire(blocking=False))
+			a.release()
+			b.release()
+		finally:
+			filelock.fcntl, filelock.msvcrt = saved
+
+class LocalRepositoryTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.repository = LocalRepository(os.path.join(self.tmpDir, 'repository'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def createArchive(self, name):
+		path = os.path.join(self.tmpDir, name)
+		z = zipfile.ZipFile(path, 'w')
+		z.writestr('hello.txt', 'hello ' + name)
+		z.close()
+		return path
+
+	def testCatalogLookups(self):
+		Bundle.createFromArchive(self.createArchive('a.zip'), 'com.test.a', '1.0.0', self.repository)
+		Bundle.createFromArchive(self.createArchive('b.zip'), 'com.test.a', '1.2.0', self.repository)
+
+		resolutions = self.repository.resolve(Resolver('com.test.a', GreaterThan, '1.1.0'))
+		self.assertEquals([str(r.version) for r in resolutions], ['1.2.0'])
+		self.assertEquals(resolutions[0].bundle.sha1, resolutions[0].bundle.archiveSHA1())
+
+		# a fresh repository object picks the catalog up from disk
+		reopened = LocalRepository(self.repository.path)
+		self.assertEquals(len(reopened.resolve(Resolver('com.test.a', Equal, '1.0.0'))), 1)
+
+	def testLookupsReadTheCatalogOnce(self):
+		archive = self.createArchive('a.zip')
+		for i in range(30):
+			Bundle.createFromArchive(archive, 'com.test.a', '1.0.%d' % i, self.repository)
+		lookups = []
+		c = self.repository.getCatalog()
+		c.versions = lambda id: lookups.append(id) or catalog.Catalog.versions(c, id)
+		c.get = lambda id, version: lookups.append((id, version)) or catalog.Catalog.get(c, id, version)
+		try:
+			self.assertEquals(len(self.repository.resolve(Resolver('com.test.a', GreaterThan, '1.0.9'))), 20)
+			self.assertEquals(len(list(self.repository.bundles())), 30)
+		finally:
+			del c.versions, c.get
+		self.assertEquals(lookups, ['com.test.a', 'com.test.a'])
+
+	def testResolveInGivenRepository(self):
+		Bundle.createFromArchive(self.createArchive('a.zip'), 'com.test.a', '1.0.0', self.repository)
+		saved = bundle.localRepository, bundle.PullSites[:]
+		bundle.localRepository = LocalRepository(os.path.join(self.tmpDir, 'default'))
+		bundle.PullSites[:] = []
+		try:
+			resolver = Resolver('com.test.a', Equal, '1.0.0')
+			resolver.resolve()
+			self.assertEquals(resolver.resolution, None)
+			resolver.resolve(repository=self.repository)
+			self.assertEquals(resolver.resolution.bundle.repository, self.repository)
+			resolver = Resolver('com.test.a', GreaterThan, '0.9')
+			self.assertEquals(resolver.fetch(self.repository).localArchive(),
+				self.repository.bundle('com.test.a', '1.0.0').localArchive())
+		finally:
+			bundle.localRepository, bundle.PullSites[:] = saved
+
+	def testArchiveSHA1(self):
+		archive = self.createArchive('a.zip')
+		b = Bundle.createFromArchive(archive, 'com.test.a', '1.0.0', self.repository)
+		self.assertEquals(b.archiveSHA1(), hashlib.sha1(open(archive, 'rb').read()).hexdigest())
+
+		# rewriting the archive invalidates the cached sha1
+		f = open(b.localArchive(), 'ab')
+		f.write('x')
+		f.close()
+		os.utime(b.localArchive(), (time.time() + 10, time.time() + 10))
+		self.assertEquals(b.archiveSHA1(), hashlib.sha1(open(archive, 'rb').read() + 'x').hexdigest())
+
+	def testIdenticalArchivesShareStorage(self):
+		archive = self.createArchive('a.zip')
+		a = Bundle.createFromArchive(archive, 'com.test.a', '1.0.0', self.repository)
+		b = Bundle.createFromArchive(archive, 'com.test.a', '1.0.1', self.repository)
+		self.assertTrue(os.path.samefile(a.localArchive(), b.localArchive()))
+		self.assertFalse(os.path.samefile(archive, a.localArchive()))
+
+		dest1 = os.path.join(self.tmpDir, 'extract1')
+		dest2 = os.path.join(self.tmpDir, 'extract2')
+		os.makedirs(dest1)
+		os.makedirs(dest2)
+		a.extract(dest1, dedup=True)
+		b.extract(dest2, dedup=True)
+		self.assertTrue(os.path.samefile(os.path.join(dest1, 'hello.txt'), os.path.join(dest2, 'hello.txt')))
+
+	def testConcurrentCatalogUpdates(self):
+		# separate catalogs of the same file, as in separate processes
+		path = os.path.join(self.repository.path, 'catalog.json')
+		def addAll(i):
+			c = catalog.Catalog(path)
+			for v in range(20):
+				c.add('com.test.%d' % i, '1.0.%d' % v, {'archive': 'a.zip'})
+		pool.parallelMap(addAll, range(4), 4)
+		c = catalog.Catalog(path)
+		self.assertTrue(c.load())
+		self.assertEquals(sorted(c.ids()), ['com.test.%d' % i for i in range(4)])
+		for i in range(4):
+			self.assertEquals(len(c.versions('com.test.%d' % i)), 20)
+
+	def testRebuildCatalog(self):
+		Bundle.createFromArchive(self.createArchive('a.zip'), 'com.test.a', '1.0.0', self.repository)
+		os.remove(os.path.join(self.repository.path, 'catalog.json'))
+		reopened = LocalRepository(self.repository.path)
+		self.assertEquals(reopened.getCatalog().versions('com.test.a').keys(), ['1.0.0'])
+
+class CleanupTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.repository = LocalRepository(os.path.join(self.tmpDir, 'repository'))
+		source = os.path.join(self.tmpDir, 'source')
+		os.makedirs(source)
+		self.bundles = []
+		for i in range(4):
+			f = open(os.path.join(source, 'file.bin'), 'wb')
+			f.write(os.urandom(100000))
+			f.close()
+			b = Bundle('com.test.cached', '1.0.%d' % i, Bundle.Zip, self.repository)
+			b.bundle(source)
+			self.bundles.append(b)
+		# as if each version was last used a second after the one before
+		self.repository.accessLog.compact(dict([((b.id, str(b.version)), 1000000000 + i)
+			for i, b in enumerate(self.bundles)]))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def versions(self):
+		return sorted(self.repository.getCatalog().versions('com.test.cached').keys())
+
+	def testEviction(self):
+		# 1.0.0 was used least recently, but a lockfile pins it
+		path = os.path.join(self.tmpDir, 'pynaries.lock')
+		resolutions = [bundle.Resolution(self.bundles[0], None)]
+		lockfile.Lockfile(path).save([('com.test.cached', Equal, '1.0.0')], False, resolutions)
+		cleanup.registerLockfile(path, self.repository)
+		self.repository.recordUse(self.bundles[1])
+
+		evicted = cleanup.collect(self.repository, budget=250000)
+		self.assertEquals(evicted, [('com.test.cached', '1.0.2'), ('com.test.cached', '1.0.3')])
+		self.assertEquals(self.versions(), ['1.0.0', '1.0.1'])
+		self.assertFalse(os.path.exists(self.bundles[2].localPath()))
+		blobs = [f for root, dirs, files in os.walk(self.repository.store.path) for f in files]
+		self.assertEquals(sorted(blobs), sorted([b.sha1 for b in self.bundles[0:2]]))
+
+		# once the lockfile is gone, its bundles can go too
+		os.remove(path)
+		self.assertEquals(cleanup.collect(self.repository, budget=150000), [('com.test.cached', '1.0.0')])
+		self.assertEquals(len(open(self.repository.accessLog.path).readlines()), 1)
+
+	def testVersionsInUseStay(self):
+		# 1.0.0 is being extracted by someone else
+		lock = self.repository.versionLock('com.test.cached', '1.0.0')
+		lock.acquire(shared=True)
+		try:
+			self.assertEquals(cleanup.collect(self.repository, budget=250000),
+				[('com.test.cached', '1.0.1'), ('com.test.cached', '1.0.2')])
+		finally:
+			lock.release()
+		self.assertEquals(self.versions(), ['1.0.0', '1.0.3'])
+		self.assertEquals(cleanup.collect(self.repository, budget=150000), [('com.test.cached', '1.0.0')])
+		self.assertEquals(sorted(os.listdir(os.path.join(self.repository.path, 'com.test.cached'))), ['1.0.3'])
+
+		# using a version records it, so it's no longer the first to go
+		self.bundles[3].extract(os.path.join(self.tmpDir, 'dest'))
+		self.assertTrue(self.repository.accessLog.load()[('com.test.cached', '1.0.3')] > 1000000003)
+
+	def testOneCollectionAtATime(self):
+		budget = cleanup.CacheBudget
+		cleanup.SetCacheBudget(0)
+		lock = cleanup._collectLock(self.repository)
+		lock.acquire()
+		try:
+			self.assertEquals(cleanup.collectIfDue(self.repository), [])
+		finally:
+			lock.release()
+			cleanup.SetCacheBudget(budget)
+		self.assertEquals(len(self.versions()), 4)
+
+	def testStaleDownloadLocks(self):
+		dir = self.bundles[0].localPath()
+		stale, held = os.path.join(dir, 'a.zip.partial.lock'), os.path.join(dir, 'b.zip.partial.lock')
+		lock = filelock.FileLock(held)
+		lock.acquire()
+		try:
+			open(stale, 'w').close()
+			os.utime(stale, (0, 0))
+			os.utime(held, (0, 0))
+			cleanup.collect(self.repository)
+			self.assertFalse(os.path.exists(stale))
+			self.assertTrue(os.path.exists(held))
+		finally:
+			lock.release()
+
+	def testOrphanBlobs(self):
+		# a blob that's about to be linked, and the blob of an archive that
+		# was copied into the repository rather than linked
+		inserting = self.repository.store.blobPath('0' * 40)
+		if not os.path.exists(os.path.dirname(inserting)):
+			os.makedirs(os.path.dirname(inserting))
+		open(inserting, 'w').close()
+		archive = self.bundles[0].localArchive()
+		shutil.copy(archive, archive + '.copy')
+		os.rename(archive + '.copy', archive)
+		copied = self.repository.store.blobPath(self.bundles[0].sha1)
+
+		cleanup.collect(self.repository)
+		self.assertTrue(os.path.exists(inserting))
+		self.assertTrue(os.path.exists(copied))
+
+		# unlinked blobs go once they're old enough, but archives stay
+		cleanup.collect(self.repository, maxAge=0)
+		self.assertFalse(os.path.exists(inserting))
+		self.assertTrue(os.path.exists(copied))
+
+	def testTemporaryFiles(self):
+		stale = self.bundles[0].localArchive() + '.partial'
+		fresh = self.bundles[1].localArchive() + '.partial'
+		for path in (stale, fresh):
+			open(path, 'w').close()
+		os.utime(stale, (1000000000, 1000000000))
+		tmpDir = self.repository.tempDir()
+		os.utime(tmpDir, (1000000000, 1000000000))
+
+		self.assertEquals(cleanup.collect(self.repository), [])
+		self.assertFalse(os.path.exists(stale))
+		self.assertFalse(os.path.exists(tmpDir))
+		self.assertTrue(os.path.exists(fresh))
+		self.assertEquals(len(self.versions()), 4)
+
+# serves the files under a directory, with byte ranges, as a plain web server
+# would; when acceptRanges is False it doesn't say that it supports them
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	def do_GET(self):
+		path = os.path.join(self.server.root, *urllib2.unquote(self.path).strip('/').split('/'))
+		if not os.path.isfile(path):
+			self.send_error(404)
+			return
+		data = open(path, 'rb').read()
+		match = re.match('bytes=(\\d+)-(\\d*)$', self.headers.get('Range', ''))
+		if match is None:
+			self.send_response(200)
+		else:
+			start = int(match.group(1))
+			end = len(data) - 1
+			if match.group(2): end = min(end, int(match.group(2)))
+			self.send_response(206)
+			self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, len(data)))
+			data = data[start:end + 1]
+		if self.server.acceptRanges:
+			self.send_header('Accept-Ranges', 'bytes')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, *args):
+		pass
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def __init__(self, root, acceptRanges=True):
+		BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+		self.root = root
+		self.acceptRanges = acceptRanges
+		self.baseURL = 'http://127.0.0.1:%d' % self.server_address[1]
+		thread = threading.Thread(target=self.serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	# clients drop responses they decide not to read, e.g. to segment instead
+	def handle_error(self, request, address):
+		pass
+
+class TransferTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.source = os.path.join(self.tmpDir, 'source.zip')
+		f = open(self.source, 'wb')
+		f.write(''.join(['%d some bytes\n' % i for i in range(50000)]))
+		f.close()
+		self.url = 'file://' + urllib2.quote(self.source)
+		self.sha1 = transfer.fileSHA1(self.source)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def testConcurrentDownloadsOfOneArchive(self):
+		# as by several processes fetching into the same repository
+		path = os.path.join(self.tmpDir, 'shared', 'archive.zip')
+		attempts = []
+		download = transfer._download
+		def slowDownload(*args):
+			attempts.append(args)
+			time.sleep(0.2)
+			download(*args)
+		errors = []
+		def fetch():
+			try:
+				transfer.download(self.url, path, 'archive.zip', self.sha1)
+			except Exception, e:
+				errors.append(e)
+		transfer._download = slowDownload
+		try:
+			downloads = [threading.Thread(target=fetch) for i in range(5)]
+			for thread in downloads: thread.start()
+			for thread in downloads: thread.join()
+		finally:
+			transfer._download = download
+		self.assertEquals(errors, [])
+		self.assertEquals(len(attempts), 1)
+		self.assertEquals(transfer.fileSHA1(path), self.sha1)
+		self.assertEquals(sorted(os.listdir(os.path.dirname(path))), ['archive.zip'])
+
+	def testSegmentedDownload(self):
+		probes = []
+		probeRanges = transfer._probeRanges
+		transfer._probeRanges = lambda url: probes.append(url) or probeRanges(url)
+		segmented = []
+		run = transfer.SegmentedDownload.run
+		transfer.SegmentedDownload.run = lambda download: segmented.append(download.ranges) or run(download)
+		segments, threshold = transfer.Segments, transfer.SegmentThreshold
+		advertising, silent = RangeServer(self.tmpDir), RangeServer(self.tmpDir, False)
+		try:
+			# small archives are fetched in one piece without a probe
+			path = os.path.join(self.tmpDir, 'whole', 'archive.zip')
+			transfer.download(advertising.baseURL + '/source.zip', path, 'archive.zip', self.sha1)
+			self.assertEquals(transfer.fileSHA1(path), self.sha1)
+			self.assertEquals((probes, segmented), ([], []))
+
+			# the server advertises ranges, so big ones are split straight away
+			transfer.SetDownloadSegments(3, 1)
+			path = os.path.join(self.tmpDir, 'segmented', 'archive.zip')
+			transfer.download(advertising.baseURL + '/source.zip', path, 'archive.zip', self.sha1)
+			self.assertEquals(transfer.fileSHA1(path), self.sha1)
+			self.assertFalse(os.path.exists(transfer.segmentsPath(path)))
+			self.assertEquals(probes, [])
+			self.assertEquals([len(ranges) for ranges in segmented], [3])
+
+			# a server that doesn't say is probed, but only once
+			for i in range(2):
+				path = os.path.join(self.tmpDir, 'probed%d' % i, 'archive.zip')
+				transfer.download(silent.baseURL + '/source.zip', path, 'archive.zip', self.sha1)
+				self.assertEquals(transfer.fileSHA1(path), self.sha1)
+			self.assertEquals(probes, [silent.baseURL + '/source.zip'])
+			self.assertEquals(len(segmented), 3)
+		finally:
+			advertising.stop()
+			silent.stop()
+			transfer.SetDownloadSegments(segments, threshold)
+			transfer._probeRanges = probeRanges
+			transfer.SegmentedDownload.run = run
+
+class ArchivesTestCase(unittest.TestCase):
+	def testMultiStreamRoundTrip(self):
+		data = ''.join(['%d some text\n' % i for i in range(20000)])
+		for compression in ['gz', 'bz2']:
+			out = StringIO.StringIO()
+			compressor = archives.BlockCompressor(out, compression, 4, 10000)
+			for i in range(0, len(data), 777):
+				compressor.write(data[i:i + 777])
+			compressor.close()
+			self.assertTrue(compressor.blocks > 10)
+
+			reader = archives.MultiStreamReader(StringIO.StringIO(out.getvalue()), compression)
+			chunks = []
+			chunk = reader.read(5000)
+			while chunk != '':
+				chunks.append(chunk)
+				chunk = reader.read(5000)
+			self.assertEquals(''.join(chunks), data)
+
+class BundleTestCase(unittest.TestCase):
+	def setUp(self):
+		self.tmpDir = tempfile.mkdtemp()
+		self.repository = LocalRepository(os.path.join(self.tmpDir, 'repository'))
+		self.source = os.path.join(self.tmpDir, 'source')
+		os.makedirs(os.path.join(self.source, 'lib', 'empty'))
+		os.makedirs(os.path.join(self.source, 'bin'))
+		for i in range(20):
+			self.writeFile(os.path.join('lib', 'file%d.txt' % i), ('line %d\n' % i) * 1000 * i)
+		self.writeFile(os.path.join('bin', 'tool'), '#!/bin/sh\necho hello\n')
+		os.chmod(os.path.join(self.source, 'bin', 'tool'), 0755)
+		os.symlink('file1.txt', os.path.join(self.source, 'lib', 'link.txt'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpDir)
+
+	def writeFile(self, path, contents):
+		f = open(os.path.join(self.source, path), 'wb')
+		f.write(contents)
+		f.close()
+
+	def listTree(self, dir):
+		tree = {}
+		for root, dirs, files in os.walk(dir):
+			for name in dirs + files:
+				path = os.path.join(root, name)
+				rel = os.path.relpath(path, dir)
+				if os.path.islink(path):
+					tree[rel] = ('link', os.readlink(path))
+				elif os.path.isdir(path):
+					tree[rel] = ('dir',)
+				else:
+					tree[rel] = ('file', open(path, 'rb').read(), os.stat(path).st_mode & 0777)
+		return tree
+
+	def assertRoundTrip(self, type):
+		b = Bundle('com.test.bundle', '1.0.0', type, self.repository)
+		b.bundle(self.source)
+		dest = os.path.join(self.tmpDir, 'dest' + type)
+		os.makedirs(dest)
+		b.extract(dest)
+		self.assertEquals(self.listTree(dest), self.listTree(self.source))
+
+	def testZipRoundTrip(self):
+		self.assertRoundTrip(Bundle.Zip)
+
+	def testTarGZRoundTrip(self):
+		self.assertRoundTrip(Bundle.TarGZ)
+
+	def testTarBZ2RoundTrip(self):
+		self.assertRoundTrip(Bundle.TarBZ2)
+
+	def testZipDirectoryModes(self):
+		archive = os.path.join(self.tmpDir, 'modes.zip')
+		z = zipfile.ZipFile(archive, 'w')
+		for name, mode in [('ro/', 0555), ('ro/private/', 0700)]:
+			info = zipfile.ZipInfo(name)
+			info.external_attr = (040000 | mode) << 16L
+			z.writestr(info, '')
+		info = zipfile.ZipInfo('ro/private/file.txt')
+		info.external_attr = 0644 << 16L
+		z.writestr(info, 'hello')
+		z.close()
+		b = Bundle.createFromArchive(archive, 'com.test.modes', '1.0.0', self.repository)
+		dest = os.path.join(self.tmpDir, 'modes')
+		b.extract(dest)
+		try:
+			self.assertEquals(open(os.path.join(dest, 'ro', 'private', 'file.txt')).read(), 'hello')
+			self.assertEquals(os.stat(os.path.join(dest, 'ro')).st_mode & 0777, 0555)
+			self.assertEquals(os.stat(os.path.join(dest, 'ro', 'private')).st_mode & 0777, 0700)
+		finally:
+			os.chmod(os.path.join(dest, 'ro'), 0755)
+
+	def testExtractModes(self):
+		b = Bundle('com.test.bundle', '1.0.0', Bundle.Zip, self.repository)
+		b.bundle(self.source)
+		for mode in (Bundle.Hardlink, Bundle.Symlink, Bundle.Copy):
+			dest = os.path.join(self.tmpDir, 'dest-' + mode)
+			b.extract(dest, mode=mode)
+			self.assertEquals(self.listTree(os.path.realpath(dest)), self.listTree(self.source))
+
+		tree = b.tree()
+		self.assertEquals(os.path.realpath(os.path.join(self.tmpDir, 'dest-symlink')), os.path.realpath(tree))
+		self.assertEquals(os.listdir(os.path.dirname(tree)), [os.path.basename(tree)])
+		linked = os.path.join(self.tmpDir, 'dest-hardlink', 'bin', 'tool')
+		copied = os.path.join(self.tmpDir, 'dest-copy', 'bin', 'tool')
+		self.assertEquals(os.stat(linked).st_ino, os.stat(os.path.join(tree, 'bin', 'tool')).st_ino)
+		self.assertNotEquals(os.stat(copied).st_ino, os.stat(linked).st_ino)
+
+		# a rebuilt archive gets a new tree. the old one stays for whatever
+		# still uses it, until collection finds it's been replaced for long enough
+		oldTree = self.listTree(tree)
+		self.writeFile(os.path.join('lib', 'new.txt'), 'new')
+		b.bundle(self.source)
+		b.extract(os.path.join(self.tmpDir, 'dest-symlink2'), mode=Bundle.Symlink)
+		self.assertNotEquals(b.tree(), tree)
+		self.assertEquals(self.listTree(os.path.join(self.tmpDir, 'dest-symlink2') + '/'), self.listTree(self.source))
+		self.assertEquals(self.listTree(os.path.join(self.tmpDir, 'dest-symlink') + '/'), oldTree)
+		cleanup.collect(self.repository)
+		self.assertTrue(os.path.exists(tree))
+		cleanup.collect(self.repository, maxAge=0)
+		self.assertFalse(os.path.exists(tree))
+		self.assertTrue(os.path.exists(b.tree()))
+
+	def testUnsafeZipMembers(self):
+		for name in ['../escaped.txt', 'lib/../../escaped.txt', '/tmp/escaped.txt']:
+			archive = os.path.join(self.tmpDir, 'unsafe.zip')
+			z = zipfile.ZipFile(archive, 'w')
+			z.writestr('safe.txt', 'safe')
+			z.writestr(zipfile.ZipInfo(name), 'escaped')
+			z.close()
+			b = Bundle.createFromArchive(archive, 'com.test.unsafe', '1.0.0', self.repository)
+			dest = os.path.join(self.tmpDir, 'dest', 'unsafe')
+			self.assertRaises(IOError, b.extract, dest)
+			self.assertFalse(os.path.exists(os.path.join(dest, 'safe.txt')))
+			self.assertFalse(os.path.exists(os.path.join(self.tmpDir, 'dest', 'escaped.txt')))
+		self.assertEquals(archives.memberPath(dest, 'lib/./file.txt'), os.path.join(dest, 'lib', 'file.txt'))
+
+	def assertMembers(self, type):
+		b = Bundle('com.test.bundle', '1.0.0', type, self.repository)
+		b.bundle(self.source)
+		listing = b.listing()
+		self.assertEquals(sorted(listing), sorted([rel + (kind[0] == 'dir' and '/' or '')
+			for rel, kind in self.listTree(self.source).items()]))
+		for name in ('lib/file19.txt', 'bin/tool', 'lib/link.txt'):
+			member = b.openMember(name)
+			try:
+				self.assertEquals(member.read(), open(os.path.join(self.source, name), 'rb').read())
+			finally:
+				member.close()
+		self.assertRaises(KeyError, b.openMember, 'lib/missing.txt')
+		self.assertRaises(IOError, b.openMember, 'lib')
+		return b
+
+	def testZipMembers(self):
+		self.assertMembers(Bundle.Zip)
+
+	def testTarMembers(self):
+		blockSize = archives.BlockSize
+		archives.BlockSize = 16 * 1024
+		try:
+			b = self.assertMembers(Bundle.TarGZ)
+		finally:
+			archives.BlockSize = blockSize
+		# the index is kept, and members are read from the stream they start in
+		self.assertTrue(os.path.exists(b.localMemberIndex()))
+		index = b._members()[2]
+		self.assertTrue(len(index.streams) > 5)
+		member = index.open(b.localArchive(), 'gz', b._members()[1]['lib/file19.txt'])
+		self.assertEquals(member.read(7), 'line 19')
+		self.assertTrue(member.raw.tell() - member.fileobj.consumed > 0)
+		member.close()
+
+		self.assertMembers(Bundle.TarBZ2)
+
+	def testPackRoundTrip(self):
+		self.assertRoundTrip(Bundle.Pack)
+
+	def testPackMembers(self):
+		blockSize = pack.BlockSize
+		pack.BlockSize = 16 * 1024
+		try:
+			b = self.assertMembers(Bundle.Pack)
+		finally:
+			pack.BlockSize = blockSize
+		packFile = pack.Pack(b.localArchive())
+		self.assertTrue(len(packFile.blocks) > 5)
+		# only the blocks holding a member are decompressed to read it
+		member = b.openMember('lib/file19.txt')
+		self.assertEquals(member.read(7), 'line 19')
+		self.assertTrue(member.fileobj.next < len(packFile.blocks))
+		member.close()
+
+		copy = os.path.join(self.tmpDir, 'copy.pack')
+		shutil.copy(b.localArchive(), copy)
+		imported = Bundle.createFromArchive(copy, 'com.test.imported', '1.0.0', self.repository)
+		self.assertTrue(imported.type is Bundle.Pack)
+		self.assertTrue(Bundle.localBundle('com.test.imported', '1.0.0', imported.localPath(), self.repository).type is Bundle.Pack)
+
+	def testUnsafePackMembers(self):
+		outside = os.path.join(self.tmpDir, 'outside')
+		os.makedirs(outside)
+		file = os.path.join(self.source, 'lib', 'file1.txt')
+		link = os.path.join(self.tmpDir, 'link')
+		os.symlink(outside, link)
+		for members in [[(file, '../escaped.txt')], [(file, '/tmp/escaped.txt')],
+				[(link, 'lib'), (file, 'lib/escaped.txt')]]:
+			archive = os.path.join(self.tmpDir, 'unsafe.pack')
+			f = open(archive, 'wb')
+			writer = pack.PackWriter(f)
+			writer.add(file, 'safe.txt')
+			for path, arcname in members:
+				writer.add(path, arcname)
+			writer.close()
+			f.close()
+			dest = os.path.join(self.tmpDir, 'dest', 'unsafe')
+			self.assertRaises(IOError, pack.Pack(archive).extract, dest)
+			self.assertEquals(os.listdir(outside), [])
+			self.assertFalse(os.path.exists(os.path.join(self.tmpDir, 'dest', 'escaped.txt')))
+			shutil.rmtree(os.path.join(self.tmpDir, 'dest'), ignore_errors=True)
+
+	def testIncrementalZip(self):
+		stale = os.path.join(self.source, 'lib', 'file3.txt')
+		os.utime(stale, (1000000000, 1000000000))
+		b = Bundle('com.test.bundle', '1.0.0', Bundle.Zip, self.repository)
+		b.bundle(self.source)
+		self.assertTrue(os.path.exists(b.localManifest()))
+
+		# same size and mtime counts as unchanged, so the old bytes are kept
+		self.writeFile(os.path.join('lib', 'file3.txt'), ('LINE 3\n') * 1000 * 3)
+		os.utime(stale, (1000000000, 1000000000))
+		self.writeFile(os.path.join('lib', 'file4.txt'), 'changed')
+		self.writeFile(os.path.join('lib', 'new.txt'), 'new')
+		os.remove(os.path.join(self.source, 'lib', 'file5.txt'))
+
+		b2 = Bundle('com.test.bundle', '1.0.1', Bundle.Zip, self.repository)
+		b2.bundle(self.source, incremental=True)
+		zip = zipfile.ZipFile(b2.localArchive())
+		try:
+			self.assertEquals(zip.testzip(), None)
+			self.assertEquals(zip.read('lib/file3.txt'), ('line 3\n') * 1000 * 3)
+			self.assertEquals(zip.read('lib/file4.txt'), 'changed')
+			self.assertEquals(zip.read('lib/new.txt'), 'new')
+			self.assertEquals(zip.read('lib/file6.txt'), ('line 6\n') * 1000 * 6)
+			self.assertFalse('lib/file5.txt' in zip.namelist())
+		finally:
+			zip.close()
+
+		# re-bundling a version in place uses its own previous archive
+		b2.bundle(self.source, incremental=True)
+		dest = os.path.join(self.tmpDir, 'dest')
+		b2.extract(dest)
+		self.writeFile(os.path.join('lib', 'file3.txt'), ('line 3\n') * 1000 * 3)
+		os.utime(stale, (1000000000, 1000000000))
+		self.assertEquals(self.listTree(dest), self.listTree(self.source))
+
+	def testDelta(self):
+		for i in range(5):
+			self.writeFile(os.path.join('lib', 'random%d.bin' % i), os.urandom(20000))
+		b = Bundle('com.test.bundle', '1.0.0', Bundle.Zip, self.repository)
+		b.bundle(self.source)
+		self.writeFile(os.path.join('lib', 'file4.txt'), 'changed')
+		self.writeFile(os.path.join('lib', 'new.txt'), 'new')
+		os.rename(os.path.join(self.source, 'lib', 'random4.bin'), os.path.join(self.source, 'lib', 'moved.bin'))
+		b2 = Bundle('com.test.bundle', '1.0.1', Bundle.Zip, self.repository)
+		b2.bundle(self.source)
+
+		deltaPath = b2.createDelta('1.0.0')
+		self.assertEquals(b2.deltas['1.0.0']['base'], b.archiveSHA1())
+		self.assertTrue(os.path.getsize(deltaPath) < os.path.getsize(b2.localArchive()) / 4)
+
+		rebuilt = os.path.join(self.tmpDir, 'rebuilt.zip')
+		delta.apply(deltaPath, b.localArchive(), rebuilt, b2.archiveSHA1())
+		self.assertEquals(transfer.fileSHA1(rebuilt), b2.archiveSHA1())
+
+		# a delta applied to the wrong base doesn't verify, and what it built
+		# is quarantined next to where it was going
+		self.assertRaises(transfer.SHA1Mismatch, delta.apply, deltaPath, b2.localArchive(), rebuilt + '.2')
+		self.assertFalse(os.path.exists(rebuilt + '.2'))
+		quarantined = os.listdir(os.path.join(self.tmpDir, 'quarantine'))
+		self.assertEquals(len(quarantined), 1)
+		self.assertTrue(quarantined[0].startswith('rebuilt.zip.2.'))
 
 
 if __name__ == '__main__':
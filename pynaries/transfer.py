@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# pynaries - licensed under the Apache Public License 2
+# see LICENSE in the root folder for details on the license.
+# Copyright (c) 2009 Appcelerator, Inc. All Rights Reserved.
+
+"""
+Streaming HTTP downloads straight into the local repository. Bytes are
+written to "<archive>.partial" and the file is renamed into place once it is
+complete, so a half-written archive is never mistaken for a real one. If a
+transfer is interrupted, the next attempt (in this process or a later one)
+resumes from the end of the partial file with an HTTP Range request.
+
+Archives of at least SegmentThreshold bytes on servers that support ranges
+are instead split into Segments byte ranges, fetched concurrently over
+separate connections into a preallocated partial file. Whether to split is
+decided from the headers of the first response, so smaller archives cost no
+extra requests; only a big archive from a server that doesn't say whether it
+supports ranges is probed, once per host. The ranges that have completed are
+recorded in "<archive>.partial.segments" so that a segmented download resumes
+by fetching only the missing ranges.
+
+Since the partial file's name is the same in every process, whoever writes it
+holds an exclusive lock on "<archive>.partial.lock" until the archive is
+renamed into place, and removes the lock file when it's done; a process that
+was waiting for the lock finds the finished archive and leaves it be.
+"""
+
+import os, re, time, socket, hashlib, threading, httplib, urllib2, urlparse, logging
+import simplejson
+import bundle, filelock
+
+ChunkSize = 1024 * 1024
+Retries = 3
+Timeout = 60
+Segments = 4
+SegmentThreshold = 64 * 1024 * 1024
+# whether each host serves byte ranges, as far as we've found out
+rangeHosts = {}
+
+def SetDownloadSegments(segments, threshold=None):
+	global Segments, SegmentThreshold
+	Segments = max(1, int(segments))
+	if threshold is not None:
+		SegmentThreshold = threshold
+
+class IncompleteDownload(Exception):
+	pass
+
+def partialPath(archivePath):
+	return archivePath + '.partial'
+
+def segmentsPath(archivePath):
+	return partialPath(archivePath) + '.segments'
+
+def lockPath(archivePath):
+	return partialPath(archivePath) + '.lock'
+
+def _fileStamp(path):
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	return (st.st_ino, st.st_mtime)
+
+# call write() holding the lock on archivePath's partial file, unless another
+# process renamed a new archivePath into place while we waited for the lock
+def exclusively(archivePath, write):
+	before = _fileStamp(archivePath)
+	lock = filelock.FileLock(lockPath(archivePath))
+	lock.acquire()
+	try:
+		stamp = _fileStamp(archivePath)
+		if stamp is not None and stamp != before:
+			logging.info(":: => %s was fetched by another process" % os.path.basename(archivePath))
+			return
+		write()
+	finally:
+		lock.release(remove=True)
+
+class SHA1Mismatch(Exception):
+	pass
+
+def updateSHA1(m, path):
+	f = open(path, 'rb')
+	try:
+		buf = f.read(ChunkSize)
+		while buf != '':
+			m.update(buf)
+			buf = f.read(ChunkSize)
+	finally:
+		f.close()
+	return m
+
+def fileSHA1(path):
+	return updateSHA1(hashlib.sha1(), path).hexdigest()
+
+# move a file that failed verification aside, keeping it for inspection in
+# a quarantine directory next to it (so it stays on the same filesystem).
+# returns where it went, or None if it couldn't be kept, and was removed
+def quarantine(path, label):
+	dir = os.path.join(os.path.dirname(path), 'quarantine')
+	quarantinePath = os.path.join(dir, '%s.%d' % (label, int(time.time())))
+	try:
+		if not os.path.exists(dir):
+			try: os.makedirs(dir)
+			except OSError: pass
+		os.rename(path, quarantinePath)
+		return quarantinePath
+	except OSError, e:
+		logging.warn("Couldn't quarantine %s: %s" % (path, str(e)))
+		try: os.remove(path)
+		except OSError: pass
+		return None
+
+# rename a finished partial file into place once its digest is verified
+def _complete(partial, archivePath, label, sha1, digest):
+	if sha1 and digest != sha1:
+		quarantinePath = quarantine(partial, label)
+		raise SHA1Mismatch("Downloaded %s has sha1 %s, but the index says %s (quarantined as %s)" %
+			(label, digest, sha1, quarantinePath or "nothing, it was removed"))
+	os.rename(partial, archivePath)
+
+def _contentRangeTotal(response):
+	match = re.match('bytes\\s+(\\d+-\\d+|\\*)/(\\d+)', response.info().get('Content-Range', ''))
+	if match is None:
+		return None
+	return int(match.group(2))
+
+# one attempt at streaming url into archivePath, resuming from any partial
+# file. the sha1 is computed as the bytes arrive, rather than in a second pass.
+# when a new download should be segmented instead, nothing is written and
+# the size of the archive is returned
+def _download(url, archivePath, label, sha1):
+	partial = partialPath(archivePath)
+	offset = 0
+	if os.path.exists(partial):
+		offset = os.path.getsize(partial)
+
+	request = urllib2.Request(url)
+	if offset > 0:
+		request.add_header('Range', 'bytes=%d-' % offset)
+	try:
+		f = urllib2.urlopen(request, timeout=Timeout)
+	except urllib2.HTTPError, e:
+		if e.code != 416 or offset == 0:
+			raise
+		# nothing left to fetch: either the partial file is already
+		# complete, or it's longer than the archive and can't be trusted
+		if _contentRangeTotal(e) == offset:
+			_complete(partial, archivePath, label, sha1, fileSHA1(partial))
+			return
+		os.remove(partial)
+		raise IncompleteDownload("Discarded invalid partial download of " + url)
+
+	try:
+		if offset == 0 and _segmentable(url, f):
+			return int(f.info().get('Content-Length'))
+		if offset > 0 and f.getcode() != 206:
+			logging.info(":: => Server ignored the range request, restarting download")
+			offset = 0
+		elif offset > 0:
+			logging.info(":: => Resuming download at byte %d" % offset)
+		m = hashlib.sha1()
+		if offset > 0:
+			updateSHA1(m, partial)
+
+		length = f.info().get('Content-Length')
+		total = None
+		if length is not None:
+			total = offset + int(length)
+
+		if offset > 0:
+			out = open(partial, 'ab')
+		else:
+			out = open(partial, 'wb')
+		try:
+			if total: bundle.Progress.start(label, 'download', total)
+			progress = offset
+			buf = f.read(ChunkSize)
+			while buf != '':
+				out.write(buf)
+				m.update(buf)
+				progress += len(buf)
+				if total: bundle.Progress.set(min(progress, total))
+				buf = f.read(ChunkSize)
+			if total: bundle.Progress.finish()
+		finally:
+			out.close()
+	finally:
+		f.close()
+
+	if total is not None and progress != total:
+		raise IncompleteDownload("Received %d of %d bytes from %s" % (progress, total, url))
+	_complete(partial, archivePath, label, sha1, m.hexdigest())
+
+# whether the server will serve byte ranges of url
+def _probeRanges(url):
+	request = urllib2.Request(url)
+	request.add_header('Range', 'bytes=0-0')
+	try:
+		f = urllib2.urlopen(request, timeout=Timeout)
+	except urllib2.HTTPError:
+		return False
+	try:
+		return f.getcode() == 206
+	finally:
+		f.close()
+
+# whether the archive that response (to a plain GET of url) is sending should
+# be segmented instead: it has to be big enough, and its server has to either
+# advertise ranges or, failing that, be found to serve them
+def _segmentable(url, response):
+	length = response.info().get('Content-Length')
+	if Segments <= 1 or length is None or int(length) < SegmentThreshold:
+		return False
+	host = urlparse.urlparse(url).netloc
+	acceptRanges = response.info().get('Accept-Ranges', '').strip().lower()
+	if acceptRanges == 'bytes':
+		rangeHosts[host] = True
+	elif acceptRanges == 'none':
+		rangeHosts[host] = False
+	elif not rangeHosts.has_key(host):
+		rangeHosts[host] = _probeRanges(url)
+	return rangeHosts[host]
+
+# the size recorded for an interrupted segmented download, or None
+def _segmentedSize(archivePath):
+	try:
+		f = open(segmentsPath(archivePath), 'r')
+		try:
+			return simplejson.load(f).get('size')
+		finally:
+			f.close()
+	except (IOError, ValueError):
+		return None
+
+class SegmentedDownload:
+	def __init__(self, url, archivePath, size, label, segments):
+		self.url = url
+		self.archivePath = archivePath
+		self.partial = partialPath(archivePath)
+		self.statePath = segmentsPath(archivePath)
+		self.size = size
+		self.label = label
+		self.lock = threading.Lock()
+		self.received = 0
+
+		self.ranges = None
+		if os.path.exists(self.statePath) and os.path.exists(self.partial):
+			self.ranges = self._loadState()
+		if self.ranges is None:
+			segmentSize = (size + segments - 1) / segments
+			self.ranges = [[start, min(start + segmentSize, size) - 1, False]
+				for start in range(0, size, segmentSize)]
+			f = open(self.partial, 'wb')
+			f.truncate(size)
+			f.close()
+			self._saveState()
+		else:
+			logging.info(":: => Resuming segmented download of " + label)
+
+	def _loadState(self):
+		try:
+			f = open(self.statePath, 'r')
+			try:
+				state = simplejson.load(f)
+			finally:
+				f.close()
+		except (IOError, ValueError):
+			return None
+		if state.get('size') != self.size or os.path.getsize(self.partial) != self.size:
+			return None
+		return state['ranges']
+
+	def _saveState(self):
+		f = open(self.statePath, 'w')
+		try:
+			simplejson.dump({'url': self.url, 'size': self.size, 'ranges': self.ranges}, f)
+		finally:
+			f.close()
+
+	def _fetchRange(self, segment):
+		start, end, done = segment
+		if done:
+			self._count(end - start + 1)
+			return
+		attempt = 0
+		written = 0
+		while True:
+			attempt += 1
+			try:
+				written += self._fetchBytes(start + written, end)
+				break
+			except (IncompleteDownload, urllib2.URLError, httplib.HTTPException, socket.error), e:
+				if isinstance(e, urllib2.HTTPError) or attempt >= Retries:
+					raise
+				logging.warn(":: => Segment %d-%d of %s interrupted (%s), retrying" % (start, end, self.url, str(e)))
+		self.lock.acquire()
+		try:
+			segment[2] = True
+			self._saveState()
+		finally:
+			self.lock.release()
+
+	def _count(self, amount):
+		self.lock.acquire()
+		self.received += amount
+		self.lock.release()
+
+	# fetch bytes start..end (inclusive), returning how many were written
+	def _fetchBytes(self, start, end):
+		request = urllib2.Request(self.url)
+		request.add_header('Range', 'bytes=%d-%d' % (start, end))
+		f = urllib2.urlopen(request, timeout=Timeout)
+		written = 0
+		try:
+			if f.getcode() != 206:
+				raise IncompleteDownload("Server ignored the range request for " + self.url)
+			out = open(self.partial, 'r+b')
+			try:
+				out.seek(start)
+				buf = f.read(ChunkSize)
+				while buf != '':
+					out.write(buf)
+					written += len(buf)
+					self._count(len(buf))
+					buf = f.read(ChunkSize)
+			finally:
+				out.close()
+		finally:
+			f.close()
+		if written != end - start + 1:
+			raise IncompleteDownload("Received %d of %d bytes from %s" % (written, end - start + 1, self.url))
+		return written
+
+	def run(self):
+		from multiprocessing.pool import ThreadPool
+		pool = ThreadPool(len(self.ranges))
+		bundle.Progress.start(self.label, 'download', self.size)
+		try:
+			result = pool.map_async(self._fetchRange, self.ranges, 1)
+			# progress is reported from this thread, the segment workers only count
+			while not result.ready():
+				result.wait(0.25)
+				bundle.Progress.set(min(self.received, self.size))
+			result.get()
+			bundle.Progress.finish()
+		finally:
+			pool.close()
+			pool.join()
+		os.remove(self.statePath)
+
+# download url into archivePath, retrying interrupted transfers from where
+# they left off. the partial file is kept on failure so a later run can resume.
+# when sha1 is given the finished archive is verified against it, and moved
+# into quarantine if it doesn't match
+def download(url, archivePath, label=None, sha1=None):
+	if label is None:
+		label = os.path.basename(archivePath)
+	dir = os.path.dirname(archivePath)
+	if not os.path.exists(dir):
+		try: os.makedirs(dir)
+		except OSError: pass
+	exclusively(archivePath, lambda: _downloadLocked(url, archivePath, label, sha1))
+	return archivePath
+
+def _downloadLocked(url, archivePath, label, sha1):
+	if os.path.exists(segmentsPath(archivePath)):
+		size = _segmentedSize(archivePath)
+		if Segments > 1 and size is not None and os.path.exists(partialPath(archivePath)):
+			_downloadSegments(url, archivePath, size, label, sha1)
+			return
+		# can't continue the segmented download, so start over
+		os.remove(segmentsPath(archivePath))
+		if os.path.exists(partialPath(archivePath)):
+			os.remove(partialPath(archivePath))
+
+	attempt = 0
+	while True:
+		attempt += 1
+		try:
+			size = _download(url, archivePath, label, sha1)
+			break
+		except (IncompleteDownload, urllib2.URLError, httplib.HTTPException, socket.error), e:
+			if isinstance(e, urllib2.HTTPError) or attempt >= Retries:
+				raise
+			logging.warn(":: => Download of %s interrupted (%s), retrying" % (url, str(e)))
+	# segments retry on their own, so this happens outside the loop above
+	if size is not None:
+		_downloadSegments(url, archivePath, size, label, sha1)
+
+def _downloadSegments(url, archivePath, size, label, sha1):
+	SegmentedDownload(url, archivePath, size, label, Segments).run()
+	# segments arrive out of order, so this one needs a separate pass
+	digest = None
+	if sha1: digest = fileSHA1(partialPath(archivePath))
+	_complete(partialPath(archivePath), archivePath, label, sha1, digest)
+
+# copy src to dest, verifying the copy's sha1 as it's written
+def copy(src, dest, label=None, sha1=None):
+	if label is None:
+		label = os.path.basename(dest)
+	exclusively(dest, lambda: _copyLocked(src, dest, label, sha1))
+	return dest
+
+def _copyLocked(src, dest, label, sha1):
+	partial = partialPath(dest)
+	m = hashlib.sha1()
+	input = open(src, 'rb')
+	try:
+		out = open(partial, 'wb')
+		try:
+			buf = input.read(ChunkSize)
+			while buf != '':
+				out.write(buf)
+				m.update(buf)
+				buf = input.read(ChunkSize)
+		finally:
+			out.close()
+	finally:
+		input.close()
+	_complete(partial, dest, label, sha1, m.hexdigest())
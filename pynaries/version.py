@@ -17,7 +17,16 @@ for example:
  - 1.1.10 > 1.1.1alpha1
  - 1.1.10p1 > 1.1.10
 """
-class Version:
+import re
+
+numericPrefix = re.compile(r'^(\d*)(.*)$')
+
+class Version(object):
+	# versions are immutable once constructed; fromString hands out shared
+	# instances, and the sort key is computed once up front
+	__slots__ = ('major', 'minor', 'micro', 'qualifier', 'key')
+	cache = {}
+
 	def __init__(self, major, minor, micro='0', qualifier=None):
 		self.major = int(major)
 		self.minor = str(minor)
@@ -27,26 +36,30 @@ class Version:
 		if micro is None:
 			self.micro = '0'
 		self.qualifier = qualifier
+		self.key = (self.major, Version.pieceKey(self.minor),
+			Version.pieceKey(self.micro), Version.pieceKey(self.qualifier))
 	
+	# a piece sorts by its leading number, then by the annotation after it
+	@staticmethod
+	def pieceKey(piece):
+		if piece is None: return (0, '')
+		numeric, annotation = numericPrefix.match(str(piece)).groups()
+		if numeric == '': return (0, annotation)
+		return (int(numeric), annotation)
+
 	@staticmethod
 	def getNumericPiece(str):
 		if str is None: return '0'
-		n = ""
-		for c in str:
-			if c.isdigit():
-				n += c
-			else:
-				break
-		return n
+		return numericPrefix.match(str).group(1)
 	
 	@staticmethod
 	def getAnnotationPiece(s):
 		if s is None: return None
 		
-		n = Version.getNumericPiece(s)
-		if n is s:
+		annotation = numericPrefix.match(s).group(2)
+		if annotation == '':
 			return None
-		return s[len(n):]
+		return annotation
 	
 	@staticmethod
 	def fromObject(o):
@@ -60,7 +73,11 @@ class Version:
 	
 	@staticmethod
 	def fromString(str):
-		return Version.fromList(str.split('.'))
+		v = Version.cache.get(str)
+		if v is None:
+			v = Version.fromList(str.split('.'))
+			Version.cache[str] = v
+		return v
 	
 	@staticmethod
 	def fromList(list):
@@ -78,13 +95,7 @@ class Version:
 		
 	@staticmethod
 	def comparePiece(p1, p2):
-		c = int(Version.getNumericPiece(p1)) - int(Version.getNumericPiece(p2))
-		if c != 0:
-			return c
-		c = cmp(Version.getAnnotationPiece(p1), Version.getAnnotationPiece(p2))
-		if c != 0:
-			return c
-		return 0
+		return cmp(Version.pieceKey(p1), Version.pieceKey(p2))
 
 	def __str__(self):
 		s = str(self.major) + '.' + str(self.minor)
@@ -93,21 +104,29 @@ class Version:
 			s += '.' + str(self.qualifier)
 		return s
 	
+	def __repr__(self):
+		return 'Version(%s)' % str(self)
+
+	def __hash__(self):
+		return hash(self.key)
+
 	def __cmp__(self, other):
-		majorCmp = self.major - other.major
-		if majorCmp != 0:
-			return majorCmp
-		
-		#same majors, proceed
-		minorCmp = Version.comparePiece(self.minor, other.minor)
-		if minorCmp != 0:
-			return minorCmp
-		
-		microCmp = Version.comparePiece(self.micro, other.micro)
-		if microCmp != 0:
-			return microCmp
-		
-		qCmp = Version.comparePiece(self.qualifier, other.qualifier)
-		if qCmp != 0:
-			return qCmp
-		return 0
+		return cmp(self.key, other.key)
+
+	def __eq__(self, other):
+		return isinstance(other, Version) and self.key == other.key
+
+	def __ne__(self, other):
+		return not self.__eq__(other)
+
+	def __lt__(self, other):
+		return self.key < other.key
+
+	def __le__(self, other):
+		return self.key <= other.key
+
+	def __gt__(self, other):
+		return self.key > other.key
+
+	def __ge__(self, other):
+		return self.key >= other.key